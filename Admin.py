@@ -1,22 +1,26 @@
 # Admin.py - methods supporting wiki administration
 
 from types import *
-import os, re, os.path
+import os, re, os.path, zlib
 from string import join, split, strip
-from time import clock
+from time import time, sleep
 
 from AccessControl import getSecurityManager, ClassSecurityInfo, Unauthorized
+from Acquisition import aq_base
 from Globals import package_home, InitializeClass
 from OFS.CopySupport import CopyError
 from OFS.DTMLMethod import DTMLMethod
 from DateTime import DateTime
+from Persistence import PersistentMapping
+from BTrees.OOBTree import OOBTree
+from ZODB.POSException import ConflictError
 
 from i18n import _
 import Permissions
 from Utils import get_transaction, BLATHER, formattedTraceback, \
      DateTimeSyntaxError, callHooks, isunicode, safe_hasattr
 from plugins.pagetypes import PAGE_TYPE_UPGRADES, PAGE_TYPES, modernPageTypeFor
-from Defaults import PAGE_METADATA, \
+from Defaults import PAGE_METADATA, PAGE_JOB_CONFLICT_RETRIES, PAGE_JOB_SHARD_WAIT, \
      TEXTINDEXES, FIELDINDEXES, KEYWORDINDEXES, DATEINDEXES, PATHINDEXES
 
 
@@ -27,7 +31,8 @@ class PageAdminSupport:
     security = ClassSecurityInfo()
 
     security.declarePublic('upgradeAll') # we check folder permission at runtime
-    def upgradeAll(self,render=1,batch=0,REQUEST=None): # -> none
+    def upgradeAll(self,render=1,batch=0,shard=0,shards=1,restart=0,
+                   REQUEST=None): # -> none
         # depends on: wiki
         # modifies: wiki (folder, pages, dtml methods, catalog, outline, revisions..)
         """
@@ -51,6 +56,17 @@ class PageAdminSupport:
         The optional batch argument forces a commit every N pages.
         This may be useful to get a complete run in large/busy wikis,
         which can be difficult due to conflict errors or memory usage.
+        Progress is saved with each commit, and if a batched run is
+        interrupted, running it again carries on where it stopped
+        (unless restart is set). Pages whose batch hits a conflict error
+        are retried one at a time.
+
+        To share the work between several zope processes (eg ZEO
+        clients), call this in each with the same shards value (the
+        number of processes) and a different shard (0..shards-1); each
+        upgrades its part of the pages. The first shard also does the
+        wiki-wide setup, which the others wait for, and whichever
+        finishes last the wiki-wide rebuilds.
 
         Requires 'Manage properties' permission on the folder.
         """
@@ -60,37 +76,256 @@ class PageAdminSupport:
              _('You are not authorized to upgrade all pages.') + \
              _('(folder -> Manage properties)'))
         
-        batch = int(batch)
+        batch, shard, shards = int(batch), int(shard), int(shards or 1)
         if render: BLATHER('upgrading/reindexing/pre-rendering all pages:')
         else: BLATHER('upgrading/reindexing all pages:')
-        starttime = clock()
-        n, total = 0, self.pageCount()
-        self.setupCatalog(reindex=0)
-        self.rebuildWikiOutline()
-        for p in self.pageObjects(): # poor caching (not a problem here)
-            n += 1
+        def setup():
+            self.setupCatalog(reindex=0)
+            self.rebuildWikiOutline()
+            self.rebuildRevisionIndex()
+        def upgradePage(p):
+            p.upgrade(REQUEST)
+            p.upgradeId(REQUEST)
+            p.fixEncoding()
+            if render: p.preRender(clear_cache=1)
+            # make sure every page is cataloged - slow but thorough
+            p.index_object(log=0)
+        def finish():
+            self.rebuildSubscriptionIndex()
+            self.rebuildLinkGraph()
+            self.setupDtmlMethods()
+        self.runPageJob('upgradeAll', upgradePage, batch=batch,
+                        shard=shard, shards=shards, restart=restart,
+                        setup=setup, finish=finish)
+        BLATHER('upgrade complete')
+
+    # bulk page jobs
+
+    security.declarePrivate('pageJobCheckpoints')
+    def pageJobCheckpoints(self):
+        """
+        The progress records of bulk page jobs (see runPageJob) in this
+        wiki, by job name and shard.
+        """
+        folder = self.folder()
+        checkpoints = getattr(aq_base(folder),'_pagejobs',None)
+        if checkpoints is None: checkpoints = folder._pagejobs = OOBTree()
+        return checkpoints
+
+    security.declarePrivate('pageJobRun')
+    def pageJobRun(self, job, shards=1):
+        """
+        Get the record of the current or last run of a bulk page job
+        with this many shards, or None. It's a mapping with keys: id,
+        started, setup (true once shard 0 has done the job's setup) and
+        finished (the number of shards which have finished). All shards
+        update this one object when they finish, so two finishing at
+        once get a conflict error and one of them retries.
+        """
+        checkpoints = getattr(aq_base(self.folder()),'_pagejobs',{})
+        return checkpoints.get('%s run/%d' % (job, shards))
+
+    security.declarePrivate('pageJobCheckpoint')
+    def pageJobCheckpoint(self, job, shard=0, shards=1):
+        """
+        Get the progress record of one shard of a bulk page job's
+        current or last run, or None. It's a mapping with keys: run
+        (the run id), cursor (the last page id done), count (pages
+        done), errors (pages which failed), seconds (time spent so far),
+        started, done (true when the shard finished).
+        """
+        checkpoints = getattr(aq_base(self.folder()),'_pagejobs',{})
+        return checkpoints.get('%s %d/%d' % (job, shard, shards))
+
+    security.declarePrivate('startPageJobRun')
+    def startPageJobRun(self, job, shards=1):
+        """
+        Start a new run of a bulk page job, with fresh checkpoints for
+        all of its shards.
+        """
+        checkpoints = self.pageJobCheckpoints()
+        run = checkpoints['%s run/%d' % (job, shards)] = PersistentMapping({
+            'id':'%.3f.%d' % (time(), os.getpid()), 'started':DateTime(),
+            'setup':0, 'finished':0})
+        for shard in range(shards):
+            checkpoints['%s %d/%d' % (job, shard, shards)] = PersistentMapping({
+                'run':run['id'], 'cursor':None, 'count':0, 'errors':0,
+                'seconds':0.0, 'started':DateTime(), 'done':0})
+        return run
+
+    security.declarePrivate('joinPageJobRun')
+    def joinPageJobRun(self, job, shard=0, shards=1, restart=0, setup=None):
+        """
+        Get the checkpoint for one shard's part of a bulk page job,
+        or None if there's nothing for it to do.
+
+        Shard 0 starts a new run if the last one finished, there was
+        none, or restart is true; otherwise it carries on with the
+        current one. It then calls setup(), once per run. With several
+        shards, this is committed so that the other shards, which wait
+        up to PAGE_JOB_SHARD_WAIT seconds for it, can start.
+        """
+        if shard == 0:
+            run = self.pageJobRun(job, shards)
+            if run is None or restart or run['finished'] >= shards:
+                run = self.startPageJobRun(job, shards)
+            if not run['setup']:
+                if setup: setup()
+                run['setup'] = 1
+                if shards > 1: get_transaction().commit()
+        else:
+            waited = 0
+            while 1:
+                run = self.pageJobRun(job, shards)
+                checkpoint = self.pageJobCheckpoint(job, shard, shards)
+                if run is not None and run['setup'] and checkpoint is not None \
+                   and checkpoint['run'] == run['id']:
+                    break
+                if waited >= PAGE_JOB_SHARD_WAIT:
+                    BLATHER('%s: gave up waiting for shard 0 to start' % job)
+                    return None
+                if not waited:
+                    BLATHER('%s: waiting for shard 0 to start' % job)
+                sleep(5)
+                waited += 5
+                get_transaction().abort() # see other processes' commits
+        checkpoint = self.pageJobCheckpoint(job, shard, shards)
+        if checkpoint['done']: return None
+        return checkpoint
+
+    security.declarePrivate('finishPageJobShard')
+    def finishPageJobShard(self, job, shard=0, shards=1, batch=0):
+        """
+        Mark one shard of a bulk page job's run as done. Returns true if
+        it was the last of the run's shards to finish.
+        """
+        def markDone():
+            self.pageJobCheckpoint(job, shard, shards)['done'] = 1
+            run = self.pageJobRun(job, shards)
+            run['finished'] += 1
+            return run['finished'] >= shards
+        if not (batch or shards > 1): return markDone()
+        # commit the shard's work first, so a conflict below loses nothing
+        get_transaction().commit()
+        for attempt in range(PAGE_JOB_CONFLICT_RETRIES):
+            finished = markDone()
             try:
-                p.upgrade(REQUEST)
-                p.upgradeId(REQUEST)
-                p.fixEncoding()
-                if render:
-                    p.preRender(clear_cache=1)
-                    msg = 'upgraded and pre-rendered page'
-                else:
-                    msg = 'upgraded page'
-                # make sure every page is cataloged - slow but thorough
-                p.index_object(log=0)
-                BLATHER('%s %d/%d %s'%(msg,n,total,p.id()))
-            except:
-                BLATHER('failed to upgrade page %d/%d %s: %s' \
-                     % (n,total,p.id(),formattedTraceback()))
-            if batch and n % batch == 0:
-                BLATHER('committing')
                 get_transaction().commit()
-        self.setupDtmlMethods()
-        endtime = clock()
-        BLATHER('upgrade complete, %d pages processed in %fs, %.1f pages/s' \
-                %(n, endtime-starttime, n/(endtime-starttime)))
+                return finished
+            except ConflictError:
+                get_transaction().abort()
+        BLATHER('%s: could not record the end of shard %d/%d after %d conflicts' \
+                % (job, shard, shards, PAGE_JOB_CONFLICT_RETRIES))
+        return 0
+
+    security.declarePrivate('pageJobFinished')
+    def pageJobFinished(self, job, shards=1):
+        """Have all shards of this bulk page job finished their last run ?"""
+        run = self.pageJobRun(job, shards)
+        return (run is not None and run['finished'] >= shards) and 1 or 0
+
+    security.declarePrivate('pageShard')
+    def pageShard(self, id, shards):
+        """Which of shards shards page id belongs to (stable across processes)."""
+        return (zlib.crc32(id) & 0xffffffff) % shards
+
+    security.declarePrivate('runPageJob')
+    def runPageJob(self, job, action, batch=0, shard=0, shards=1, restart=0,
+                   setup=None, finish=None):
+        """
+        Call action(page) for each page in this wiki, or in one shard
+        of it, in page id order, logging any failures. The optional
+        setup() is called before any shard starts on the pages, and
+        finish() by whichever shard finishes the run last (see
+        joinPageJobRun and finishPageJobShard).
+
+        With batch, commit every batch pages, recording progress in the
+        job's checkpoint (see pageJobCheckpoint) so that a later run of
+        the same job continues after the last committed page. If a
+        batch's commit conflicts with another transaction, we redo its
+        pages one at a time, trying each up to PAGE_JOB_CONFLICT_RETRIES
+        times. After each batch commit the batch's pages are turned back
+        into ghosts and the ZODB cache is trimmed, so memory use stays
+        flat however many pages there are. Logs progress and speed, and
+        returns the number of pages done.
+        """
+        checkpoint = self.joinPageJobRun(job, shard, shards, restart, setup)
+        if checkpoint is None:
+            BLATHER('%s: nothing to do for shard %d/%d' % (job, shard, shards))
+            return 0
+        ids = [id for id in self.pageIds() if self.pageShard(id,shards) == shard]
+        ids.sort()
+        if checkpoint['cursor'] is not None:
+            ids = [id for id in ids if id > checkpoint['cursor']]
+            BLATHER('%s: resuming after %s' % (job, checkpoint['cursor']))
+        if batch: get_transaction().commit()
+        folder, total, n = self.folder(), len(ids), 0
+        starttime = time()
+        loaded = []
+        def run(ids):
+            for id in ids:
+                p = folder._getOb(id, None)
+                if p is None: continue # deleted or renamed meanwhile
+                loaded.append(p)
+                try:
+                    action(p)
+                except ConflictError:
+                    raise
+                except:
+                    BLATHER('%s: failed on page %s: %s' \
+                            % (job, id, formattedTraceback()))
+                    checkpoint['errors'] += 1
+                checkpoint['cursor'] = id
+                checkpoint['count'] += 1
+        def release():
+            # only unmodified objects are ghosted, so do this after a commit
+            for p in loaded: aq_base(p)._p_deactivate()
+            del loaded[:]
+            jar = getattr(aq_base(folder),'_p_jar',None)
+            if jar is not None: jar.cacheGC()
+        for i in range(0, total, batch or max(total,1)):
+            chunk = ids[i:i+(batch or total)]
+            batchstart = time()
+            try:
+                run(chunk)
+                checkpoint['seconds'] += time() - batchstart
+                if batch: get_transaction().commit()
+            except ConflictError:
+                if not batch: raise
+                get_transaction().abort()
+                BLATHER('%s: conflict, retrying %d pages one at a time' \
+                        % (job, len(chunk)))
+                for id in chunk:
+                    for attempt in range(PAGE_JOB_CONFLICT_RETRIES):
+                        try:
+                            run([id])
+                            get_transaction().commit()
+                            break
+                        except ConflictError:
+                            get_transaction().abort()
+                    else:
+                        BLATHER('%s: gave up on page %s after %d conflicts' \
+                                % (job, id, PAGE_JOB_CONFLICT_RETRIES))
+                        checkpoint['errors'] += 1
+                        checkpoint['cursor'] = id
+                        get_transaction().commit()
+                checkpoint['seconds'] += time() - batchstart
+            if batch: release()
+            n += len(chunk)
+            elapsed = max(time() - starttime, 0.001)
+            BLATHER('%s: %d/%d pages (shard %d/%d), %.1f pages/s' \
+                    % (job, n, total, shard, shards, n/elapsed))
+        if self.finishPageJobShard(job, shard, shards, batch) and finish:
+            finish()
+            if batch: get_transaction().commit()
+        elapsed = max(time() - starttime, 0.001)
+        BLATHER('%s: %d pages done in %.1fs, %.1f pages/s, %d errors' \
+                % (job, n, elapsed, n/elapsed, checkpoint['errors']))
+        if n < checkpoint['count']:
+            BLATHER('%s: %d pages done in all runs in %.1fs, %.1f pages/s' \
+                    % (job, checkpoint['count'], checkpoint['seconds'],
+                       checkpoint['count']/max(checkpoint['seconds'],0.001)))
+        return n
 
     # allow extra actions to be added to this method
     # upgradeId hooks return a page name that should be used
@@ -410,17 +645,20 @@ class PageAdminSupport:
             REQUEST.RESPONSE.redirect(self.pageUrl())
 
     security.declareProtected('Manage properties', 'setupCatalog')
-    def setupCatalog(self,REQUEST=None,reindex=1):
+    def setupCatalog(self,REQUEST=None,reindex=1,batch=0,idxs=None):
         """
         Create and/or configure a catalog for this wiki.
 
         Safe to call more than once; will ignore any already existing
         items. For simplicity we install all metadata for plugins (like
-        Tracker) here as well.
+        Tracker) here as well. Then reindexes all pages, unless reindex
+        is false; batch and idxs are passed to reindexCatalog.
         """
         if self.inRevisionsFolder(): return
         if not self.hasCatalog():
             self.folder().manage_addProduct['ZCatalog'].manage_addZCatalog('Catalog','')
+        elif not reindex:
+            self.ensureWikiPathIndex()
         catalog = self.catalog()
         catalogindexes, catalogmetadata = catalog.indexes(), catalog.schema()
         PluginIndexes = catalog.manage_addProduct['PluginIndexes']
@@ -466,16 +704,57 @@ class PageAdminSupport:
             if not m in catalogmetadata: catalog.manage_addColumn(m)
         if reindex:
             # now index each page, to make all indexes and metadata current
-            n = 0
-            cid = self.catalog().getId()
-            for p in self.pageObjects():
-                n = n + 1
-                BLATHER('indexing page %d %s in %s'%(n,p.id(),cid))
-                p.index_object(log=0)
-            BLATHER('indexing complete, %d pages processed' % n)
+            self.reindexCatalog(batch=batch,idxs=idxs)
         if REQUEST:
             REQUEST.RESPONSE.redirect(self.pageUrl())
-            
+
+    security.declareProtected('Manage properties', 'reindexCatalog')
+    def reindexCatalog(self,batch=0,idxs=None,shard=0,shards=1,restart=0,
+                       REQUEST=None):
+        """
+        Reindex all pages in this wiki's catalog.
+
+        This can take a long time in a large wiki, since it renders
+        and tokenizes every page. With batch, we commit every batch
+        pages, recording our progress; running it again after an
+        interruption carries on from the last committed page, unless
+        restart is set. Memory use stays flat. shard and shards split
+        the work between zope processes, as for upgradeAll.
+
+        idxs, a list or comma-separated string of index names, updates
+        just those indexes and not the metadata, eg after adding an
+        index. Unknown index names are ignored.
+
+        Returns a summary of the run, with its speed.
+        """
+        catalog = self.catalog()
+        if catalog is None: return
+        batch, shard, shards = int(batch), int(shard), int(shards or 1)
+        if isinstance(idxs, StringTypes): idxs = map(strip, split(idxs, ','))
+        job = 'reindexCatalog'
+        if idxs:
+            catalogindexes = catalog.indexes()
+            for i in [i for i in idxs if i not in catalogindexes]:
+                BLATHER('reindexCatalog: ignoring unknown index',i)
+            idxs = [i for i in idxs if i in catalogindexes]
+            if not idxs: return
+            job = '%s %s' % (job, join(idxs, ','))
+        BLATHER('indexing pages in %s%s' % (
+            catalog.getId(), idxs and ' (%s)' % join(idxs,', ') or ''))
+        def reindexPage(p):
+            if idxs: p.index_object(idxs=idxs,update_metadata=0,log=0)
+            else: p.index_object(log=0)
+        n = self.runPageJob(job, reindexPage, batch=batch, shard=shard,
+                            shards=shards, restart=restart)
+        checkpoint = self.pageJobCheckpoint(job, shard, shards)
+        summary = 'indexing complete, %d pages processed' % n
+        if checkpoint and checkpoint['seconds']:
+            summary += ' (%d in all runs, %.1f pages/s, %d errors)' % (
+                checkpoint['count'], checkpoint['count']/checkpoint['seconds'],
+                checkpoint['errors'])
+        BLATHER(summary)
+        return summary
+
     def ensureCatalog(self):
         """
         Ensure this wiki has a zcatalog, for fast standardized searching.
@@ -487,6 +766,20 @@ class PageAdminSupport:
             BLATHER('creating catalog for wiki',self.folder().getId())
             self.setupCatalog()
 
+    def ensureWikiPathIndex(self):
+        """
+        Make sure this wiki's catalog has the wikiPath index used by
+        pages(), adding it to catalogs created before it existed and
+        indexing the wiki's pages in it. Until then, pages() uses a
+        slower path search.
+        """
+        if self.inRevisionsFolder() or not self.hasCatalog(): return
+        catalog = self.catalog()
+        if 'wikiPath' in catalog.indexes(): return
+        BLATHER('adding wikiPath index to catalog',catalog.getId())
+        catalog.manage_addProduct['PluginIndexes'].manage_addFieldIndex('wikiPath')
+        for p in self.pageObjects(): p.index_object(idxs=['wikiPath'],log=0)
+
     def fixAllPagesEncoding(self, REQUEST=None):
         """Fix character encoding throughout the wiki. Needed eg when
         upgrading a pre-unicode zwiki."""
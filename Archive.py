@@ -85,8 +85,11 @@ class ArchiveSupport:
         # move pages and revisions
         af.manage_pasteObjects(f.manage_cutObjects(ids2), REQUEST)
         if rids:
+            for rid in rids: self.updateRevisionIndex(removed=rid)
             af[id].ensureRevisionsFolder()
-            af[id].revisionsFolder().manage_pasteObjects(rf.manage_cutObjects(rids), REQUEST)
+            arf = af[id].revisionsFolder()
+            arf.manage_pasteObjects(rf.manage_cutObjects(rids), REQUEST)
+            for rid in rids: af[id].updateRevisionIndex(added=arf[rid])
 
         self.__class__.manage_afterAdd = saved_manage_afterAdd
 
@@ -2,9 +2,12 @@
 # originally based on Casey Duncan's DTMLDocumentExt 0.1
 
 from AccessControl import getSecurityManager, ClassSecurityInfo
+from Acquisition import aq_base
 from Globals import InitializeClass
+from Missing import MV
 
 import Permissions
+from Defaults import INDEXED_ATTRIBUTES
 from Utils import BLATHER,formattedTraceback,safe_hasattr
 
 
@@ -97,9 +100,11 @@ class PageCatalogSupport:
     getPath = url
 
     security.declareProtected(Permissions.View, 'index_object')
-    def index_object(self,idxs=[],log=1):
+    def index_object(self,idxs=[],log=1,update_metadata=1):
         """Index this page in the wiki's catalog, if any, and log
-        problems.  Updates only certain indexes, if specified.
+        problems.  Updates only certain indexes, if specified, and
+        the metadata unless update_metadata is false (a page not yet
+        in the catalog always gets metadata).
         """
         if self.hasCatalog() and self.isCatalogable():
             if log: BLATHER('indexing',self.url())
@@ -109,10 +114,82 @@ class PageCatalogSupport:
                 # can't handle, we now index SearchableText instead but
                 # the old text index may still be present, we could
                 # specify idxs so as to no longer update it
-                self.catalog().catalog_object(self,self.url(),idxs)
+                self.catalog().catalog_object(self,self.url(),idxs,
+                                              update_metadata=update_metadata)
             except:
                 BLATHER('failed to index',self.id(),'\n',formattedTraceback())
 
+    def catalogState(self):
+        """
+        Note this page's attributes, so that changedAttributes can tell
+        which ones an operation changed. Cheap, this keeps references
+        (or copies of lists) rather than computing anything.
+        """
+        state = {}
+        for k, v in aq_base(self).__dict__.items():
+            if k.startswith('_v_'): continue
+            if isinstance(v, list): v = v[:]
+            state[k] = v
+        return state
+
+    def changedAttributes(self, state):
+        """List the attributes which have changed since catalogState."""
+        current = self.catalogState()
+        changed = [k for k in current.keys()
+                   if not state.has_key(k) or state[k] != current[k]]
+        return changed + [k for k in state.keys() if not current.has_key(k)]
+
+    def reindexChanged(self, attrs, log=1):
+        """
+        Update this page's catalog entry after a change to the named
+        attributes, updating only the indexes and metadata which
+        depend on them (see INDEXED_ATTRIBUTES). This saves eg
+        re-tokenizing the text when only the parents have changed.
+        Does a full index_object if an unlisted attribute changed, or
+        the page is not yet cataloged.
+        """
+        if not (self.hasCatalog() and self.isCatalogable()): return
+        if self.catalog().getrid(self.url()) is None:
+            self.index_object(log=log)
+            return
+        indexes, metadata = [], []
+        for a in attrs:
+            if not INDEXED_ATTRIBUTES.has_key(a):
+                self.index_object(log=log)
+                return
+            i, m = INDEXED_ATTRIBUTES[a]
+            indexes.extend(i)
+            metadata.extend(m)
+        catalogindexes = self.catalog().indexes()
+        idxs = []
+        for i in indexes:
+            if i in catalogindexes and not i in idxs: idxs.append(i)
+        if metadata:
+            try:
+                self.updateMetadata(metadata)
+            except:
+                BLATHER('failed to update metadata for',self.id(),'\n',
+                        formattedTraceback())
+        if idxs: self.index_object(idxs=idxs,log=log,update_metadata=0)
+
+    def updateMetadata(self, names):
+        """
+        Update just the named metadata columns in this page's catalog
+        record. Returns false if the page has no record yet.
+        """
+        catalog = self.catalog()._catalog
+        rid = catalog.uids.get(self.url())
+        if rid is None: return 0
+        record = list(catalog.data[rid])
+        for name in names:
+            if not catalog.schema.has_key(name): continue
+            # like Catalog.recordify
+            value = getattr(self, name, MV)
+            if value is not MV and callable(value): value = value()
+            record[catalog.schema[name]] = value
+        catalog.data[rid] = tuple(record)
+        return 1
+
     def unindex_object(self):
         """Remove this page from the wiki's catalog, if any."""
         if self.hasCatalog():
@@ -1,17 +1,23 @@
 # PageCommentsSupport mixin
 
 import sys, os, string, re, email, email.Errors
+from email.Parser import HeaderParser
 from mailbox import UnixMailbox
 from urllib import quote
 from cStringIO import StringIO
 
+from BTrees.IOBTree import IOBTree
+
 from AccessControl import getSecurityManager, ClassSecurityInfo
+from Acquisition import aq_base
 from App.Common import absattr
 from DateTime import DateTime
 from Globals import InitializeClass
 
 import Permissions
+from Defaults import DISCUSSION_PAGE_SIZE
 from Regexps import fromlineexpr
+from i18n import _
 from Utils import BLATHER, html_quote, DateTimeSyntaxError, \
   stringBefore, stringBeforeAndIncluding, stringAfter, \
   stringAfterAndIncluding, safe_hasattr
@@ -54,14 +60,14 @@ class PageCommentsSupport:
         """
         The number of comments in this page.
         """
-        return len(re.findall(fromlineexpr,self.discussionPart()))
+        return self.commentIndex().count()
 
     security.declareProtected(Permissions.View, 'documentPart')
     def documentPart(self):
         """
         This page's text from beginning up to the first message, if any.
         """
-        return re.split(fromlineexpr,self.text(),1)[0]
+        return self.commentIndex().documentPart()
 
     document = documentPart
 
@@ -70,7 +76,68 @@ class PageCommentsSupport:
         """
         This page's text from the first comment to the end (or '').
         """
-        return stringAfterAndIncluding(fromlineexpr,self.text())
+        return self.commentIndex().discussionPart()
+
+    def commentIndex(self):
+        """
+        Get this page's comment index (see CommentIndex).
+
+        This is kept in a volatile attribute, so it lasts while the page
+        object stays in the zodb cache, and is checked against the
+        page's stored text so that any change to that rebuilds it.
+        Adding a comment updates it incrementally (updateCommentIndex).
+        """
+        source = self.storedText()
+        index = getattr(self,'_v_commentindex',None)
+        if index is None or index.source is not source:
+            index = self._v_commentindex = CommentIndex(
+                source, self.text(), self.toencoded(self.text()))
+        return index
+
+    def updateCommentIndex(self, oldsource, t):
+        """
+        Record some text t appended to the page's stored text oldsource
+        in the comment index, if it's up to date; otherwise leave it to
+        be rebuilt.
+        """
+        index = getattr(self,'_v_commentindex',None)
+        if index is None: return
+        if index.source is oldsource and not self.isCompactRevision():
+            t = re.sub('<!--antidecapitationkludge-->\n\n?','',t) # as in read()
+            index.append(self.storedText(), t, self.toencoded(t))
+        else:
+            del self._v_commentindex
+
+    security.declareProtected(Permissions.View, 'commentNumber')
+    def commentNumber(self, n):
+        """
+        Return this page's nth comment (counting from 0; negative numbers
+        count from the end) as an email Message, or None.
+        """
+        index = self.commentIndex()
+        if n < 0: n = n + len(index)
+        if n < 0 or n >= len(index): return None
+        return index.message(n)
+
+    security.declareProtected(Permissions.View, 'commentWithId')
+    def commentWithId(self, message_id):
+        """
+        Return the comment with this message-id as an email Message, or None.
+        """
+        index = self.commentIndex()
+        n = index.numberOf(message_id)
+        if n is None: return None
+        return index.message(n)
+
+    security.declareProtected(Permissions.View, 'commentHeaders')
+    def commentHeaders(self):
+        """
+        The main headers of each comment, for threading and listing
+        without parsing the comment bodies: a list of dictionaries with
+        from, date, subject, message-id and in-reply-to keys.
+        """
+        index = self.commentIndex()
+        return [index.headers(n) for n in range(len(index))]
 
     security.declareProtected(Permissions.View, 'mailbox')
     def mailbox(self):
@@ -92,17 +159,137 @@ class PageCommentsSupport:
         """
         Return this page's comments as a list of email Messages.
 
+        These are the same messages mailbox() gives, parsed once and
+        kept in the comment index, so don't modify them.
+
         Warning, the email lib's Messages contain encoded text and you
         must remember to convert their data to unicode when
         appropriate.
         """
-        msgs = []
-        mbox = self.mailbox()
-        m = mbox.next()
-        while m is not None:
-            msgs.append(m)
-            m = mbox.next()
-        return msgs
+        index = self.commentIndex()
+        return [index.message(n) for n in range(len(index))]
+
+    # discussion pagination
+
+    # Long discussions can be shown a chunk of discussion_page_size
+    # comments at a time. Then the page's prerendered text includes only
+    # the latest chunk, the earlier chunks are prerendered separately
+    # (in _discussionchunks, by number) and the olderComments view shows
+    # them, one at a time. DTML in these older comments is not evaluated.
+
+    def discussionPageSize(self):
+        """
+        How many comments to show at a time, or 0 to show them all.
+
+        Saved revisions are paginated like the page they were copied
+        from, since they keep its prerendered chunks; except compact
+        revisions, which keep no prerendered data and are rendered in
+        full (in memory) when viewed.
+        """
+        if self.inRevisionsFolder() and self.isCompactRevision(): return 0
+        try: return max(int(getattr(self,'discussion_page_size',
+                                    DISCUSSION_PAGE_SIZE) or 0), 0)
+        except (TypeError, ValueError): return 0
+
+    security.declareProtected(Permissions.View, 'discussionChunkCount')
+    def discussionChunkCount(self):
+        """
+        The number of chunks this page's comments are shown in (the last
+        one, shown on the page, may not be full).
+        """
+        size, count = self.discussionPageSize(), len(self.commentIndex())
+        if not (size and count): return count and 1
+        return (count + size - 1) / size
+
+    def isPaginatedDiscussion(self):
+        """Is only the latest chunk of this page's comments shown ?"""
+        return self.discussionPageSize() and self.discussionChunkCount() > 1
+
+    def startsDiscussionChunk(self):
+        """Does this page's last comment begin a new (not the first) chunk ?"""
+        size, count = self.discussionPageSize(), len(self.commentIndex())
+        return size and count > size and (count-1) % size == 0
+
+    security.declareProtected(Permissions.View, 'latestComments')
+    def latestComments(self):
+        """
+        The comments which are shown on the page itself, ie all of them,
+        or those in the last chunk when the discussion is paginated.
+        """
+        index = self.commentIndex()
+        start = 0
+        if self.isPaginatedDiscussion():
+            start = (self.discussionChunkCount()-1) * self.discussionPageSize()
+        return [index.message(n) for n in range(start, len(index))]
+
+    def preRenderDiscussionChunks(self, start=0):
+        """
+        Prerender the comment chunks before the latest one (from chunk
+        start, and any earlier ones which are missing), or discard them
+        if the discussion is not paginated.
+        """
+        chunks = getattr(aq_base(self),'_discussionchunks',None)
+        if not self.isPaginatedDiscussion():
+            if chunks is not None: del self._discussionchunks
+            return
+        if chunks is None: chunks = self._discussionchunks = IOBTree()
+        size = self.discussionPageSize()
+        last = self.discussionChunkCount() - 1
+        index, pagetype = self.commentIndex(), self.pageType()
+        for c in range(min(start, len(chunks)), last):
+            t = ''
+            for n in range(c*size, (c+1)*size):
+                t += pagetype.preRenderMessage(self, index.message(n))
+            chunks[c] = pagetype.preRender(self, t)
+        for c in list(chunks.keys(last)): del chunks[c]
+
+    def discussionChunks(self):
+        """The prerendered older comment chunks, in order."""
+        chunks = getattr(aq_base(self),'_discussionchunks',None)
+        if chunks is None: return []
+        return list(chunks.values())
+
+    security.declareProtected(Permissions.View, 'discussionChunk')
+    def discussionChunk(self, chunk):
+        """
+        Render one of the older comment chunks as a HTML fragment, or
+        return '' if there is no such chunk.
+        """
+        chunks = getattr(aq_base(self),'_discussionchunks',None)
+        if chunks is None: return ''
+        try: chunk = int(chunk)
+        except (TypeError, ValueError): return ''
+        t = chunks.get(chunk)
+        if t is None: return ''
+        return self.renderMarkedLinksIn(t)
+
+    def olderCommentsLink(self, chunk=None):
+        """
+        A link to the olderComments view for chunk (by default, the one
+        before the latest), or '' if there is none.
+        """
+        if not self.isPaginatedDiscussion(): return ''
+        if chunk is None: chunk = self.discussionChunkCount() - 2
+        if chunk < 0: return ''
+        return '<a class="visualNoPrint" href="%s/olderComments?chunk=%d">%s</a>' \
+               % (self.pageUrl(), chunk, _("older comments"))
+
+    security.declareProtected(Permissions.View, 'olderComments')
+    def olderComments(self, chunk=None, REQUEST=None):
+        """
+        Show one chunk of this page's older comments, with links to the
+        chunks before and after it.
+        """
+        last = self.discussionChunkCount() - 1
+        try: chunk = int(chunk)
+        except (TypeError, ValueError): chunk = last - 1
+        chunk = max(min(chunk, last - 1), 0)
+        if chunk + 1 < last: newer = self.olderCommentsLink(chunk+1)
+        else: newer = '<a href="%s#comments">%s</a>' % (
+            self.pageUrl(), _("latest comments"))
+        nav = '\n<p>%s %s</p>\n' % (self.olderCommentsLink(chunk-1), newer)
+        body = nav + self.discussionChunk(chunk) + nav
+        return self.addSkinTo(body, show_subtopics=0)
 
 
     # utilities
@@ -148,3 +335,124 @@ class PageCommentsSupport:
 
 InitializeClass(PageCommentsSupport)
 
+
+class CommentIndex:
+    """
+    Where the comments are in a page's text.
+
+    This records the start of the discussion part and the number of
+    comments (by fromlineexpr, in the page's text) and the extent of
+    each message (by the mailbox module's From line test, in the
+    encoded text), so that counting comments or getting the nth one
+    does not mean reparsing the whole page. Messages and their headers
+    are parsed when first asked for, and kept. append() indexes new
+    text added to the end of the page, rescanning only the last line or
+    message before it.
+    """
+    HEADERS = ('from', 'date', 'subject', 'message-id', 'in-reply-to')
+
+    def __init__(self, source, text, encoded):
+        self.source = source    # the stored text we were built from
+        self.text = text
+        self.encoded = encoded
+        self.fromstarts = []    # offsets in text of fromlineexpr matches
+        self.starts = []        # offsets in encoded of each message
+        self.messages = {}      # message number -> Message, when parsed
+        self._headers = {}      # message number -> header dict, when parsed
+        self._ids = None        # message-id -> message number, when needed
+        self.scan(0, 0)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def scan(self, textpos, encpos):
+        for m in re.compile(fromlineexpr).finditer(self.text, textpos):
+            self.fromstarts.append(m.start())
+        isfromline = re.compile(UnixMailbox._fromlinepattern).match
+        for m in re.compile(r'(?m)^From .*\n?').finditer(self.encoded, encpos):
+            if isfromline(m.group()): self.starts.append(m.start())
+
+    def append(self, source, t, encoded):
+        """Index text t (and its encoded form) added to the end."""
+        if self.fromstarts: textpos = self.fromstarts[-1]
+        else: textpos = lastLineStart(self.text, 2)
+        encpos = lastLineStart(self.encoded)
+        self.fromstarts = [i for i in self.fromstarts if i < textpos]
+        self.starts = [i for i in self.starts if i < encpos]
+        # the last message may get longer
+        last = len(self.starts) - 1
+        for n in self.messages.keys():
+            if n >= last: del self.messages[n]
+        for n in self._headers.keys():
+            if n >= last: del self._headers[n]
+        self._ids = None
+        self.source = source
+        self.text = self.text + t
+        self.encoded = self.encoded + encoded
+        self.scan(textpos, encpos)
+
+    def count(self):
+        return len(self.fromstarts)
+
+    def documentPart(self):
+        if self.fromstarts: return self.text[:self.fromstarts[0]]
+        return self.text
+
+    def discussionPart(self):
+        if self.fromstarts: return self.text[self.fromstarts[0]:]
+        return ''
+
+    def messageText(self, n):
+        """The encoded text of message n, including its From line."""
+        if n+1 < len(self.starts): end = self.starts[n+1]
+        else: end = len(self.encoded)
+        return self.encoded[self.starts[n]:end]
+
+    def message(self, n):
+        """
+        Message n as an email Message, or '' if it can't be parsed (like
+        PageCommentsSupport.mailbox).
+        """
+        m = self.messages.get(n)
+        if m is None:
+            try:
+                m = email.message_from_string(self.messageText(n))
+            except email.Errors.MessageParseError:
+                BLATHER('message parsing error in comment',n)
+                m = ''
+            self.messages[n] = m
+        return m
+
+    def headers(self, n):
+        """Some headers of message n, parsing only its header block."""
+        h = self._headers.get(n)
+        if h is None:
+            m = self.messages.get(n)
+            if m is None:
+                t = self.messageText(n)
+                i = t.find('\n\n')
+                if i != -1: t = t[:i+1]
+                try: m = HeaderParser().parsestr(t)
+                except email.Errors.MessageParseError: m = {}
+            h = {}
+            for k in self.HEADERS: h[k] = (m and m.get(k)) or ''
+            self._headers[n] = h
+        return h
+
+    def numberOf(self, message_id):
+        """The number of the message with this message-id, or None."""
+        if self._ids is None:
+            self._ids = {}
+            for n in range(len(self)):
+                i = self.headers(n)['message-id']
+                if i and not self._ids.has_key(i): self._ids[i] = n
+        return self._ids.get(message_id)
+
+def lastLineStart(t, lines=1):
+    """The offset of the start of the last lines lines of t."""
+    i = len(t)
+    for l in range(lines):
+        i = t.rfind('\n', 0, max(i-1,0)) + 1
+        if not i: break
+    return i
+
@@ -12,6 +12,8 @@ DISABLE_JAVASCRIPT = 1       # disable javascript, etc. in edits ?
 PREFER_USERNAME_COOKIE = 0   # prefer cookie to authenticated name ?
 MAX_NEW_LINES_DISPLAY = 200  # truncate each diff (and mailout)
 MAX_OLD_LINES_DISPLAY = 20   # at this number of lines
+DIFF_MAX_COST = 500          # give up diffing a region with more changed lines
+DIFF_TIMEOUT = 5             # s; and report what's left as changed after this
 LINK_TO_ALL_CATALOGED = 0    # link to all pages in the catalog ? unimplemented
 LINK_TO_ALL_OBJECTS = 0      # link to non-wiki page objects ? unimplemented
 LARGE_FILE_SIZE = 1024*1024  # images larger than this will not be inlined
@@ -27,6 +29,28 @@ CONDITIONAL_HTTP_GET = 0     # handle If-modified-since headers with 304 respons
 CONDITIONAL_HTTP_GET_IGNORE = [ 'allow_dtml' ] 
                              # ignore pages with these properties set to 
                              # non-False values
+RENDER_CACHE = 0             # cache non-DTML page views for anonymous users ?
+RENDER_CACHE_SIZE = 1000     # maximum number of pages in the render cache
+RENDER_CACHE_TIMEOUT = 600   # s; cached views show some time-dependent info
+RENDER_CACHE_VARIANTS = 20   # maximum cached views (skins, languages..) per page
+STX_BLOCK_CACHE_SIZE = 5000  # formatted structured text paragraphs kept in memory
+RENDER_POOL_SIZE = 0         # processes for formatting rst & stx outside zope (0: none)
+RENDER_POOL_TIMEOUT = 60     # s; kill a worker which takes longer than this
+RENDER_POOL_MIN_SIZE = 10000 # bytes; smaller texts are quicker to format in zope
+RENDER_POOL_MAX_SIZE = 5000000 # bytes; larger texts are formatted in zope
+RENDER_POOL_MAX_REQUESTS = 500 # replace a worker after this many requests
+DTML_CACHE_SIZE = 500        # parsed DTML page texts kept in memory, shared by all threads
+DISCUSSION_PAGE_SIZE = 0     # show long discussions this many comments at a time (0: all)
+COMPACT_REVISIONS = 0        # save revisions as line deltas without prerendered data ?
+REVISION_SNAPSHOT_INTERVAL = 10 # with compact revisions, a full copy every N
+PAGE_JOB_CONFLICT_RETRIES = 3 # upgradeAll etc. retry a page this many times after conflicts
+PAGE_JOB_SHARD_WAIT = 600     # s; how long a sharded upgradeAll etc. waits for shard 0 to start
+MAIL_QUEUE = 1               # send mail-outs from a background queue (plain Mail Hosts only) ?
+MAIL_QUEUE_DIR = ''          # where to spool them; default: var/zwikimailqueue
+MAIL_QUEUE_BATCH = 100       # messages sent per SMTP connection
+MAIL_QUEUE_INTERVAL = 30     # s; how often the worker checks the queue
+MAIL_QUEUE_RETRY_DELAY = 60  # s; first retry delay after a failure, then doubled
+MAIL_QUEUE_MAX_ATTEMPTS = 10 # give up on a message after this many failures
 
 # Standard metadata fields which we add to the wiki (or plone) catalog
 # and expect in page brain objects.  Plugins can add more of these.
@@ -93,6 +117,7 @@ FIELDINDEXES = [
     'page_type',
     'rating',
     'voteCount',
+    'wikiPath',
     ]
 KEYWORDINDEXES = [
     'canonicalLinks',
@@ -107,5 +132,28 @@ PATHINDEXES = [
     'path',
     ]
 
+# the catalog indexes and metadata computed from each page attribute, so
+# that we can reindex just those after a change (see reindexChanged).
+# Changes to attributes not listed here get a full reindex.
+INDEXED_ATTRIBUTES = {
+    # attribute:        (indexes, metadata)
+    'raw':              (['SearchableText','canonicalLinks'], ['size','summary']),
+    '_prerendered':     (['canonicalLinks'], []),
+    '_discussionchunks':(['canonicalLinks'], []),
+    'page_type':        (['page_type','canonicalLinks'], ['page_type']),
+    'parents':          (['parents'], ['parents']),
+    'last_edit_time':   (['last_edit_time','lastEditTime'],
+                         ['last_edit_time','lastEditTime']),
+    'last_editor':      (['last_editor'], ['lastEditor']),
+    'last_log':         ([], ['last_log']),
+    'subscriber_list':  ([], ['subscriber_list']),
+    '_votes':           (['rating','voteCount'], ['rating','voteCount']),
+    'last_editor_ip':   ([], []),
+    'revision_number':  ([], []),
+    'show_subtopics':   ([], []),
+    }
+
 ZWIKI_SPAMPATTERNS_URL = 'http://zwiki.org/spampatterns.txt'
 ZWIKI_SPAMPATTERNS_TIMEOUT = 1 # s
+ZWIKI_SPAMPATTERNS_TTL = 3600 # s; how often to refresh it, in the background
+ZWIKI_SPAMPATTERNS_FILE = ''  # the last copy; default: var/zwikispampatterns.txt
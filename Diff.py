@@ -5,7 +5,10 @@ A diff-browsing view and utilities for use with History.
 from __future__ import nested_scopes
 from string import join, split, atoi
 import re
+from types import TupleType
 from struct import pack, unpack
+from bisect import bisect_left
+from time import time
 import difflib
 
 from DocumentTemplate.DT_Util import html_quote
@@ -13,7 +16,8 @@ from OFS.History import historicalRevision
 from AccessControl import getSecurityManager, ClassSecurityInfo
 from Globals import InitializeClass
 
-from Defaults import MAX_OLD_LINES_DISPLAY, MAX_NEW_LINES_DISPLAY
+from Defaults import MAX_OLD_LINES_DISPLAY, MAX_NEW_LINES_DISPLAY, \
+     DIFF_MAX_COST, DIFF_TIMEOUT
 import Permissions
 from Utils import get_transaction, BLATHER, formattedTraceback
 
@@ -87,12 +91,228 @@ def addedtext(a,b):
     return '\n' + join(r,'\n')
 
 def diffcodes(a,b):
-    """Return a diff between two texts, as difflib opcodes."""
+    """Return a diff between two lists of lines, as an iterator of
+    difflib-style opcodes. See diffopcodes."""
+    return diffopcodes(a,b)
+
+def difflibcodes(a,b):
+    """Return a diff between two lists of lines, as difflib opcodes,
+    using difflib itself (which can be very slow on large texts)."""
     return difflib.SequenceMatcher(
         isjunk=re.compile(r"\s*$").match,
         a=a,
         b=b).get_opcodes()
 
+# Our own diff engine. difflib's SequenceMatcher can take minutes on
+# large texts with many repeated lines, so we do a patience diff
+# instead: lines are replaced by integer ids, leading and trailing
+# lines in common are matched, and lines which occur exactly once on
+# each side are used as anchors to split the texts into smaller
+# regions. Regions with no such anchors are diffed with Myers' O(ND)
+# algorithm, after dropping the lines which don't occur on the other
+# side at all. Myers' cost (the number of differing lines D, which also
+# bounds its memory use) and the total time are capped; a region we
+# give up on is simply reported as changed.
+
+isblank = re.compile(r"\s*$").match
+
+def diffopcodes(a, b, maxcost=DIFF_MAX_COST, timeout=DIFF_TIMEOUT):
+    """
+    Generate difflib-style opcodes for the differences between two lists
+    of lines.
+
+    Yields (tag, alo, ahi, blo, bhi) tuples like those returned by
+    difflib.SequenceMatcher.get_opcodes(). maxcost and timeout (in
+    seconds) limit the work done, as described above.
+    """
+    i = j = 0
+    for ai, bj, n in matchingblocks(a, b, maxcost, timeout):
+        if i < ai and j < bj: yield ('replace', i, ai, j, bj)
+        elif i < ai:          yield ('delete', i, ai, j, bj)
+        elif j < bj:          yield ('insert', i, ai, j, bj)
+        if n: yield ('equal', ai, ai+n, bj, bj+n)
+        i, j = ai+n, bj+n
+
+def matchingblocks(a, b, maxcost=DIFF_MAX_COST, timeout=DIFF_TIMEOUT):
+    """
+    Generate the blocks of lines common to a and b, as (i, j, n) tuples
+    in order and not adjacent, ending with (len(a), len(b), 0).
+    """
+    ids = {}
+    a = [ids.setdefault(l, len(ids)) for l in a]
+    b = [ids.setdefault(l, len(ids)) for l in b]
+    # like difflib, don't anchor on blank lines
+    blanks = {}
+    for l, id in ids.items():
+        if isblank(l): blanks[id] = 1
+    deadline = time() + timeout
+    pi = pj = pn = 0
+    for i, j, n in _matches(a, b, blanks, maxcost, deadline):
+        if pi + pn == i and pj + pn == j:
+            pn += n
+        else:
+            if pn: yield (pi, pj, pn)
+            pi, pj, pn = i, j, n
+    if pn: yield (pi, pj, pn)
+    yield (len(a), len(b), 0)
+
+def _matches(a, b, blanks, maxcost, deadline):
+    """
+    Generate matching (i, j, n) blocks of two lists of line ids, in
+    order, possibly adjacent.
+    """
+    # a stack of things to do, in reverse order: regions (alo, ahi,
+    # blo, bhi) to be diffed and matches (i, j, n) to be output
+    todo = [(0, len(a), 0, len(b))]
+    while todo:
+        t = todo.pop()
+        if len(t) == 3:
+            yield t
+            continue
+        alo, ahi, blo, bhi = t
+        # match the common head and tail
+        i, j = alo, blo
+        while i < ahi and j < bhi and a[i] == b[j]: i, j = i+1, j+1
+        i2, j2 = ahi, bhi
+        while i2 > i and j2 > j and a[i2-1] == b[j2-1]: i2, j2 = i2-1, j2-1
+        found = []
+        if i > alo: found.append((alo, blo, i-alo))
+        if i < i2 and j < j2:
+            anchors = _anchors(a, b, blanks, i, i2, j, j2)
+            if anchors:
+                for ai, bj in anchors:
+                    if i < ai and j < bj: found.append((i, ai, j, bj))
+                    found.append((ai, bj, 1))
+                    i, j = ai+1, bj+1
+                if i < i2 and j < j2: found.append((i, i2, j, j2))
+            elif time() < deadline:
+                found.extend(_myers(a, b, i, i2, j, j2, maxcost, deadline))
+        if i2 < ahi: found.append((i2, j2, ahi-i2))
+        found.reverse()
+        todo.extend(found)
+
+def _anchors(a, b, blanks, alo, ahi, blo, bhi):
+    """
+    Find the longest increasing sequence of lines occurring exactly once
+    in each region, as a list of (i, j) positions.
+    """
+    counts = {}
+    for i in xrange(alo, ahi):
+        c = counts.get(a[i])
+        if c is None: counts[a[i]] = [1, 0, i, 0]
+        else: c[0] += 1
+    for j in xrange(blo, bhi):
+        c = counts.get(b[j])
+        if c is not None:
+            c[1] += 1
+            c[3] = j
+    pairs = [(c[2], c[3]) for id, c in counts.items()
+             if c[0] == 1 and c[1] == 1 and not blanks.has_key(id)]
+    if not pairs: return []
+    pairs.sort()
+    # patience sorting, on the b positions
+    tails, tailpairs, back = [], [], {}
+    for p in pairs:
+        k = bisect_left(tails, p[1])
+        if k: back[p] = tailpairs[k-1]
+        if k == len(tails):
+            tails.append(p[1])
+            tailpairs.append(p)
+        else:
+            tails[k] = p[1]
+            tailpairs[k] = p
+    lis, p = [], tailpairs[-1]
+    while p is not None:
+        lis.append(p)
+        p = back.get(p)
+    lis.reverse()
+    return lis
+
+def _myers(a, b, alo, ahi, blo, bhi, maxcost, deadline):
+    """
+    Find matching lines in two regions with Myers' diff algorithm,
+    returning (i, j, 1) tuples in order, or none if the cost or time
+    limits are exceeded.
+    """
+    # ignore lines which can't match anything
+    inb, ina = {}, {}
+    for j in xrange(blo, bhi): inb[b[j]] = 1
+    for i in xrange(alo, ahi): ina[a[i]] = 1
+    ai = [i for i in xrange(alo, ahi) if inb.has_key(a[i])]
+    bj = [j for j in xrange(blo, bhi) if ina.has_key(b[j])]
+    x = [a[i] for i in ai]
+    y = [b[j] for j in bj]
+    n, m = len(x), len(y)
+    if not n or not m: return []
+    # trace[d][k+d] is the furthest x reached on diagonal k with cost d
+    trace, v, end = [], [0, 0], None
+    for d in xrange(min(n+m, maxcost)+1):
+        if d % 16 == 0 and time() > deadline: return []
+        vd = [0] * (2*d+1)
+        for k in xrange(-d, d+1, 2):
+            if k == -d or (k != d and v[k-1+d-1] < v[k+1+d-1]):
+                px = v[k+1+d-1]
+            else:
+                px = v[k-1+d-1] + 1
+            if d == 0: px = 0
+            py = px - k
+            while px < n and py < m and x[px] == y[py]: px, py = px+1, py+1
+            vd[k+d] = px
+            if px >= n and py >= m:
+                end = (d, k)
+                break
+        trace.append(vd)
+        v = vd
+        if end: break
+    if end is None: return []
+    # walk back through the trace, collecting the diagonal runs
+    d, k = end
+    px = trace[d][k+d]
+    matches = []
+    while d >= 0:
+        py = px - k
+        if d == 0:
+            sx = 0
+        else:
+            v = trace[d-1]
+            if k == -d or (k != d and v[k-1+d-1] < v[k+1+d-1]):
+                pk = k+1
+                sx = v[pk+d-1]
+            else:
+                pk = k-1
+                sx = v[pk+d-1] + 1
+        while px > sx:
+            px, py = px-1, py-1
+            matches.append((ai[px], bj[py], 1))
+        if d == 0: break
+        px, k, d = trace[d-1][pk+d-1], pk, d-1
+    matches.reverse()
+    return matches
+
+def textdelta(a,b):
+    """
+    Return a compact line-based delta from text a to text b.
+
+    The delta is a list where a tuple (lo,hi) means lines lo to hi of
+    a and a list holds new lines; applydelta(a,delta) gives back b.
+    """
+    a = split(a,'\n')
+    b = split(b,'\n')
+    delta = []
+    for tag, alo, ahi, blo, bhi in diffcodes(a,b):
+        if tag == 'equal': delta.append((alo,ahi))
+        elif bhi > blo: delta.append(b[blo:bhi])
+    return delta
+
+def applydelta(a,delta):
+    """Reconstruct a text from text a and a delta made by textdelta."""
+    a = split(a,'\n')
+    b = []
+    for d in delta:
+        if type(d) is TupleType: b.extend(a[d[0]:d[1]])
+        else: b.extend(d)
+    return join(b,'\n')
+
 def textdiff(a, b, verbose=1):
     """
     Generate readable a plain text diff between two texts.
@@ -11,8 +11,6 @@ from itertools import *
 from email.Message import Message
 from copy import deepcopy
 import os.path
-import socket
-import urllib2
 
 import ZODB # need this for pychecker
 from AccessControl import getSecurityManager, ClassSecurityInfo, Unauthorized
@@ -33,14 +31,14 @@ from zExceptions import BadRequest, Forbidden
 import OFS.Image
 
 from plugins.pagetypes import PAGETYPES
-from Defaults import DISABLE_JAVASCRIPT, LARGE_FILE_SIZE, LEAVE_PLACEHOLDER, \
-    ZWIKI_SPAMPATTERNS_URL, ZWIKI_SPAMPATTERNS_TIMEOUT
+from Defaults import DISABLE_JAVASCRIPT, LARGE_FILE_SIZE, LEAVE_PLACEHOLDER
 import Permissions
 from Regexps import javascriptexpr, htmlheaderexpr, htmlfooterexpr
 from Utils import get_transaction, BLATHER, INFO, parseHeadersBody, isunicode, \
-     safe_hasattr, stripList
+     safe_hasattr
 from i18n import _
 from Diff import addedtext, textdiff
+from SpamFilter import spamPatterns, remoteSpamPatterns, parseSpamPatterns
 
 
 class PageEditingSupport:
@@ -107,6 +105,7 @@ class PageEditingSupport:
         p = self.__class__(__name__=id)
         p.title = name # because manage_afterAdd adds this to the wiki outline
         p = self.folder()[self.folder()._setObject(id,p)] # place in folder
+        p.clearLinkCache()
         p.checkForSpam(text) # now we're acquiring wiki options, check for spam
         p.ensureMyRevisionNumberIsLatest()
         p.setCreator(REQUEST)
@@ -201,13 +200,15 @@ class PageEditingSupport:
 
         # each of these handlers checks relevant permissions and does the necessary
         if p.handleDeleteMe(text,REQUEST,log): return
+        state = p.catalogState()
         p.saveRevision()
         p.handleEditPageType(type,REQUEST,log)
         if text != None: p.handleEditText(text,REQUEST,subjectSuffix,log)
         p.handleSubtopicsProperty(subtopics,REQUEST)
         p.handleFileUpload(REQUEST,log)
         p.handleRename(title,leaveplaceholder,updatebacklinks,REQUEST,log)
-        p.index_object()
+        p.clearRenderCache()
+        p.reindexChanged(p.changedAttributes(state))
 
         if REQUEST:
             try:
@@ -273,22 +274,33 @@ class PageEditingSupport:
         self.checkForSpam(t)
 
         # do it
+        state = self.catalogState()
         self.saveRevision()
         # append to the raw source
         t = '\n\n' + t
+        oldsource = self.storedText()
         self.raw += t
-        # and to the _prerendered cache, carefully mimicking a full
-        # prerender. This works with current page types at least.
-        t = self.pageType().preRenderMessage(self,m)
-        if firstcomment: t=self.pageType().discussionSeparator(self) + t
-        t = self.pageType().preRender(self,t)
-        self.setPreRendered(self.preRendered()+t)
+        self.updateCommentIndex(oldsource, t)
+        if self.startsDiscussionChunk():
+            # the page now shows just this comment; the previous latest
+            # chunk joins the older ones
+            self.setPreRendered(self.pageType().preRender(self))
+            self.preRenderDiscussionChunks(self.discussionChunkCount()-2)
+        else:
+            # and to the _prerendered cache, carefully mimicking a full
+            # prerender. This works with current page types at least.
+            t = self.pageType().preRenderMessage(self,m)
+            if firstcomment: t=self.pageType().discussionSeparator(self) + t
+            t = self.pageType().preRender(self,t)
+            self.setPreRendered(self.preRendered()+t)
+        self.updateLinkGraph()
         self.cookDtmlIfNeeded()
         # extras
         self.setLastEditor(REQUEST)
         self.setLastLog(subject_heading)
         if self.autoSubscriptionEnabled(): self.subscribeThisUser(REQUEST)
-        self.index_object()
+        self.clearRenderCache()
+        self.reindexChanged(self.changedAttributes(state))
         if REQUEST: REQUEST.cookies['zwiki_username'] = m['From'] # use real from address
         if sendmail:
             self.sendMailToSubscribers(
@@ -391,6 +403,7 @@ class PageEditingSupport:
         # figure out where to go afterward - up, or to default page (which may change)
         redirecturl = self.primaryParent() and self.primaryParentUrl() or None
         self.folder().manage_delObjects([self.getId()])
+        self.clearLinkCache()
         redirecturl = redirecturl or self.defaultPageUrl()
         self.sendMailToEditSubscribers(
             'This page was deleted.\n',
@@ -452,11 +465,14 @@ class PageEditingSupport:
             self.folder()._setObject(id,o)
         def replaceMyselfWithRev(r):
             newself = self.revision(rev)
+            newself.expandRevision()
             newself._setId(id)
             replaceMyselfWith(newself)
         def deleteRevsSince(r):
             for r in oldrevs[oldrevs.index(rev):]:
-                self.revisionsFolder()._delObject('%s.%d' % (id,r))
+                rid = '%s.%d' % (id,r)
+                self.revisionsFolder()._delObject(rid)
+                self.updateRevisionIndex(removed=rid)
         replaceMyselfWithRev(rev)
         deleteRevsSince(rev)
         BLATHER('expunged %s history after revision %d' % (id,rev))
@@ -533,6 +549,7 @@ class PageEditingSupport:
             self.changeIdCarefully(newid)
         if namechanged:
             self.changeNameCarefully(newname)
+        self.clearLinkCache()
         if (idchanged or namechanged) and updatebacklinks:
             self._replaceLinksEverywhere(oldname,newname,REQUEST)
         self.index_object() # update catalog XXX manage_renameObject may also, if idchanged
@@ -726,7 +743,7 @@ class PageEditingSupport:
     security.declareProtected(Permissions.View, 'read')
     def read(self):
         return re.sub('<!--antidecapitationkludge-->\n\n?','',
-                      self._old_read())
+                      self.storedText())
 
     security.declareProtected(Permissions.View, 'text')
     def text(self, REQUEST=None, RESPONSE=None):
@@ -773,48 +790,25 @@ class PageEditingSupport:
             raise Forbidden, "There was a problem, please contact the site admin."
             
         # content matches a banned pattern ?
-        for pat in self.getSpamPatterns():
-            if re.search(pat,t): forbid("spam pattern found")
+        m = spamPatterns(self.getSpamPatterns()).search(t)
+        if m: forbid("spam pattern found: %s" % m.group())
 
     def getSpamPatterns(self):
-        """Fetch spam patterns from the global zwiki spam blacklist,
-        or a local property. Returns a list of stripped non-empty
-        regular expression strings.
+        """Get spam patterns from a local property, or the global zwiki
+        spam blacklist. Returns a list of stripped non-empty regular
+        expression strings. The global blacklist is the copy we last
+        fetched; this never waits for the network (see SpamFilter).
         """
         if safe_hasattr(self.folder(), 'spampatterns'):
             return list(getattr(self.folder(),'spampatterns',[]))
         else:
-            BLATHER('checking zwiki.org spam blacklist')
-            req = urllib2.Request(
-                ZWIKI_SPAMPATTERNS_URL, 
-                None,
-                {'User-Agent':'Zwiki %s' % self.zwiki_version()}
-                )
-            # have to set timeout this way for python 2.4. XXX safe ?
-            saved = socket.getdefaulttimeout()
-            socket.setdefaulttimeout(ZWIKI_SPAMPATTERNS_TIMEOUT)
-            try:
-                try:
-                    response = urllib2.urlopen(req)
-                    t = response.read()
-                except urllib2.URLError, e:
-                    BLATHER('failed to read blacklist, skipping (%s)' % e)
-                    t = ''
-            finally:
-                socket.setdefaulttimeout(saved)
-            return self.parseSpamPatterns(t)
+            return remoteSpamPatterns('Zwiki %s' % self.zwiki_version())
 
     def parseSpamPatterns(self, t):
         """Parse the contents of spampatterns.txt, returning any
-        patterns as a list of strings.
-
-        spampatterns.txt version 1 may contain:
-
-        - comments - lines beginning with #
-        - whitespace at the start or end of lines, or blank lines
-        - a line of the form "zwiki-spampatterns-version: 1"; assumed if not present
+        patterns as a list of strings (see SpamFilter.parseSpamPatterns).
         """
-        return [p for p in stripList(t.split('\n')) if not (p.startswith('#') or p.startswith('zwiki-spampatterns-version:'))]
+        return parseSpamPatterns(t)
 
     def cleanupText(self, t):
         """Clean up incoming text and convert to unicode for internal use."""
@@ -5,11 +5,19 @@ Warning: this implementation might be zodb-cache-unfriendly as revisions
 increase.
 """
 
-from AccessControl import getSecurityManager, ClassSecurityInfo
+from bisect import bisect_left, insort
+from cPickle import dumps
+from AccessControl import getSecurityManager, ClassSecurityInfo, Unauthorized
+from Acquisition import aq_base
 from Globals import InitializeClass
 try:    from Products.BTreeFolder2.BTreeFolder2 import BTreeFolder2 as Folder
 except ImportError: from OFS.Folder import Folder # zope 2.7
-from Utils import safe_hasattr, sorted, registerSupportFolderId
+from BTrees.OOBTree import OOBTree
+from Utils import safe_hasattr, sorted, registerSupportFolderId, BLATHER, \
+     get_transaction
+from Defaults import COMPACT_REVISIONS, REVISION_SNAPSHOT_INTERVAL
+from Diff import textdelta, applydelta
+from i18n import _
 
 import re
 import Permissions
@@ -18,6 +26,18 @@ from OutlineSupport import PersistentOutline
 REVISIONS_FOLDER_ID = 'revisions'
 registerSupportFolderId(REVISIONS_FOLDER_ID)
 
+def revisionIdParts(id):
+    """Split a revision object id into base id and revision number, or
+    return (None, None) if it's not a revision id."""
+    m = re.match(r'(.*)\.(\d+)$', id)
+    if m: return (m.group(1), int(m.group(2)))
+    else: return (None, None)
+
+def revisionIndexEntry(rev):
+    """The revision index entry for a revision object."""
+    return (revisionIdParts(rev.getId())[1],
+            rev.last_edit_time, rev.last_editor, rev.last_log)
+
 class PageHistorySupport:
     """
     This mixin provides methods to save, browse and restore zwiki page
@@ -31,9 +51,17 @@ class PageHistorySupport:
     """
     security = ClassSecurityInfo()
 
+    # compact revisions (see compactRevision)
+    _compact_revision = 0
+    _delta_base = None
+    _delta_ops = None
+    _delta_depth = 0
+
     def ensureRevisionsFolder(self):
         if self.revisionsFolder() is None:
-            self.folder()._setObject(REVISIONS_FOLDER_ID,Folder(REVISIONS_FOLDER_ID))
+            f = Folder(REVISIONS_FOLDER_ID)
+            f._revisionindex = OOBTree() # a new folder's index is empty
+            self.folder()._setObject(REVISIONS_FOLDER_ID,f)
 
     def inRevisionsFolder(self):
         return self.folder().getId() == REVISIONS_FOLDER_ID
@@ -67,19 +95,90 @@ class PageHistorySupport:
         return f[self.getIdBase()]
 
     def oldRevisionIds(self):
-        f = self.revisionsFolder()
-        if not f:
-            return []
-        else:
-            isrev = re.compile(r'%s\.\d+$' % self.getIdBase()).match
-            ids = filter(isrev, list(f.objectIds(spec=self.meta_type)))
-            # probably in the right order, but let's make sure
-            ids.sort(lambda a,b: cmp(int(a.split('.')[1]), int(b.split('.')[1])))
-            return ids
+        base = self.getIdBase()
+        return ['%s.%d' % (base,r) for r in self.oldRevisionNumbers()]
 
     def oldRevisions(self):
         return [self.revisionsFolder()[id] for id in self.oldRevisionIds()]
 
+    # the revision index
+
+    def revisionIndex(self):
+        """
+        Get the revision index, or None if there is no revisions folder.
+
+        This is an OOBTree kept in the revisions folder, mapping each
+        page's base id to a tuple of (revision number, last edit time,
+        last editor, last log) for its old revisions, sorted by revision
+        number. It lets us browse a page's history without searching the
+        whole revisions folder or loading other revision objects. It is
+        created with the revisions folder, or by upgradeAll for older
+        wikis (until then this returns None), and kept up to date by
+        saveRevision, expunge, archive and the ZMI add/delete hooks.
+        """
+        f = self.revisionsFolder()
+        if f is None: return None
+        return getattr(aq_base(f),'_revisionindex',None)
+
+    security.declareProtected('Manage properties', 'rebuildRevisionIndex')
+    def rebuildRevisionIndex(self):
+        """
+        Regenerate the revision index from the revisions folder's contents.
+        """
+        f = self.revisionsFolder()
+        if f is None: return None
+        revs = {}
+        for id in f.objectIds(spec=self.meta_type):
+            base, r = revisionIdParts(id)
+            if base is not None:
+                revs.setdefault(base,[]).append(revisionIndexEntry(f[id]))
+        index = OOBTree()
+        for base, entries in revs.items():
+            entries.sort()
+            index[base] = tuple(entries)
+        f._revisionindex = index
+        return index
+
+    security.declarePrivate('updateRevisionIndex')
+    def updateRevisionIndex(self,added=None,removed=None):
+        """
+        Record a revision object's addition, or a revision id's removal,
+        in the revision index, if there is one yet.
+        """
+        f = self.revisionsFolder()
+        if f is None: return
+        index = getattr(aq_base(f),'_revisionindex',None)
+        if index is None: return
+        if removed:
+            base, r = revisionIdParts(removed)
+            if base is not None and index.has_key(base):
+                entries = [e for e in index[base] if e[0] != r]
+                if entries: index[base] = tuple(entries)
+                else: del index[base]
+        if added is not None:
+            base, r = revisionIdParts(added.getId())
+            if base is not None:
+                entries = [e for e in index.get(base,()) if e[0] != r]
+                insort(entries, revisionIndexEntry(added))
+                index[base] = tuple(entries)
+
+    def oldRevisionInfo(self):
+        """
+        Revision number, last edit time, last editor and last log of each
+        of this page's old revisions, oldest first, from the revision index.
+        """
+        index = self.revisionIndex()
+        if index is not None: return index.get(self.getIdBase(),())
+        # no index yet (wiki not upgraded), search the revisions folder
+        f = self.revisionsFolder()
+        if f is None: return ()
+        base = self.getIdBase()
+        entries = [revisionIndexEntry(f[id])
+                   for id in f.objectIds(spec=self.meta_type)
+                   if revisionIdParts(id)[0] == base]
+        entries.sort()
+        return tuple(entries)
+
     def getIdBase(self):
         """This page's id with any revision number suffix removed."""
         return re.sub(r'^(.*)\.\d+$', r'\1', self.getId())
@@ -87,15 +186,19 @@ class PageHistorySupport:
     security.declareProtected(Permissions.View, 'revisionCount')
     def revisionCount(self):
         """The number of revisions existing for this page."""
-        return len(self.revisions())
+        return len(self.oldRevisionInfo()) + 1
 
     security.declareProtected(Permissions.View, 'revision')
     def revision(self, rev):
         """Get the specified revision of this page object (starting from 1)."""
         if rev:
-            # should be no more than one, but you never know
-            revs = [r for r in self.revisions() if r.revisionNumber()==rev]
-            if revs: return revs[0]
+            oldrevs = self.oldRevisionNumbers()
+            i = bisect_left(oldrevs, rev)
+            if i < len(oldrevs) and oldrevs[i] == rev:
+                return self.revisionsFolder()._getOb(
+                    '%s.%d' % (self.getIdBase(),rev), None)
+            latest = self.latestRevision()
+            if latest.revisionNumber() == rev: return latest
         return None
 
     security.declareProtected(Permissions.View, 'previousRevision')
@@ -125,12 +228,13 @@ class PageHistorySupport:
     def revisionNumbers(self):
         """The revision numbers of all available revisions of this page
         (sorted)."""
-        return sorted([r.revisionNumber() for r in self.revisions()])
+        return sorted(self.oldRevisionNumbers() +
+                      [self.latestRevision().revisionNumber()])
 
     def oldRevisionNumbers(self):
         """The revision numbers of all old revisions, excluding the latest
         one (sorted)."""
-        return sorted([r.revisionNumber() for r in self.oldRevisions()])
+        return [e[0] for e in self.oldRevisionInfo()]
 
     def firstRevisionNumber(self):
         """The revision number of the earliest saved revision of this page."""
@@ -157,9 +261,12 @@ class PageHistorySupport:
     def revisionNumberBefore(self, username): # -> revision number | none
         # depends on: self, revisions
         """The revision number of the last edit not by username, or None."""
-        for r in range(self.revisionCount(),0,-1):
-            if self.revision(r).lastEditor() != username:
-                return r
+        latest = self.latestRevision()
+        if latest.lastEditor() != username: return latest.revisionNumber()
+        oldrevs = self.oldRevisionInfo()
+        for i in range(len(oldrevs)-1,-1,-1):
+            if self.tounicode(oldrevs[i][2]) != username:
+                return oldrevs[i][0]
         return None
 
     def ensureMyRevisionNumberIsLatest(self):
@@ -188,6 +295,9 @@ class PageHistorySupport:
         rid = '%s.%d' % (self.getId(), self.revisionNumber())
         ob = self._getCopy(self.folder())
         ob._setId(rid)
+        if self.compactRevisionsEnabled():
+            oldids = self.oldRevisionIds()
+            ob.compactRevision(oldids and self.revisionsFolder()[oldids[-1]] or None)
 
         # kludge so the following won't update an outline cache
         # in the revisions folder (hopefully thread-safe, otherwise
@@ -202,10 +312,148 @@ class PageHistorySupport:
         # clean up after kludge
         self.__class__.manage_afterAdd = manage_afterAdd
         self.__class__.wikiOutline     = wikiOutline
+        self.updateRevisionIndex(added=ob)
 
         # and increment
         self.revision_number = self.revisionNumber() + 1
 
+    # compact revisions
+
+    def compactRevisionsEnabled(self):
+        return getattr(self,'compact_revisions',COMPACT_REVISIONS) and 1
+
+    def isCompactRevision(self):
+        return getattr(aq_base(self),'_compact_revision',0) and 1
+
+    security.declarePrivate('compactRevision')
+    def compactRevision(self, base=None):
+        """
+        Shrink this revision object, given the previous saved revision.
+
+        Saved revisions normally hold a full copy of the page, including
+        its pre-rendered html. A compact revision drops the pre-rendered
+        data, including any older comment chunks (it is regenerated, in
+        memory only, if the revision is viewed) and holds just a
+        line-based delta from the base revision's text, which it keeps a
+        reference to. This means deleting the base revision later does
+        no harm. Every REVISION_SNAPSHOT_INTERVAL revisions (or when
+        there is no usable base) we keep the full text instead, so that
+        reconstructing a revision takes a bounded number of steps.
+        """
+        text = self.storedText()
+        self._prerendered = ''
+        if aq_base(self).__dict__.has_key('_discussionchunks'):
+            del self._discussionchunks
+        self._compact_revision = 1
+        self._delta_base = self._delta_ops = None
+        self._delta_depth = 0
+        if base is not None:
+            base = aq_base(base)
+            basetext = base.storedText()
+            depth = base.isCompactRevision() and base._delta_depth + 1 or 1
+            if (depth < REVISION_SNAPSHOT_INTERVAL
+                and type(basetext) == type(text)):
+                self._delta_base = base
+                self._delta_ops = textdelta(basetext, text)
+                self._delta_depth = depth
+                self.raw = ''
+                return
+        self.raw = text
+
+    security.declarePrivate('expandRevision')
+    def expandRevision(self):
+        """Turn a compact revision back into a full, standalone copy."""
+        if not self.isCompactRevision(): return
+        text = self.revisionText()
+        for a in ('_compact_revision','_delta_base','_delta_ops',
+                  '_delta_depth','_v_revisiontext','_v_prerendered'):
+            if aq_base(self).__dict__.has_key(a): delattr(self,a)
+        self.raw = text
+
+    def storedText(self):
+        """This page's raw text, reconstructed if it's a compact revision."""
+        if self.isCompactRevision(): return self.revisionText()
+        else: return self._old_read()
+
+    def revisionText(self):
+        """
+        Get the raw text of a compact revision, from its base revisions.
+        """
+        t = getattr(self,'_v_revisiontext',None)
+        if t is None:
+            chain, r = [], aq_base(self)
+            while r._delta_ops is not None:
+                chain.append(r)
+                r = r._delta_base
+            t = r.raw
+            chain.reverse()
+            for r in chain: t = applydelta(t, r._delta_ops)
+            self._v_revisiontext = t
+        return t
+
+    def revisionStorageSize(self):
+        """
+        Roughly how many bytes this revision's text data takes up in the
+        database, for measuring the effect of compactRevisions.
+        """
+        ob = aq_base(self)
+        chunks = getattr(ob,'_discussionchunks',None)
+        return len(dumps((ob.raw, getattr(ob,'_prerendered',''),
+                          chunks is not None and list(chunks.values()) or None,
+                          getattr(ob,'_delta_ops',None)), 1))
+
+    security.declarePublic('compactRevisions') # we check folder permission at runtime
+    def compactRevisions(self,batch=0,REQUEST=None):
+        """
+        Convert this wiki's existing saved revisions to compact revisions.
+
+        Each page's revisions are processed oldest first, with each one
+        stored as a delta from the one before (see compactRevision).
+        Revisions which are already compact are left alone, so this can
+        be re-run safely, eg after an interrupted run. Logs and returns
+        the approximate size of the revisions' text data before and
+        after. This does not turn on compact revisions for future edits;
+        set the compact_revisions property for that.
+
+        The optional batch argument forces a commit every N revisions.
+
+        Requires 'Manage properties' permission on the folder.
+        """
+        if not self.checkPermission(Permissions.manage_properties,
+                                     self.folder()):
+            raise Unauthorized, (
+             _('You are not authorized to compact revisions.') + \
+             _('(folder -> Manage properties)'))
+        f = self.revisionsFolder()
+        if f is None: return (0,0)
+        batch = int(batch)
+        BLATHER('compacting all revisions:')
+        revs = {}
+        for id in f.objectIds(spec=self.meta_type):
+            base, r = revisionIdParts(id)
+            if base is not None: revs.setdefault(base,[]).append((r,id))
+        n, before, after = 0, 0, 0
+        for base in sorted(revs.keys()):
+            prev = None
+            for r, id in sorted(revs[base]):
+                rev = f[id]
+                size = rev.revisionStorageSize()
+                if not rev.isCompactRevision():
+                    rev.compactRevision(prev)
+                    n += 1
+                    if batch and n % batch == 0:
+                        BLATHER('committing')
+                        get_transaction().commit()
+                elif aq_base(rev).__dict__.has_key('_discussionchunks'):
+                    # compacted before these were dropped too
+                    del rev._discussionchunks
+                before += size
+                after += rev.revisionStorageSize()
+                prev = rev
+        BLATHER('compacted %d revisions, text data reduced from %d to %d bytes' \
+                % (n, before, after))
+        return (before, after)
+
     # backwards compatibility / temporary
 
     def forwardRev(self,rev): return self.revisionCount() - rev - 1
@@ -217,7 +465,9 @@ class PageHistorySupport:
         Just a quick helper for diff browsing.
         """
         rev = self.forwardRev(int(rev))
-        note = self.revisions()[rev].lastLog()
+        info = (list(self.oldRevisionInfo()) + [None])[rev]
+        if info: note = info[3] or ''
+        else: note = self.latestRevision().lastLog()
         match = re.search(r'"(.*)"',note)
         if match:
             if withQuotes: return match.group()
@@ -227,4 +477,3 @@ class PageHistorySupport:
 
 InitializeClass(PageHistorySupport)
 
-
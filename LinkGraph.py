@@ -0,0 +1,101 @@
+######################################################################
+# the wiki's link graph
+
+from Persistence import Persistent
+from BTrees.OOBTree import OOBTree, OOTreeSet
+
+class LinkGraph(Persistent):
+    """
+    A persistent record of which pages link to which, in both directions.
+
+    Nodes are page ids; each page's links are the canonical ids of the
+    local wiki links it contains (see ZWikiPage.canonicalLinks), which
+    may or may not be existing pages. We keep:
+
+    - the forward links of every page, as a sorted tuple
+    - the backlinks of every link target, as an OOTreeSet
+    - the orphaned pages, which no other page links to
+    - the wanted pages, which are linked to but don't exist
+
+    so that each of these queries, and every update, costs time
+    proportional to the number of links involved rather than the size
+    of the wiki.
+    """
+    def __init__(self):
+        self._forward = OOBTree()   # page id -> tuple of link target ids
+        self._backward = OOBTree()  # link target id -> OOTreeSet of page ids
+        self._orphans = OOTreeSet()
+        self._wanted = OOTreeSet()
+
+    def hasPage(self, id):
+        return self._forward.has_key(id)
+
+    def setLinks(self, id, targets):
+        """Record page id (new or existing) as linking to targets."""
+        new = {}
+        for t in targets: new[t] = 1
+        old = self._forward.get(id,())
+        newlinks = tuple(sorted(new.keys()))
+        if self.hasPage(id) and newlinks == old: return
+        self._forward[id] = newlinks
+        for t in old:
+            if not new.has_key(t): self._unlink(id, t)
+        for t in newlinks:
+            if not t in old:
+                if not self._backward.has_key(t): self._backward[t] = OOTreeSet()
+                self._backward[t].insert(id)
+                self._refresh(t)
+        self._refresh(id)
+
+    def removePage(self, id):
+        """
+        Forget page id and its links. Links to it are kept, so it becomes
+        wanted if anything still links to it.
+        """
+        if not self.hasPage(id): return
+        for t in self._forward[id]: self._unlink(id, t)
+        del self._forward[id]
+        self._refresh(id)
+
+    def _unlink(self, id, target):
+        backlinks = self._backward.get(target)
+        if backlinks is not None:
+            backlinks.remove(id)
+            if not backlinks: del self._backward[target]
+        self._refresh(target)
+
+    def _refresh(self, id):
+        """Update id's orphaned/wanted status."""
+        backlinks = self._backward.get(id)
+        if self.hasPage(id):
+            if self._wanted.has_key(id): self._wanted.remove(id)
+            if backlinks is None or backlinks.minKey() == backlinks.maxKey() == id:
+                self._orphans.insert(id)
+            elif self._orphans.has_key(id):
+                self._orphans.remove(id)
+        else:
+            if self._orphans.has_key(id): self._orphans.remove(id)
+            if backlinks is not None: self._wanted.insert(id)
+            elif self._wanted.has_key(id): self._wanted.remove(id)
+
+    def links(self, id):
+        """The ids page id links to, sorted."""
+        return list(self._forward.get(id,()))
+
+    def backlinks(self, id):
+        """The ids of the pages linking to id (which need not exist), sorted."""
+        return list(self._backward.get(id,()))
+
+    def linkCount(self, id):
+        return len(self._forward.get(id,()))
+
+    def backlinkCount(self, id):
+        return len(self._backward.get(id,()))
+
+    def orphans(self):
+        """The ids of pages with no links from other pages, sorted."""
+        return list(self._orphans)
+
+    def wanted(self):
+        """The ids of non-existent pages which are linked to, sorted."""
+        return list(self._wanted)
@@ -10,12 +10,17 @@ from email.Iterators import typed_subpart_iterator
 from email.Header import Header, decode_header
 
 from Globals import InitializeClass
+from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base
+from BTrees.OOBTree import OOBTree
 
 from i18n import _
 from TextFormatter import TextFormatter
 from Utils import html_unquote,BLATHER,DEBUG,formattedTraceback,stripList, \
-     isIpAddress,isEmailAddress,isUsername,safe_hasattr,tounicode,toencoded
-from Defaults import AUTO_UPGRADE, PAGE_METATYPE
+     isIpAddress,isEmailAddress,isUsername,safe_hasattr,tounicode,toencoded, \
+     get_transaction
+from Defaults import AUTO_UPGRADE, PAGE_METATYPE, MAIL_QUEUE
+from MailQueue import mailQueue, wakeMailQueue
 from Regexps import bracketedexpr,urlchars
 from plugins.tracker.tracker import ISSUE_SEVERITIES
 
@@ -42,6 +47,7 @@ class PageSubscriptionSupport:
     For the moment, it's still called "email" in arguments to avoid
     breaking legacy dtml (eg subscribeform).
     """
+    security = ClassSecurityInfo()
     subscriber_list = []
     _properties=(
         {'id':'subscriber_list', 'type': 'lines', 'mode': 'w'},
@@ -70,10 +76,14 @@ class PageSubscriptionSupport:
         With parent flag, manage the parent folder's subscriber list instead.
         """
         if AUTO_UPGRADE: self._upgradeSubscribers()
+        old = self._getSubscribers(parent)
         if parent:
             self.folder().subscriber_list = subscriberlist
+            self.updateSubscriptionIndex('whole_wiki',old,subscriberlist)
         else:
             self.subscriber_list = subscriberlist
+            if not self.inRevisionsFolder():
+                self.updateSubscriptionIndex(self.getId(),old,subscriberlist)
 
     def _resetSubscribers(self, parent=0): # -> none; modifies self, folder
         """
@@ -238,7 +248,7 @@ class PageSubscriptionSupport:
                 subs = self._getSubscribers(parent)
                 subs.append(subscriber + (edits and ':edits' or ''))
                 self._setSubscribers(subs,parent)
-                if not parent: self.index_object()
+                if not parent: self.reindexChanged(['subscriber_list'])
         if REQUEST:
             REQUEST.RESPONSE.redirect(
                 REQUEST.get('redirectURL',
@@ -263,7 +273,7 @@ class PageSubscriptionSupport:
                     BLATHER('unsubscribed',subscriber,'from',self.id())
                     sl.remove(s)
             self._setSubscribers(sl,parent)
-            if not parent: self.index_object()
+            if not parent: self.reindexChanged(['subscriber_list'])
         if REQUEST:
             REQUEST.RESPONSE.redirect(
                 REQUEST.get('redirectURL',
@@ -318,41 +328,112 @@ class PageSubscriptionSupport:
         if user and not (self.isSubscriber(user) or self.isWikiSubscriber(user)):
             self.subscribe(user)
 
-    def allSubscriptionsFor(self, email): # -> [string]; depends on self, wiki, catalog
+    def allSubscriptionsFor(self, email): # -> [string]; depends on self, wiki
         """
         Return the ids of all pages to which a subscriber is subscribed
         ('whole_wiki' indicates a wiki subscription).
 
-        XXX catalog case duplicates isSubscriber code
+        This is a lookup in the subscription index, so is cheap enough
+        to do for every incoming mail.
         """
-        subscriber = email
-        subscriptions = []
         # subscriber may be an email address or a member id, and
         # they may be subscribed as either
+        index = self.subscriptionIndex()
+        if index is None: index = self.scanSubscriptions()
+        ids = {}
+        for key in self.subscriptionKeys(email):
+            for id in index.get(key,()): ids[id] = 1
+        subscriptions = sorted(ids.keys())
+        if ids.has_key('whole_wiki'):
+            subscriptions.remove('whole_wiki')
+            subscriptions.insert(0,'whole_wiki')
+        return subscriptions
+
+    def subscriptionKeys(self, subscriber): # -> [string]; depends on cmf/plone site
+        """
+        The subscription index keys for a subscriber or subscriber list
+        entry: its email address, and its username if it is one.
+        """
+        if not subscriber or type(subscriber) != StringType: return []
+        subscriber = re.sub(r':edits$','',subscriber)
+        keys = self.usernamesFrom(subscriber)
         email = self.emailAddressFrom(subscriber)
-        usernames = self.usernamesFrom(subscriber)
+        if email and not email in keys: keys.append(email)
+        return keys
 
-        if not (email or usernames):
-            return []
-        if self.isWikiSubscriber(subscriber):
-            subscriptions.append('whole_wiki')
-        # optimization: try to use catalog for memory efficiency..
-        # XXX obsolete, always have a catalog now ?
+    def subscriptionIndex(self): # -> OOBTree; depends on wiki
+        """
+        Get the wiki's subscription index, or None if it has not been
+        built yet.
+
+        This is an OOBTree kept in the wiki folder, mapping each
+        subscriber's email address and username (see subscriptionKeys)
+        to a sorted tuple of the ids of the pages they are subscribed to,
+        including 'whole_wiki' for a wiki subscription. _setSubscribers
+        and the ZMI add/delete hooks (hence also renames) keep it up to
+        date; it can get out of step if a subscriber_list property is
+        edited directly or a member's email address changes, in which
+        case upgradeAll or rebuildSubscriptionIndex will fix it. It is
+        built when a wiki is created or upgraded, never during a view.
+        """
+        return getattr(aq_base(self.wikiFolder()),'_subscriptionindex',None)
+
+    security.declareProtected('Manage properties', 'rebuildSubscriptionIndex')
+    def rebuildSubscriptionIndex(self): # -> OOBTree; depends on wiki, catalog; modifies wiki
+        """
+        Regenerate the subscription index from the wiki's subscriber lists.
+        """
+        index = OOBTree()
+        for key, pages in self.scanSubscriptions().items():
+            index[key] = pages
+        self.wikiFolder()._subscriptionindex = index
+        return index
+
+    def scanSubscriptions(self): # -> {string:(string)}; depends on wiki, catalog
+        """
+        Work out the subscription index's contents, as a dictionary,
+        from the wiki's subscriber lists. This visits every page, so
+        is used only when the index has not been built yet.
+        """
+        f = self.wikiFolder()
+        subscriptions = [('whole_wiki',self.wikiSubscriberList())]
         if self.hasCatalogIndexesMetadata(
             (['meta_type','path'], ['subscriber_list'])):
-            pages = self.pages()
-            for page in pages:
-                for sub in page.subscriber_list:
-                    if not sub: continue
-                    if ((email and (self.emailAddressFrom(sub) == email)) or
-                        (usernames and (sub in usernames))):
-                        subscriptions.append(page.id)
+            for page in self.pages():
+                subscriptions.append((page.id,page.subscriber_list))
         else:
-            # poor caching
-            for id, page in self.folder().objectItems(spec=PAGE_METATYPE):
-                if page.isSubscriber(subscriber):
-                    subscriptions.append(id)
-        return subscriptions
+            for id, page in f.objectItems(spec=PAGE_METATYPE):
+                subscriptions.append((id,page.subscriber_list))
+        ids = {}
+        for id, subs in subscriptions:
+            for sub in subs:
+                for key in self.subscriptionKeys(sub):
+                    ids.setdefault(key,{})[id] = 1
+        for key, pages in ids.items():
+            ids[key] = tuple(sorted(pages.keys()))
+        return ids
+
+    def updateSubscriptionIndex(self, id, old=[], new=[]): # -> none; depends on wiki; modifies wiki
+        """
+        Record a change of the subscriber list of page id (or
+        'whole_wiki') from old to new in the subscription index, if
+        there is one yet.
+        """
+        index = getattr(aq_base(self.wikiFolder()),'_subscriptionindex',None)
+        if index is None: return
+        oldkeys, newkeys = {}, {}
+        for sub in old:
+            for key in self.subscriptionKeys(sub): oldkeys[key] = 1
+        for sub in new:
+            for key in self.subscriptionKeys(sub): newkeys[key] = 1
+        for key in oldkeys.keys():
+            if not newkeys.has_key(key) and id in index.get(key,()):
+                ids = tuple([i for i in index[key] if i != id])
+                if ids: index[key] = ids
+                else: del index[key]
+        for key in newkeys.keys():
+            ids = index.get(key,())
+            if not id in ids: index[key] = tuple(sorted(ids + (id,)))
 
     def otherPageSubscriptionsFor(self, email): # -> [string]; depends on self, wiki
         """
@@ -763,11 +844,50 @@ class PageMailSupport:
                 'List-Archive':'<'+self.pageUrl()+'>',
                 'List-Help':'<'+self.wikiUrl()+'>',
                 }
-            GenericMailHost(self.mailhost()).send(fields)
-            BLATHER('sent mail to subscribers:\nTo: %s\nBcc: %s' % (fields['To'],fields['Bcc']))
+            mailhost = GenericMailHost(self.mailhost())
+            if self.useMailQueue() and mailhost.canQueue():
+                self.queueMail(mailhost, fields)
+            else:
+                mailhost.send(fields)
+                BLATHER('sent mail to subscribers:\nTo: %s\nBcc: %s' % (fields['To'],fields['Bcc']))
         except: 
             BLATHER('**** failed to send mail to %s: %s' % (recipients,formattedTraceback()))
             
+    def useMailQueue(self): # -> boolean; depends on: wiki
+        """
+        Should mail-outs go through the background mail queue ?
+
+        This is on by default and can be turned off with a
+        use_mail_queue property on the wiki folder.
+        """
+        return getattr(self.folder(),'use_mail_queue',MAIL_QUEUE) and 1 or 0
+
+    def queueMail(self, mailhost, fields, queuedir=None): # -> none; other effects: queues msg
+        """
+        Add a mail-out to the background mail queue, to be sent after
+        this transaction commits; if it aborts, nothing is sent. If there
+        is no usable queue, send it right away instead.
+        """
+        queue = mailQueue(queuedir)
+        if queue is None:
+            mailhost.send(fields)
+            return
+        mfrom, mto, msg = mailhost.envelope(fields)
+        path = mailhost.path()
+        def enqueue(status=1):
+            if not status: return
+            try:
+                queue.put(mfrom, mto, msg, path)
+                wakeMailQueue(queuedir)
+                BLATHER('queued mail to subscribers:\nTo: %s\nBcc: %s' \
+                        % (fields['To'],fields['Bcc']))
+            except:
+                BLATHER('**** failed to queue mail to %s: %s' \
+                        % (mto,formattedTraceback()))
+        txn = get_transaction()
+        if safe_hasattr(txn,'addAfterCommitHook'): txn.addAfterCommitHook(enqueue)
+        else: enqueue()
+
 InitializeClass(PageMailSupport)
 
 class GenericMailHost:
@@ -785,7 +905,42 @@ class GenericMailHost:
                 charset=fields['charset'],
                 **fields)
         else:
-            msg = """\
+            r = self.context.send(self.message(fields))
+        if r: BLATHER(r)
+
+    def canQueue(self): # -> boolean
+        """
+        Can this mailhost's messages go through the mail queue ? Only a
+        plain Mail Host, whose SMTP server we can talk to directly; the
+        others do their own queueing or message construction.
+        """
+        return self.context.meta_type == 'Mail Host'
+
+    def path(self): # -> string
+        """The mailhost's ZODB path, by which queued mail refers to it."""
+        return '/'.join(self.context.getPhysicalPath())
+
+    def server(self): # -> (host, port, uid, pwd)
+        """The SMTP server settings of a plain Mail Host."""
+        c = self.context
+        return (getattr(c,'smtp_host','localhost'),
+                int(getattr(c,'smtp_port',25)),
+                getattr(c,'smtp_uid','') or None,
+                getattr(c,'smtp_pwd','') or None)
+
+    def envelope(self, fields): # -> (sender, recipients, message text)
+        """
+        The SMTP envelope and message for a mail-out, as we would queue
+        it. The Bcc header is left out of the message.
+        """
+        mfrom = parseaddr(fields['From'])[1]
+        mto = [a for n,a in getaddresses([fields['To'],fields['Bcc']]) if a]
+        msg = re.sub(r'(?m)^Bcc: .*\n','',self.message(fields),1)
+        return mfrom, mto, msg
+
+    def message(self, fields): # -> string
+        """The rfc-822 text of a mail-out, for a non-secure mailhost."""
+        return """\
 From: %(From)s
 Reply-To: %(Reply-To)s
 To: %(To)s
@@ -804,8 +959,6 @@ Content-Type: text/plain; charset="%(charset)s"
 
 %(body)s
 """ % fields
-            r = self.context.send(msg)
-        if r: BLATHER(r)
 
 
 class PageMailinSupport:
@@ -980,7 +1133,7 @@ class MailIn:
         mail_accept_nonmembers property, or the mailin_policy property
         must be 'open'.
         """
-        def is_subscriber(e): return len(self.context.allSubscriptionsFor(e)) > 0 # XXX poor caching
+        def is_subscriber(e): return len(self.context.allSubscriptionsFor(e)) > 0
         postingpolicy = getattr(self.context.folder(),'mailin_policy',None)
         allowlist = getattr(self.context.folder(),'mail_accept_nonmembers',[])
         return (postingpolicy == 'open'
@@ -0,0 +1,313 @@
+######################################################################
+# a persistent queue for sending mail-outs in the background
+
+"""
+Outgoing mail is written to a spool directory and sent by a worker
+thread, so that page edits and comments don't wait for the mail server.
+
+Each queued message is a pickle file in the new/ subdirectory, named
+so that sorting the names gives the order in which they should be
+tried (next attempt time, then arrival). The worker claims a message
+by moving it to cur/, so several zope processes can share a queue. Sent
+messages are deleted; failed ones go back to new/ with a later retry
+time, doubling each time, until MAIL_QUEUE_MAX_ATTEMPTS is reached and
+they are moved to failed/ for an administrator to look at.
+
+Queued messages record only the path of the Mail Host they are to be
+sent through; its SMTP settings (including any password) are looked up
+in the ZODB when sending, so they are never written to the spool.
+"""
+
+import os, smtplib, threading, thread
+from cPickle import dump, load
+from time import time
+
+from Utils import BLATHER, formattedTraceback
+from Defaults import MAIL_QUEUE_DIR, MAIL_QUEUE_BATCH, MAIL_QUEUE_INTERVAL, \
+     MAIL_QUEUE_RETRY_DELAY, MAIL_QUEUE_MAX_ATTEMPTS
+
+STALE_CLAIM_AGE = 3600 # s; a claimed message older than this was abandoned
+
+class MailQueue:
+    """
+    A directory of messages waiting to be sent over SMTP.
+
+    servers is a function giving the (host, port, uid, pwd) SMTP
+    settings of the Mail Host at a path.
+    """
+    def __init__(self, path, servers=None):
+        self.path = path
+        self.servers = servers or mailHostServer
+        for d in ('new','cur','failed','tmp'):
+            d = os.path.join(path,d)
+            if not os.path.isdir(d): os.makedirs(d)
+        self.lock = thread.allocate_lock()
+        self.counter = 0
+
+    def _name(self, nexttry, attempts, unique):
+        return '%012d-%d-%s' % (nexttry, attempts, unique)
+
+    def put(self, mfrom, mto, msg, mailhost):
+        """
+        Queue a message for mfrom to send to the mto addresses, via the
+        Mail Host with path mailhost. Returns the message's queue file
+        name.
+        """
+        self.lock.acquire()
+        try:
+            self.counter += 1
+            unique = '%d.%d.%d' % (time()*1000, os.getpid(), self.counter)
+        finally:
+            self.lock.release()
+        name = self._name(time(), 0, unique)
+        tmp = os.path.join(self.path,'tmp',name)
+        f = open(tmp,'wb')
+        try:
+            dump({'from':mfrom, 'to':list(mto), 'msg':msg,
+                  'mailhost':mailhost},
+                 f, 1)
+        finally:
+            f.close()
+        os.rename(tmp, os.path.join(self.path,'new',name))
+        return name
+
+    def waiting(self):
+        """The names of all queued messages, in order."""
+        names = os.listdir(os.path.join(self.path,'new'))
+        names.sort()
+        return names
+
+    def due(self, limit=None, now=None):
+        """The names of up to limit messages ready to be (re)tried now."""
+        if now is None: now = time()
+        now = '%012d' % now
+        due = []
+        for name in self.waiting():
+            if name[:12] > now or (limit and len(due) >= limit): break
+            due.append(name)
+        return due
+
+    def failed(self):
+        """The names of messages which we gave up on."""
+        names = os.listdir(os.path.join(self.path,'failed'))
+        names.sort()
+        return names
+
+    def claim(self, name):
+        """
+        Take a queued message for sending, returning its data, or None
+        if it has already been taken by someone else. The file's
+        modification time records when it was claimed (see recover).
+        """
+        cur = os.path.join(self.path,'cur',name)
+        try:
+            os.rename(os.path.join(self.path,'new',name), cur)
+        except OSError:
+            return None
+        os.utime(cur, None)
+        f = open(cur,'rb')
+        try:     return load(f)
+        finally: f.close()
+
+    def done(self, name):
+        """Forget a claimed message which has been sent."""
+        os.remove(os.path.join(self.path,'cur',name))
+
+    def retry(self, name):
+        """
+        Return a claimed message to the queue with a later retry time,
+        or move it to failed/ if it has had too many attempts.
+        """
+        nexttry, attempts, unique = name.split('-',2)
+        attempts = int(attempts) + 1
+        cur = os.path.join(self.path,'cur',name)
+        if attempts >= MAIL_QUEUE_MAX_ATTEMPTS:
+            os.rename(cur, os.path.join(self.path,'failed',name))
+            BLATHER('**** gave up sending queued mail %s after %d attempts' \
+                    % (name, attempts))
+            return None
+        delay = MAIL_QUEUE_RETRY_DELAY * 2**(attempts-1)
+        newname = self._name(time() + delay, attempts, unique)
+        os.rename(cur, os.path.join(self.path,'new',newname))
+        return newname
+
+    def recover(self, age=STALE_CLAIM_AGE):
+        """
+        Return messages claimed more than age seconds ago (by a process
+        which died while sending, presumably) to the queue.
+        """
+        cur = os.path.join(self.path,'cur')
+        for name in os.listdir(cur):
+            try:
+                if os.path.getmtime(os.path.join(cur,name)) < time() - age:
+                    self.retry(name)
+            except OSError:
+                pass
+
+    def process(self, batch=MAIL_QUEUE_BATCH):
+        """
+        Try to send up to batch messages which are due, using one SMTP
+        connection per mail host. Returns the number sent.
+        """
+        mailhosts, order = {}, []
+        for name in self.due(limit=batch):
+            entry = self.claim(name)
+            if entry is None: continue
+            mailhost = entry['mailhost']
+            if not mailhosts.has_key(mailhost):
+                mailhosts[mailhost] = []
+                order.append(mailhost)
+            mailhosts[mailhost].append((name,entry))
+        sent = 0
+        for mailhost in order:
+            try:
+                server = self.servers(mailhost)
+            except:
+                BLATHER('**** could not find mail host %s to send queued mail: %s' \
+                        % (mailhost, formattedTraceback()))
+                for name, entry in mailhosts[mailhost]: self.retry(name)
+                continue
+            try:
+                sent += self.sendBatch(server, mailhosts[mailhost])
+            except:
+                # sendBatch has put this batch back; carry on with the others
+                BLATHER('**** failed to send queued mail via %s: %s' \
+                        % (mailhost, formattedTraceback()))
+        return sent
+
+    def sendBatch(self, server, entries):
+        """Send some claimed messages through one SMTP server."""
+        host, port, uid, pwd = server
+        sent = 0
+        try:
+            smtp = smtplib.SMTP(host, port)
+        except:
+            BLATHER('**** could not connect to %s:%s to send queued mail: %s' \
+                    % (host, port, formattedTraceback()))
+            for name, entry in entries: self.retry(name)
+            return sent
+        try:
+            if uid:
+                try:
+                    smtp.login(uid, pwd)
+                except:
+                    BLATHER('**** could not log in to %s:%s to send queued mail: %s' \
+                            % (host, port, formattedTraceback()))
+                    return sent
+            for name, entry in entries:
+                try:
+                    smtp.sendmail(entry['from'], entry['to'], entry['msg'])
+                    self.done(name)
+                    sent += 1
+                except (smtplib.SMTPException, OSError, IOError):
+                    BLATHER('**** failed to send queued mail %s: %s' \
+                            % (name, formattedTraceback()))
+                    self.retry(name)
+        finally:
+            # anything not yet dealt with (eg after a lost connection)
+            # goes back in the queue
+            for name, entry in entries:
+                if os.path.exists(os.path.join(self.path,'cur',name)):
+                    self.retry(name)
+            try: smtp.quit()
+            except: pass
+        BLATHER('sent %d queued mail(s) via %s:%s' % (sent, host, port))
+        return sent
+
+
+class MailQueueWorker(threading.Thread):
+    """
+    A daemon thread which sends a mail queue's messages, checking it every
+    interval seconds or when woken up.
+    """
+    def __init__(self, queue, interval=MAIL_QUEUE_INTERVAL):
+        threading.Thread.__init__(self, name='ZWiki mail queue worker')
+        self.setDaemon(1)
+        self.queue = queue
+        self.interval = interval
+        self.event = threading.Event()
+        self.stopping = 0
+
+    def wake(self):
+        self.event.set()
+
+    def stop(self):
+        self.stopping = 1
+        self.event.set()
+
+    def run(self):
+        while not self.stopping:
+            self.event.clear()
+            try:
+                self.queue.recover()
+                while self.queue.process() and not self.stopping:
+                    pass
+            except:
+                BLATHER('**** mail queue worker error: %s' % formattedTraceback())
+            self.event.wait(self.interval)
+
+
+def mailHostServer(path):
+    """
+    Look up the SMTP settings of the Mail Host at path, with a ZODB
+    connection of our own (the worker thread has none).
+    """
+    try: import Zope2 as Zope
+    except ImportError: import Zope
+    from Mail import GenericMailHost
+    app = Zope.app()
+    try:
+        return GenericMailHost(app.unrestrictedTraverse(path)).server()
+    finally:
+        app._p_jar.close()
+
+# one queue and worker per spool directory, per process
+QUEUES = {}
+QUEUESLOCK = thread.allocate_lock()
+
+def defaultMailQueueDir():
+    """The configured mail queue directory, or one in zope's var dir."""
+    if MAIL_QUEUE_DIR: return MAIL_QUEUE_DIR
+    try: return os.path.join(CLIENT_HOME,'zwikimailqueue')
+    except NameError: return None
+
+def mailQueue(path=None):
+    """
+    Get the mail queue for this directory (or the default one), starting
+    its worker thread if needed. Returns None if there's no usable
+    directory.
+    """
+    path = path or defaultMailQueueDir()
+    if not path: return None
+    QUEUESLOCK.acquire()
+    try:
+        if not QUEUES.has_key(path):
+            try:
+                queue = MailQueue(path)
+            except (OSError, IOError):
+                BLATHER('**** could not set up mail queue in %s: %s' \
+                        % (path, formattedTraceback()))
+                return None
+            worker = MailQueueWorker(queue)
+            worker.start()
+            QUEUES[path] = (queue, worker)
+        return QUEUES[path][0]
+    finally:
+        QUEUESLOCK.release()
+
+def wakeMailQueue(path=None):
+    """Ask a mail queue's worker to check the queue now."""
+    path = path or defaultMailQueueDir()
+    if QUEUES.has_key(path): QUEUES[path][1].wake()
+
+def stopMailQueue(path=None):
+    """Stop a mail queue's worker thread (the queue itself stays on disk)."""
+    path = path or defaultMailQueueDir()
+    QUEUESLOCK.acquire()
+    try:
+        if QUEUES.has_key(path):
+            queue, worker = QUEUES[path]
+            del QUEUES[path]
+            worker.stop()
+    finally:
+        QUEUESLOCK.release()
@@ -22,23 +22,58 @@ class Outline:
     """
     _parentmap = {}
     _childmap =  {}
-    _nesting =   []
+    _nesting =   [] # no longer used, the nesting is derived on demand
     def parentmap(self): return self._parentmap
-    def setParentmap(self,parentmap): self._parentmap = parentmap
+    def setParentmap(self,parentmap):
+        self._parentmap = parentmap
+        self._v_nodes = None
+        self.updateNesting()
     def childmap(self): return self._childmap
-    def setChildmap(self,childmap): self._childmap = childmap
-    def nesting(self): return self._nesting
-    def setNesting(self,nesting): self._nesting = nesting
+    def setChildmap(self,childmap):
+        self._childmap = childmap
+        self.updateNesting()
+    def nesting(self):
+        """
+        Return the nesting, deriving it from the childmap if needed.
+
+        The nesting is not stored persistently but kept in a volatile
+        attribute, so mutators need only update the parentmap and
+        childmap.
+        """
+        nesting = getattr(self,'_v_nesting',None)
+        if nesting is None:
+            nesting = self._v_nesting = self.offspring(self.roots())
+        return nesting
+    def setNesting(self,nesting):
+        self._v_nesting = nesting
+        self._v_flatindex = None
     def nodes(self):
         """Return a sorted list of all nodes."""
-        nodes = self.parentmap().keys()
-        nodes.sort()
-        return nodes
-    def nodeCount(self): return len(self.nodes())
-    def hasNode(self,node): return node in self.nodes()
+        nodes = getattr(self,'_v_nodes',None)
+        if nodes is None:
+            nodes = self.parentmap().keys()
+            nodes.sort()
+            self._v_nodes = nodes
+        return nodes[:]
+    def nodeCount(self): return len(self.parentmap())
+    def hasNode(self,node): return self.parentmap().has_key(node)
     def flat(self):
         """Return a flattened version of the outline, preserving order."""
-        return flatten(self.nesting())
+        return self.flatIndex()[0][:]
+    def flatIndex(self):
+        """
+        Return the flattened outline and a dictionary of node positions.
+
+        A node appearing more than once (because it has several parents)
+        is given the position of its first appearance. Both are derived
+        along with the nesting and used for quick navigation.
+        """
+        index = getattr(self,'_v_flatindex',None)
+        if index is None:
+            flat, positions = flatten(self.nesting()), {}
+            for i in range(len(flat)-1,-1,-1): positions[flat[i]] = i
+            index = self._v_flatindex = (flat, positions)
+        return index
     def roots(self):
         """Return a sorted list of the root nodes."""
         return filter(lambda x:not self.parents(x), self.nodes())
@@ -53,6 +88,7 @@ class Outline:
         preserve the order of children, which complicates things badly.
         """
         nodes = self.nodes()
+        isnode = self.parentmap().has_key
         # XXX still problems with things not getting updated properly
         oldchildmap = self.childmap()
         if reset:
@@ -62,10 +98,9 @@ class Outline:
             childmap = self.childmap() or {} 
             # remove any no-longer-existing nodes from childmap
             for p in childmap.keys()[:]:
-                if not p in nodes: del childmap[p]
+                if not isnode(p): del childmap[p]
                 else:
-                    for c in childmap[p][:]: # a copy
-                        if not c in nodes: childmap[p].remove(c)
+                    childmap[p] = filter(isnode, childmap[p])
         # make sure each existing node appears in the childmap
         for c in nodes:
             for p in self.parents(c):
@@ -73,12 +108,13 @@ class Outline:
                 if not childmap.has_key(p): childmap[p] = [c]
                 elif not c in childmap[p]: childmap[p].append(c)
         # add a childmap entry for any nodes we missed (non-parents)
-        for l in filter(lambda x:x not in childmap.keys(),nodes):
-            childmap[l] = []
+        for l in nodes:
+            if not childmap.has_key(l): childmap[l] = []
         self.setChildmap(childmap)
     def updateNesting(self):
-        """Regenerate nesting from childmap and roots."""
-        self.setNesting(self.offspring(self.roots()))
+        """Forget the nesting, so that it will be regenerated when needed."""
+        self._v_nesting = None
+        self._v_flatindex = None
     def update(self):
         """Regenerate everything from the parentmap."""
         self.updateChildmap()
@@ -86,6 +122,26 @@ class Outline:
     def __init__(self,parentmap={}):
         self.setParentmap(parentmap)
         self.update()
+
+    # The mutators below adjust just the parentmap and childmap entries
+    # of the node concerned, its parents and its children, so they take
+    # time proportional to those and not to the size of the outline. The
+    # update flag is for backwards compatibility; a full update is never
+    # needed.
+
+    def _addChild(self,parent,node):
+        """Append node to parent's children in the childmap, if needed."""
+        children = self._childmap.get(parent)
+        if children is None: self._childmap[parent] = [node]
+        elif not node in children: children.append(node)
+    def _removeChild(self,parent,node):
+        """Remove node from parent's children in the childmap, if there."""
+        children = self._childmap.get(parent)
+        if children and node in children: children.remove(node)
+    def _changed(self):
+        """Note that the maps have been modified in place."""
+        self.setParentmap(self._parentmap)
+        self.setChildmap(self._childmap)
     def add(self,node,parents=[],update=1):
         """
         Add node to the outline, under the specified parents if any.
@@ -93,19 +149,28 @@ class Outline:
         If node is already present, it will be reparented.
         """
         parentmap = self.parentmap()
+        for p in parentmap.get(node,[]): self._removeChild(p,node)
         parentmap[node] = parents[:] # use a copy
-        self.setParentmap(parentmap)
-        if update: self.update()
+        for p in parents: self._addChild(p,node)
+        if not self._childmap.has_key(node): self._childmap[node] = []
+        self._changed()
     def delete(self,node,update=1):
         """
         Remove node from the outline.
+
+        Any children are moved under node's parents.
         """
-        for c in self.children(node):
-            self.reparent(c,self.parents(node),update=0)
+        parents = self.parents(node)
+        children = self._childmap.get(node,[])[:]
+        children.sort()
+        for c in children:
+            self.reparent(c,parents,update=0)
+        for p in parents: self._removeChild(p,node)
         parentmap = self.parentmap()
         del parentmap[node]
-        self.setParentmap(parentmap)
-        if update: self.update()
+        # keep the entry if something still names node as a parent
+        if not self._childmap.get(node,1): del self._childmap[node]
+        self._changed()
     def replace(self,node,newnode,update=1):
         """
         Replace node with newnode in the outline.
@@ -113,37 +178,34 @@ class Outline:
         If node wasn't there, just add newnode. This is useful for rename().
         Should this sort of robustness check be done here or there ?
 
-        Tries to preserve node's ordering among it's siblings, as in
-        updateChildMap.
+        Tries to preserve node's ordering among it's siblings.
         """
-        parentmap = self.parentmap()
+        parentmap, childmap = self.parentmap(), self.childmap()
         # replace node with newnode, preserving node's parents
         parents = self.parents(node)
         if parentmap.has_key(node): del parentmap[node]
         parentmap[newnode] = parents
         # reparent node's children under newnode
-        for c in filter(lambda x:node in parentmap[x],parentmap.keys()):
-            parentmap[c].remove(node)
-            parentmap[c].append(newnode)
-        self.setParentmap(parentmap)
-
-        # tweak childmap before updateChildMap, to preserve node's position
-        childmap = self.childmap()
-        for p in childmap.keys():
-            if node in childmap[p]:
-                childmap[p][childmap[p].index(node)] = newnode
-        self.setChildmap(childmap)
-
-        if update: self.update()
+        children = childmap.get(node,[])
+        if node in children: children[children.index(node)] = newnode
+        for c in children:
+            if parentmap.has_key(c) and node in parentmap[c]:
+                parentmap[c].remove(node)
+                parentmap[c].append(newnode)
+        if childmap.has_key(node): del childmap[node]
+        childmap[newnode] = children
+        # put newnode in node's place among it's siblings
+        for p in parents:
+            siblings = childmap.get(p)
+            if siblings and node in siblings:
+                siblings[siblings.index(node)] = newnode
+            else:
+                self._addChild(p,newnode)
+        self._changed()
     def reparent(self,node,newparents,update=1):
         """
         Change node's parents to newparents in the outline.
         """
-        # help prepare childmap for updateChildMap 
-        childmap = self.childmap()
-        for p in self.parents(node): childmap[p].remove(node)
-        self.setChildmap(childmap)
-            
         self.add(node,newparents,update)
     def reorder(self,node,child=None):
         """
@@ -168,23 +230,23 @@ class Outline:
         """
         Get the first node in the outline.
         """
-        list = self.flat()
+        list = self.flatIndex()[0]
         if list: return list[0]
         else: return None
     def last(self):
         """
         Get the last node in the outline.
         """
-        list = self.flat()
+        list = self.flatIndex()[0]
         if list: return list[-1]
         else: return None
     def next(self,node,wrap=0):
         """
         Get the next node in the outline.
         """
-        list = self.flat()
-        if node in list:
-            i = list.index(node)
+        list, positions = self.flatIndex()
+        if positions.has_key(node):
+            i = positions[node]
             if i < len(list)-1: return list[i+1]
             elif wrap: return list[0]
         return None
@@ -192,9 +254,9 @@ class Outline:
         """
         Get the previous node in the outline.
         """
-        list = self.flat()
-        if node in list:
-            i = list.index(node)
+        list, positions = self.flatIndex()
+        if positions.has_key(node):
+            i = positions[node]
             if i > 0: return list[i-1]
             elif wrap: return list[-1]
         return None
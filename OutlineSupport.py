@@ -188,7 +188,7 @@ class ParentsProperty:
             BLATHER("adjusting %s's parents from %s to %s" % 
                  (self.pageName(), parents, cleanedupparents))
             self.setParents(cleanedupparents)
-            self.index_object() #XXX only need to update parents index & metadata
+            self.reindexChanged(['parents'])
 
 InitializeClass(ParentsProperty) 
 
@@ -405,7 +405,8 @@ class OutlineManager:
         # finally - update our parents property, the outline cache, and catalog
         self.setParents(uniqueparents) 
         self.wikiOutline().reparent(self.pageName(),uniqueparents)
-        self.index_object()
+        self.clearRenderCache()
+        self.reindexChanged(['parents'])
 
         # send mail if appropriate
         self.sendMailToEditSubscribers(
@@ -741,7 +742,7 @@ class OutlineRendering:
         # XXX will not match ? clean up
         if hierarchy == '<ul>\n</ul>':
             self.setParents([])
-            self.index_object()
+            self.reindexChanged(['parents'])
             hierarchy = self.renderNesting(
                 nesting, here, 
                 enlarge_current=enlarge_current,
@@ -787,7 +788,7 @@ class OutlineRendering:
         # special case: if parent seems to be missing, reset XXX
         if len(renderlist) == 2 :
             self.setParents([])
-            self.index_object()
+            self.reindexChanged(['parents'])
             renderlist = self.nestingAsRenderList(nesting, here)
 
         return {'contentsUrl':self.contentsUrl(), 'hierarchy':renderlist}
@@ -88,19 +88,59 @@ bracketmatch        = re.compile(r'(\[\[?|\(\()([^\n\]]+)(\]\]?|\)\))')
 #      in latin and other languages so things are more likely to "just
 #      work" for more users.
 
-# we'll set up the following strings to use when building the regexps:
-# U:   'A|B|C|... '
-# L:   'a|b|c|...'
+# we'll set up the following lists of the utf8-encoded upper & lower-case
+# letters, and from them the strings to use when building the regexps:
+# U:   matches any upper-case letter, like 'A|B|C|...'
+# L:   matches any lower-case letter, like 'a|b|c|...'
 # Ubr: '[ABC...]'
 # Lbr: '[abc...]'
-# where A, b etc. are the utf8-encoded upper & lower-case letters.
+# UL:  a character class matching any byte of a letter (or |)
+def charclass(chars):
+    """
+    Make a regexp character class matching any of chars (single
+    bytes), using ranges where possible: '[A-Za-z\\xc3]'.
+    """
+    def esc(c):
+        if c.isalnum() and c < '\x80': return c
+        return '\\x%02x' % ord(c)
+    codes = sorted(set(map(ord, chars)))
+    ranges = []
+    for c in codes:
+        if ranges and ranges[-1][1] == c-1: ranges[-1][1] = c
+        else: ranges.append([c,c])
+    parts = []
+    for first, last in ranges:
+        if last == first: parts.append(esc(chr(first)))
+        elif last == first+1: parts.append(esc(chr(first)) + esc(chr(last)))
+        else: parts.append('%s-%s' % (esc(chr(first)), esc(chr(last))))
+    return '[%s]' % ''.join(parts)
+
+def lettersexpr(letters):
+    """
+    Make a regexp matching any one of letters (utf8-encoded strings).
+    This matches the same as 'A|B|C|...', but is much quicker: the
+    single-byte letters become one character class, and the multi-byte
+    letters are grouped by their leading byte, eg [A-Z]|\\xc3[\\x80-\\x86].
+    (utf8 never encodes one letter as a prefix of another, so the order
+    of alternatives doesn't matter.)
+    """
+    singles, groups = [], {}
+    for c in letters:
+        if len(c) == 1: singles.append(c)
+        else: groups.setdefault(c[0], []).append(c[1:])
+    alternatives = []
+    if singles: alternatives.append(charclass(singles))
+    for lead in sorted(groups.keys()):
+        rest = lettersexpr(groups[lead])
+        if '|' in rest: rest = '(?:%s)' % rest
+        alternatives.append(charclass(lead)[1:-1] + rest)
+    return '|'.join(alternatives)
+
 try:
     import locale
     lang, encoding = locale.getlocale()
-    U =           '|'.join([c.encode('utf8') for c in unicode(string.uppercase, encoding)])
-    L =           '|'.join([c.encode('utf8') for c in unicode(string.lowercase, encoding)])
-    Ubr = '[%s]' % ''.join([c.encode('utf8') for c in unicode(string.uppercase, encoding)])
-    Lbr = '[%s]' % ''.join([c.encode('utf8') for c in unicode(string.lowercase, encoding)])
+    uppers = [c.encode('utf8') for c in unicode(string.uppercase, encoding)]
+    lowers = [c.encode('utf8') for c in unicode(string.lowercase, encoding)]
     relocaleflag = r'(?L)'
     wordboundary = r'\b'
 except (TypeError,LookupError):
@@ -123,13 +163,19 @@ except (TypeError,LookupError):
     # http://zwiki.org/InternationalCharactersInPageNames
     uppercase = string.uppercase + '\xc3\x80\xc3\x81\xc3\x82\xc3\x83\xc3\x84\xc3\x85\xc3\x86\xc3\x88\xc3\x89\xc3\x8a\xc3\x8b\xc3\x8c\xc3\x8d\xc3\x8e\xc3\x8f\xc3\x92\xc3\x93\xc3\x94\xc3\x95\xc3\x96\xc3\x98\xc3\x99\xc3\x9a\xc3\x9b\xc3\x9c\xc3\x9d\xc3\x87\xc3\x90\xc3\x91\xc3\x9e'
     lowercase = string.lowercase + '\xc3\xa0\xc3\xa1\xc3\xa2\xc3\xa3\xc3\xa4\xc3\xa5\xc3\xa6\xc3\xa8\xc3\xa9\xc3\xaa\xc3\xab\xc3\xac\xc3\xad\xc3\xae\xc3\xaf\xc3\xb2\xc3\xb3\xc3\xb4\xc3\xb5\xc3\xb6\xc3\xb8\xc3\xb9\xc3\xba\xc3\xbb\xc3\xbc\xc3\xbd\xc3\xbf\xc2\xb5\xc3\x9f\xc3\xa7\xc3\xb0\xc3\xb1\xc3\xbe'
-    U =           '|'.join([c.encode('utf8') for c in unicode(uppercase,'utf-8')])
-    L =           '|'.join([c.encode('utf8') for c in unicode(lowercase,'utf-8')])
-    Ubr = '[%s]' % ''.join([c.encode('utf8') for c in unicode(uppercase,'utf-8')])
-    Lbr = '[%s]' % ''.join([c.encode('utf8') for c in unicode(lowercase,'utf-8')])
+    uppers = [c.encode('utf8') for c in unicode(uppercase,'utf-8')]
+    lowers = [c.encode('utf8') for c in unicode(lowercase,'utf-8')]
     relocaleflag = ''
     wordboundary = '(?<![A-Za-z0-9\x80-\xff])' 
 
+U   = lettersexpr(uppers)
+L   = lettersexpr(lowers)
+Ubr = '[%s]' % ''.join(uppers)
+Lbr = '[%s]' % ''.join(lowers)
+# this was '[%s]' % (U+L) when U and L were plain alternations, so it
+# also excludes |; kept that way to link exactly the same things
+UL  = charclass('|'.join(uppers) + '|'.join(lowers))
+
 # the basic bare wikiname regexps
 # ?: means "don't remember", apparently a performance optimization
 wikiname1 = r'%s%s(?:%s)+(?:%s)+(?:%s)(?:%s|%s)*[0-9]*' % (relocaleflag,wordboundary,U,L,U,U,L)
@@ -146,7 +192,7 @@ wikiname3        = r'(?:%s|%s)' % (wikiname1, wikiname2)
 # cautiously commented  --StefanRank
 # more trouble: the XML spec also allows &---WikiName---;
 #wikiname4        = r'(?:(?<!&)%s|(?<=&)%s(?![%s;]))' % (wikiname3, wikiname3, U+L)
-wikiname4        = r'(?:(?<!&)%s(?![%s])|(?<=&)%s(?![%s;]))' % (wikiname3, U+L, wikiname3, U+L)
+wikiname4        = r'(?:(?<!&)%s(?!%s)|(?<=&)%s(?!%s|;))' % (wikiname3, UL, wikiname3, UL)
 
 wikiname         = r'!?(%s)' %(wikiname4)
 
@@ -160,6 +206,17 @@ localwikilink1   = r'(?:%s|%s|%s|%s)' % (wikiname4,bracketedexpr,doubleparenthes
 localwikilink    = r'!?(%s)' % (localwikilink1)
 interwikilink    = r'!?((?P<local>%s):(?P<remote>\w%s))' % (localwikilink1,urlchars) # local wiki link, a colon, one word char, one or more url chars
 anywikilinkexpr  = re.compile(r'(%s|%s)' % (interwikilink,wikilink))
+# these are used for each link found when rendering, and are too big
+# to leave to the re module's small cache, so compile them once here
+wikinameexpr     = re.compile(wikiname)
+wholewikinameexpr = re.compile(r'^%s$' % wikiname)
+wikilinkexpr     = re.compile(wikilink)
+interwikilinkexpr = re.compile(interwikilink)
+urlexpr          = re.compile(url)
+hashnumberlinkexpr = re.compile(hashnumberexpr)
+singlebracketedlinkexpr = re.compile(singlebracketedexpr)
+doublebracketedlinkexpr = re.compile(doublebracketedexpr)
+doubleparenthesislinkexpr = re.compile(doubleparenthesisexpr)
 markedwikilinkexpr  = re.compile(r'<zwiki>(.*?)</zwiki>')
 untitledwikilinkexpr = re.compile(r'<a href="([^"/]*/)*(?P<page>[^/"]*)" title="">.*?</a>')
 wikinamewords    = r'((%s(?!%s))+|%s%s+|[0-9]+)'%(Ubr,Lbr,Ubr,Lbr)
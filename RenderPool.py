@@ -0,0 +1,157 @@
+######################################################################
+# a pool of processes for formatting page text
+
+"""
+Formatting rst or stx text is CPU-heavy python code which holds the
+global interpreter lock, so saving or previewing one big page slows
+every other thread in the zope process. When RENDER_POOL_SIZE is set,
+the page types send this work to a pool of separate python processes
+(renderworker.py) instead, which can use other cores. Text and
+settings go to the worker as pickles, the HTML comes back the same way.
+
+Texts smaller than RENDER_POOL_MIN_SIZE (not worth the trip) or larger
+than RENDER_POOL_MAX_SIZE are formatted in process, as is everything
+when the pool is disabled or not supported (non-posix systems), or if
+a worker fails. A worker which takes longer than RENDER_POOL_TIMEOUT is
+killed and RenderTimeout is raised.
+"""
+
+import os, sys, subprocess, thread, threading
+from time import time
+
+from Utils import BLATHER, formattedTraceback
+from Defaults import RENDER_POOL_SIZE, RENDER_POOL_TIMEOUT, \
+     RENDER_POOL_MIN_SIZE, RENDER_POOL_MAX_SIZE, RENDER_POOL_MAX_REQUESTS
+from renderworker import send, receive, Timeout
+
+WORKERSCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'renderworker.py')
+
+class RenderTimeout(Exception): pass
+
+class WorkerError(Exception): pass
+
+class RenderWorker:
+    """
+    One worker process, used by one thread at a time.
+    """
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, WORKERSCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        self.requests = 0
+        try: products = list(sys.modules['Products'].__path__)
+        except (KeyError, AttributeError): products = []
+        send(self.process.stdin, {'path':sys.path, 'products':products})
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def call(self, module, name, args=(), kw={}, timeout=RENDER_POOL_TIMEOUT):
+        """
+        Call module.name(*args, **kw) in the worker and return the
+        result. Raises RenderTimeout or WorkerError if that fails.
+        """
+        self.requests += 1
+        try:
+            send(self.process.stdin, (module, name, args, kw))
+            reply = receive(self.process.stdout, time() + timeout)
+        except Timeout:
+            raise RenderTimeout, '%s.%s took more than %ds' % (module, name, timeout)
+        except (IOError, OSError, EOFError), e:
+            raise WorkerError, str(e)
+        if reply is None: raise WorkerError, 'worker exited'
+        ok, result = reply
+        if not ok: raise WorkerError, result
+        return result
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+            if self.alive(): os.kill(self.process.pid, 9)
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+
+
+class RenderPool:
+    """
+    Up to size worker processes, started as needed and reused.
+    Callers wait (without holding the interpreter lock) when all of
+    them are busy.
+    """
+    def __init__(self, size, timeout=RENDER_POOL_TIMEOUT,
+                 maxrequests=RENDER_POOL_MAX_REQUESTS):
+        self.size, self.timeout, self.maxrequests = size, timeout, maxrequests
+        self.slots = threading.Semaphore(size)
+        self.lock = thread.allocate_lock()
+        self.idle = []
+
+    def call(self, module, name, args=(), kw={}):
+        self.slots.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                worker = None
+                while self.idle and worker is None:
+                    worker = self.idle.pop()
+                    if not worker.alive(): worker = None
+            finally:
+                self.lock.release()
+            if worker is None: worker = RenderWorker()
+            try:
+                result = worker.call(module, name, args, kw, self.timeout)
+            except:
+                worker.stop()
+                raise
+            if worker.requests >= self.maxrequests:
+                worker.stop()
+            else:
+                self.lock.acquire()
+                self.idle.append(worker)
+                self.lock.release()
+            return result
+        finally:
+            self.slots.release()
+
+    def stop(self):
+        """Stop the idle workers (busy ones are stopped by their users)."""
+        self.lock.acquire()
+        try:
+            for worker in self.idle: worker.stop()
+            self.idle = []
+        finally:
+            self.lock.release()
+
+
+POOL = None
+POOLLOCK = thread.allocate_lock()
+
+def renderPool():
+    """Get the render pool, or None if it's disabled or unsupported."""
+    global POOL
+    if not RENDER_POOL_SIZE or os.name != 'posix': return None
+    POOLLOCK.acquire()
+    try:
+        if POOL is None: POOL = RenderPool(RENDER_POOL_SIZE)
+        return POOL
+    finally:
+        POOLLOCK.release()
+
+def renderInPool(size, function, *args, **kw):
+    """
+    Call function (a module-level function which the workers can
+    import) with these arguments in the render pool, or right here if
+    the pool is disabled, size (the amount of text involved) is out of
+    the pool's range, or the pool fails. Returns the function's result.
+    """
+    pool = renderPool()
+    if pool and RENDER_POOL_MIN_SIZE <= size <= RENDER_POOL_MAX_SIZE:
+        try:
+            return pool.call(function.__module__, function.__name__, args, kw)
+        except WorkerError, e:
+            BLATHER('render pool failed, formatting in process (%s)' % e)
+        except (IOError, OSError):
+            BLATHER('render pool failed, formatting in process (%s)' \
+                    % formattedTraceback())
+    return function(*args, **kw)
@@ -0,0 +1,190 @@
+######################################################################
+# spam pattern matching for edits
+
+"""
+Checking edits against spam patterns.
+
+The patterns come from a wiki's spampatterns property or from the
+global zwiki spam blacklist (ZWIKI_SPAMPATTERNS_URL). They are compiled
+into a single regular expression, so edited text is scanned once, and
+compiled expressions are cached by pattern list. The global blacklist
+is fetched by a background thread every ZWIKI_SPAMPATTERNS_TTL seconds
+and saved to a local file, which is used until the first fetch
+completes (eg after a restart); edits never wait for the network.
+"""
+
+import os, re, socket, thread, threading, urllib2
+from time import time
+
+from Utils import BLATHER, LRUCache, stripList
+from Defaults import ZWIKI_SPAMPATTERNS_URL, ZWIKI_SPAMPATTERNS_TIMEOUT, \
+     ZWIKI_SPAMPATTERNS_TTL, ZWIKI_SPAMPATTERNS_FILE
+
+def parseSpamPatterns(t):
+    """
+    Parse the contents of spampatterns.txt, returning any patterns as a
+    list of strings.
+
+    spampatterns.txt version 1 may contain:
+
+    - comments - lines beginning with #
+    - whitespace at the start or end of lines, or blank lines
+    - a line of the form "zwiki-spampatterns-version: 1"; assumed if not present
+    """
+    return [p for p in stripList(t.split('\n'))
+            if not (p.startswith('#') or p.startswith('zwiki-spampatterns-version:'))]
+
+# inline flags (which apply to the whole expression), named groups and
+# backreferences (which would refer to the wrong group when combined)
+standaloneexpr = re.compile(r'\(\?[iLmsuxP]|\\\d')
+
+class SpamPatterns:
+    """
+    A list of spam patterns compiled for matching in one pass.
+
+    Patterns which aren't valid regular expressions are logged and
+    ignored. Patterns which would match differently inside a combined
+    expression (with inline flags, named groups or backreferences) are
+    compiled on their own. If the combined expression can't be compiled
+    (eg python's limit on groups is exceeded) we split it into as few
+    expressions as possible.
+    """
+    def __init__(self, patterns):
+        self.patterns = []
+        for p in patterns:
+            try:
+                re.compile(p)
+                self.patterns.append(p)
+            except re.error, e:
+                BLATHER('ignoring bad spam pattern %s (%s)' % (p,e))
+        combinable = [p for p in self.patterns if not standaloneexpr.search(p)]
+        standalone = [p for p in self.patterns if standaloneexpr.search(p)]
+        self.regexps = self.compile(combinable) + map(re.compile, standalone)
+
+    def compile(self, patterns):
+        if not patterns: return []
+        try:
+            return [re.compile('|'.join(['(?:%s)' % p for p in patterns]))]
+        except (re.error, AssertionError, OverflowError):
+            if len(patterns) == 1: raise
+            half = len(patterns) / 2
+            return self.compile(patterns[:half]) + self.compile(patterns[half:])
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def search(self, t):
+        """Return the first spam pattern match in t, or None."""
+        for r in self.regexps:
+            m = r.search(t)
+            if m: return m
+        return None
+
+# compiled pattern lists, by their contents
+COMPILED = LRUCache(20)
+
+def spamPatterns(patterns):
+    """Get the compiled form of a list of pattern strings, cached."""
+    key = tuple(patterns)
+    compiled = COMPILED.get(key)
+    if compiled is None:
+        compiled = SpamPatterns(patterns)
+        COMPILED.set(key, compiled)
+    return compiled
+
+def spamPatternsFile():
+    """Where to keep the last copy of the global blacklist, or None."""
+    if ZWIKI_SPAMPATTERNS_FILE: return ZWIKI_SPAMPATTERNS_FILE
+    try: return os.path.join(CLIENT_HOME,'zwikispampatterns.txt')
+    except NameError: return None
+
+class RemoteSpamPatterns:
+    """
+    The global spam blacklist, as last fetched. patterns() returns
+    immediately with what we have, starting a refresh in the background
+    if that is older than the TTL.
+    """
+    def __init__(self, url=ZWIKI_SPAMPATTERNS_URL, path=None,
+                 ttl=ZWIKI_SPAMPATTERNS_TTL, timeout=ZWIKI_SPAMPATTERNS_TIMEOUT):
+        self.url, self.path, self.ttl, self.timeout = url, path, ttl, timeout
+        self.lock = thread.allocate_lock()
+        self.list = None
+        self.fetched = 0
+        self.refreshing = None
+
+    def patterns(self, useragent='Zwiki'):
+        self.lock.acquire()
+        try:
+            if self.list is None: self.list = parseSpamPatterns(self.readFile())
+            if time() - self.fetched > self.ttl and self.refreshing is None:
+                self.refreshing = threading.Thread(
+                    target=self.refresh, args=(useragent,),
+                    name='ZWiki spam blacklist refresh')
+                self.refreshing.setDaemon(1)
+                self.refreshing.start()
+            return self.list
+        finally:
+            self.lock.release()
+
+    def readFile(self):
+        if self.path and os.path.exists(self.path):
+            try:
+                f = open(self.path)
+                try: return f.read()
+                finally: f.close()
+            except IOError, e:
+                BLATHER('failed to read %s (%s)' % (self.path,e))
+        return ''
+
+    def writeFile(self, t):
+        if not self.path: return
+        tmp = '%s.%d' % (self.path, os.getpid())
+        try:
+            f = open(tmp,'w')
+            try: f.write(t)
+            finally: f.close()
+            os.rename(tmp, self.path)
+        except (IOError, OSError), e:
+            BLATHER('failed to save spam blacklist to %s (%s)' % (self.path,e))
+
+    def fetch(self, useragent='Zwiki'):
+        """Download the blacklist, returning its text."""
+        BLATHER('checking zwiki.org spam blacklist')
+        req = urllib2.Request(self.url, None, {'User-Agent':useragent})
+        try:
+            return urllib2.urlopen(req, timeout=self.timeout).read()
+        except TypeError: # python < 2.6 urlopen has no timeout
+            saved = socket.getdefaulttimeout()
+            socket.setdefaulttimeout(self.timeout)
+            try: return urllib2.urlopen(req).read()
+            finally: socket.setdefaulttimeout(saved)
+
+    def refresh(self, useragent='Zwiki'):
+        try:
+            try:
+                t = self.fetch(useragent)
+            except (urllib2.URLError, socket.error, IOError), e:
+                BLATHER('failed to read blacklist, keeping the old one (%s)' % e)
+                t = None
+            if t is not None:
+                self.writeFile(t)
+                self.list = parseSpamPatterns(t)
+        finally:
+            # try again after the TTL in any case
+            self.lock.acquire()
+            self.fetched = time()
+            self.refreshing = None
+            self.lock.release()
+
+REMOTE = None
+REMOTELOCK = thread.allocate_lock()
+
+def remoteSpamPatterns(useragent='Zwiki'):
+    """The global blacklist's patterns, without waiting for the network."""
+    global REMOTE
+    REMOTELOCK.acquire()
+    try:
+        if REMOTE is None: REMOTE = RemoteSpamPatterns(path=spamPatternsFile())
+    finally:
+        REMOTELOCK.release()
+    return REMOTE.patterns(useragent)
@@ -16,30 +16,54 @@ import re
 # create a new "ZCTextIndex Lexicon" and recreate the
 # "SearchableText" and "Title" indexes with your new lexicon
 
+# These run over the full text of each page whenever it's indexed, so
+# they try to be quick: text is decoded once, by the splitter, words
+# are generated rather than collected in lists, html is stripped only
+# from text which contains some, and the normalizer lowercases all
+# words in one go. The splitters' process() returns an iterator for the
+# next pipeline element (normally the case normalizer, which returns a
+# list); processGlob() (used for queries) returns a list.
+
 enc = 'utf-8'
 
+# runs of ideographic/syllabic characters (Han, kana, hangul etc.),
+# which aren't separated into words by spaces
+cjk = re.compile(u'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff66-\uff9f]+')
+
 
 class UnicodeWordSplitter:
 
     word = re.compile(r"(?u)\w+")
     wordGlob = re.compile(r"(?u)\w+[\w*?]*")
     html = re.compile(r"(?u)<[^<>]*>|&[A-Za-z0-9#]+;")
+    bigrams = False
 
     def process(self, lst, glob=False, strip_html=False):
-        result = []
-        for w in lst:
+        findall = (glob and self.wordGlob or self.word).findall
+        html = strip_html and self.html
+        def prepare(w):
             if not isinstance(w, unicode):
                 w = unicode(w, enc)
-            if strip_html:
-                w = self.html.sub(' ', w)
-            if glob:
-                result += self.wordGlob.findall(w)
+            if html and ('<' in w or '&' in w):
+                w = html.sub(' ', w)
+            return w
+        def words():
+            for w in lst:
+                for x in findall(prepare(w)):
+                    yield x
+        words = words()
+        if self.bigrams: return self.splitCJK(words, glob)
+        return words
+
+    def splitCJK(self, words, glob=False):
+        for word in words:
+            if cjk.search(word):
+                for part in cjkBigrams(word, glob): yield part
             else:
-                result += self.word.findall(w)
-        return result
+                yield word
 
     def processGlob(self, lst):
-        return self.process(lst, True)
+        return list(self.process(lst, True))
 
 
 class UnicodeHTMLWordSplitter(UnicodeWordSplitter):
@@ -48,15 +72,51 @@ class UnicodeHTMLWordSplitter(UnicodeWordSplitter):
         return UnicodeWordSplitter.process(self, lst, glob, True)
 
 
+class UnicodeCJKWordSplitter(UnicodeWordSplitter):
+    """
+    Also splits chinese, japanese and korean text, which has no spaces
+    between words, into overlapping pairs of characters (bigrams).
+    """
+    bigrams = True
+
+
+class UnicodeHTMLCJKWordSplitter(UnicodeHTMLWordSplitter):
+    bigrams = True
+
+
+def cjkBigrams(word, glob=False):
+    """
+    Generate the parts of word, with each run of CJK characters split
+    into overlapping bigrams (a single character stays as it is).
+    With glob, wildcards following CJK characters are dropped.
+    """
+    pos = 0
+    for m in cjk.finditer(word):
+        if m.start() > pos: yield word[pos:m.start()]
+        run = m.group()
+        if len(run) == 1:
+            yield run
+        else:
+            for i in xrange(len(run)-1): yield run[i:i+2]
+        pos = m.end()
+    rest = word[pos:]
+    if glob: rest = rest.lstrip('*?')
+    if rest: yield rest
+
+
 class UnicodeCaseNormalizer:
 
     def process(self, lst):
-        result = []
-        for w in lst:
-            if not isinstance(w, unicode):
-                w = unicode(w, enc)
-            result.append(w.lower())
-        return result
+        lst = list(lst)
+        try:
+            # lowercasing them all at once is much quicker. This can't
+            # work if a word contains the separator, so check
+            result = u'\0'.join(lst).lower().split(u'\0')
+            if len(result) == len(lst): return result
+        except UnicodeError:
+            pass
+        return [(isinstance(w, unicode) and w or unicode(w, enc)).lower()
+                for w in lst]
 
 
 try:
@@ -64,9 +124,12 @@ try:
           'Unicode Whitespace splitter', UnicodeWordSplitter)
     element_factory.registerFactory('Word Splitter',
           'Unicode HTML aware splitter', UnicodeHTMLWordSplitter)
+    element_factory.registerFactory('Word Splitter',
+          'Unicode CJK bigram splitter', UnicodeCJKWordSplitter)
+    element_factory.registerFactory('Word Splitter',
+          'Unicode HTML aware CJK bigram splitter', UnicodeHTMLCJKWordSplitter)
     element_factory.registerFactory('Case Normalizer',
           'Unicode Case normalizer', UnicodeCaseNormalizer)
 except ValueError:
     # in case the splitter is already registered, ValueError is raised
     pass
-
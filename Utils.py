@@ -3,7 +3,7 @@
 
 from types import *
 from string import split,join,find,lower,rfind,atoi,strip,lstrip
-import os, re, sys, traceback, math
+import os, re, sys, traceback, math, thread
 from urllib import quote, unquote
 
 from Acquisition import aq_base
@@ -977,6 +977,118 @@ if not safe_hasattr(__builtins__,'sorted'):
 else:
     sorted = sorted
 
+class LRUCache:
+    """
+    A thread-safe dictionary-like cache holding at most size items.
+
+    When full, the least recently used item is discarded to make room.
+    Items are kept in a circular doubly-linked list of [prev, next, key,
+    value] nodes, most recently used last, so all operations are O(1).
+    """
+    def __init__(self, size=100):
+        self.size = size
+        self._lock = thread.allocate_lock()
+        self._clear()
+
+    def _clear(self):
+        self._map = {}
+        root = self._root = []
+        root[:] = [root, root, None, None]
+
+    def _unlink(self, node):
+        prev, next = node[0], node[1]
+        prev[1], next[0] = next, prev
+
+    def _append(self, node):
+        root = self._root
+        last = root[0]
+        node[0], node[1] = last, root
+        last[1] = root[0] = node
+
+    def __len__(self):
+        return len(self._map)
+
+    def has_key(self, key):
+        return self._map.has_key(key)
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            node = self._map.get(key)
+            if node is None: return default
+            self._unlink(node)
+            self._append(node)
+            return node[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            node = self._map.get(key)
+            if node is not None:
+                self._unlink(node)
+                node[3] = value
+            else:
+                node = [None, None, key, value]
+                self._map[key] = node
+                while len(self._map) > max(self.size,1):
+                    oldest = self._root[1]
+                    self._unlink(oldest)
+                    del self._map[oldest[2]]
+            self._append(node)
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        self._lock.acquire()
+        try:
+            node = self._map.get(key)
+            if node is not None:
+                self._unlink(node)
+                del self._map[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try: self._clear()
+        finally: self._lock.release()
+
+class KeyedLocks:
+    """
+    A lock for each key, so that threads working on different things
+    don't wait for each other. Locks are made when first acquired and
+    forgotten when nobody holds or waits for them.
+    """
+    def __init__(self):
+        self._lock = thread.allocate_lock()
+        self._locks = {} # key -> [lock, number of users]
+
+    def acquire(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [thread.allocate_lock(), 0]
+            entry[1] += 1
+        finally:
+            self._lock.release()
+        entry[0].acquire()
+
+    def release(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._locks[key]
+            entry[0].release()
+            entry[1] -= 1
+            if not entry[1]: del self._locks[key]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._locks)
+
 # unique values of a list
 def nub(l):
     u = []
@@ -202,13 +202,69 @@ def addErrorTo(text,error):
     return """<div class="error">%s</div>\n%s""" % (error,text)
 
 
+class Skin:
+    """
+    The templates and other files of a filesystem skin, by name; a
+    dictionary-like object. To keep product startup quick we just note
+    where each one is (see register), and load it the first time it's
+    asked for, keeping it after that.
+    """
+    def __init__(self):
+        self.loaders = {}
+        self.objects = {}
+
+    def register(self, name, load, *args):
+        """Arrange for load(*args) to provide the named object when needed."""
+        self.loaders[name] = (load, args)
+        if self.objects.has_key(name): del self.objects[name]
+
+    def get(self, name, default=None):
+        obj = self.objects.get(name, None)
+        if obj is None and self.loaders.has_key(name):
+            load, args = self.loaders[name]
+            obj = load(*args)
+            if obj is None: self.loaders.pop(name, None) # gone meanwhile
+            else: self.objects[name] = obj
+        if obj is None: return default
+        return obj
+
+    def __getitem__(self, name):
+        obj = self.get(name)
+        if obj is None: raise KeyError, name
+        return obj
+
+    def __setitem__(self, name, obj):
+        if self.loaders.has_key(name): del self.loaders[name]
+        self.objects[name] = obj
+
+    def update(self, dict):
+        for name, obj in dict.items(): self[name] = obj
+
+    def has_key(self, name):
+        return (self.loaders.has_key(name) or
+                self.objects.get(name, None) is not None)
+    __contains__ = has_key
+
+    def keys(self):
+        return [k for k in nub(self.loaders.keys() + self.objects.keys())
+                if self.has_key(k)]
+
+    def values(self):
+        return [v for v in map(self.get, self.keys()) if v is not None]
+
+    def items(self):
+        return [(k, v) for k, v in map(lambda k:(k, self.get(k)), self.keys())
+                if v is not None]
+
 # load built-in zwiki skin templates from the filesystem
 # skins/zwiki/ defines all of these, other skins need not
 
-SKINS = {}
-for s in os.listdir(abszwikipath('skins')):
-    SKINS[s] = {}
-    skindir = os.path.join(abszwikipath('skins'),s)
+def registerSkin(skindir):
+    """
+    Make a Skin of the standard templates present in a skin directory.
+    """
+    skin = Skin()
+    files = os.listdir(skindir)
     for template in [
         # main view templates
         # these usually have a similarly named publish method
@@ -245,14 +301,14 @@ for s in os.listdir(abszwikipath('skins')):
         'testtemplate',
         'badtemplate',
         ]:
-        obj = loadPageTemplate(template,dir=skindir)
-        if obj: SKINS[s][template] = obj
+        if template+'.pt' in files:
+            skin.register(template, loadPageTemplate, template, skindir)
     for template in [
         # stylesheet
         'stylesheet',
         ]:
-        obj = loadStylesheet(template,dir=skindir)
-        if obj: SKINS[s][template] = obj
+        if template+'.css' in files:
+            skin.register(template, loadStylesheet, template, skindir)
     for template in [
         # helper dtml methods
         'Index',
@@ -264,21 +320,25 @@ for s in os.listdir(abszwikipath('skins')):
         'subtopics_board',
         'stylesheet', # a stylesheet.dtml would override stylesheet.css
         ]:
-        obj = loadDtmlMethod(template,dir=skindir)
-        if obj: SKINS[s][template] = obj
+        if template+'.dtml' in files:
+            skin.register(template, loadDtmlMethod, template, skindir)
+    return skin
+
+SKINS = {}
+for s in os.listdir(abszwikipath('skins')):
+    SKINS[s] = registerSkin(os.path.join(abszwikipath('skins'),s))
 
 # extras
 # XXX this really expects to be a full wiki page
 # for now, read it as a file and format it in helppage.pt
 # one issue: File does not refresh in debug mode ?
-SKINS['zwiki']['HelpPage'] = loadFile('HelpPage.stx',dir=skindir)
+SKINS['zwiki'].register('HelpPage', loadFile, 'HelpPage.stx',
+                        os.path.join(abszwikipath('skins'),'zwiki'))
 
 TEMPLATES = SKINS['zwiki'] # backwards compatibility
 
 # set up easy access to all PT macros via here/macros.
 MACROS = {} # a flat dictionary of all macros defined in all templates
-# need to initialise it for some backwards compatibility assignments at startup
-[MACROS.update(t.pt_macros()) for t in TEMPLATES.values() if isPageTemplate(t)]
 def getmacros(self):
     """
     Get a dictionary of all the page template macros in the skin. More precisely,
@@ -293,22 +353,29 @@ def getmacros(self):
     for s in nub(['zwiki',self.currentSkin()]):
         skin = SKINS[s]
         for t in skin.keys():
-            if isPageTemplate(skin[t]):
+            obj = skin.get(t)
+            if isPageTemplate(obj):
                 #MACROS.update(self.getSkinTemplate(t).pt_macros())
-                MACROS.update(skin[t].pt_macros())
+                MACROS.update(obj.pt_macros())
+        if not MACROS.has_key('linkpanel'): addOldMacros()
     return MACROS
 
-# provide old macros for backwards compatibility
-# pre-0.52 these were defined in wikipage, old custom templates may need them
-# two more were defined in contentspage, we won't support those
-MACROS['linkpanel']   = MACROS['links']
-MACROS['navpanel']    = MACROS['hierarchylinks']
-nullmacro = ZopePageTemplate('null','<div metal:define-macro="null" />').pt_macros()['null']
-MACROS['favicon']     = nullmacro
-MACROS['logolink']    = nullmacro
-MACROS['pagelinks']   = nullmacro
-MACROS['pagenameand'] = nullmacro
-MACROS['wikilinks']   = nullmacro
+def addOldMacros():
+    """
+    Provide old macros for backwards compatibility.
+
+    Pre-0.52 these were defined in wikipage, old custom templates may
+    need them. Two more were defined in contentspage, we won't support
+    those.
+    """
+    MACROS['linkpanel']   = MACROS['links']
+    MACROS['navpanel']    = MACROS['hierarchylinks']
+    nullmacro = ZopePageTemplate('null','<div metal:define-macro="null" />').pt_macros()['null']
+    MACROS['favicon']     = nullmacro
+    MACROS['logolink']    = nullmacro
+    MACROS['pagelinks']   = nullmacro
+    MACROS['pagenameand'] = nullmacro
+    MACROS['wikilinks']   = nullmacro
 
 
 class SkinUtils:
@@ -12,12 +12,16 @@ disclaimers apply, etc.
 """
 
 from __future__ import nested_scopes
-import os, sys, re, string, time, thread
+import os, sys, re, string, time, bisect
 from string import split,join,find,lower,rfind,atoi,strip
 from urllib import quote, unquote
 from types import *
+try: from hashlib import md5
+except ImportError: from md5 import new as md5 # python < 2.5
 
 #import ZODB # need this for pychecker
+from Acquisition import aq_base
+from BTrees.Length import Length
 from AccessControl import getSecurityManager, ClassSecurityInfo
 from App.Common import rfc1123_date
 from DateTime import DateTime
@@ -28,16 +32,19 @@ from Defaults import AUTO_UPGRADE, IDS_TO_AVOID, \
      PAGE_METATYPE, LINK_TO_ALL_CATALOGED, LINK_TO_ALL_OBJECTS, \
      WIKINAME_LINKS, BRACKET_LINKS, DOUBLE_BRACKET_LINKS, \
      DOUBLE_PARENTHESIS_LINKS, ISSUE_LINKS, PAGE_METADATA, \
-     CONDITIONAL_HTTP_GET, CONDITIONAL_HTTP_GET_IGNORE
-from Regexps import url, bracketedexpr, singlebracketedexpr, \
-     doublebracketedexpr, doubleparenthesisexpr, wikiname, wikilink, \
-     interwikilink, remotewikiurl, protected_line, zwikiidcharsexpr, \
-     anywikilinkexpr, markedwikilinkexpr, localwikilink, \
-     spaceandlowerexpr, dtmlorsgmlexpr, wikinamewords, hashnumberexpr, \
-     bracketmatch
+     CONDITIONAL_HTTP_GET, CONDITIONAL_HTTP_GET_IGNORE, \
+     RENDER_CACHE, RENDER_CACHE_SIZE, RENDER_CACHE_TIMEOUT, \
+     RENDER_CACHE_VARIANTS, DTML_CACHE_SIZE
+from Regexps import bracketedexpr, remotewikiurl, protected_line, \
+     zwikiidcharsexpr, anywikilinkexpr, markedwikilinkexpr, localwikilink, \
+     spaceandlowerexpr, dtmlorsgmlexpr, wikinamewords, bracketmatch, \
+     wikinameexpr, wholewikinameexpr, wikilinkexpr, interwikilinkexpr, \
+     urlexpr, hashnumberlinkexpr, singlebracketedlinkexpr, \
+     doublebracketedlinkexpr, doubleparenthesislinkexpr
 from Utils import PageUtils, BLATHER, DateTimeSyntaxError, isunicode, \
-     safe_hasattr, ZOPEVERSION
+     safe_hasattr, ZOPEVERSION, LRUCache, KeyedLocks
 from Views import PageViews
+from LinkGraph import LinkGraph
 from OutlineSupport import PageOutlineSupport
 from Archive import ArchiveSupport
 from Diff import PageDiffSupport # XXX to be replaced by..
@@ -56,6 +63,21 @@ from plugins import PLUGINS
 
 DEFAULT_PAGETYPE = PAGETYPES[0]
 
+# rendered page views, see ZWikiPage.render
+RENDERCACHE = LRUCache(RENDER_CACHE_SIZE)
+
+def acceptedLanguages(header):
+    """
+    Normalise an Accept-Language header to its language tags, in order,
+    so that the render cache doesn't keep a variant for every spelling.
+    """
+    langs = [l.split(';')[0].strip().lower() for l in header.split(',')]
+    return ','.join([l for l in langs if l])
+
+# parsed DTML, by digest of the text parsed, see ZWikiPage.cook
+DTMLCACHE = LRUCache(DTML_CACHE_SIZE)
+DTMLCACHELOCKS = KeyedLocks()
+
 # see plugins/__init__.py    
 #
 # PageCMFSupport is last to avoid PortalContent.id overriding
@@ -202,9 +224,14 @@ class ZWikiPage(
         match = filter(lambda x:x._id==id,PAGETYPES)
         return (match and match[0]) or DEFAULT_PAGETYPE
 
-    def setPreRendered(self,t): self._prerendered = t
+    def setPreRendered(self,t):
+        # compact revisions keep this in memory only
+        if self.isCompactRevision(): self._v_prerendered = t
+        else: self._prerendered = t
 
     def preRendered(self):
+        if self.isCompactRevision():
+            return getattr(self,'_v_prerendered','') or ''
         # cope with non-existing or None attribute on old instances - needed ?
         return getattr(self,'_prerendered','') or ''
 
@@ -254,14 +281,109 @@ class ZWikiPage(
         NB this can also get set in I18n.py.
         """
         if not self.preRendered(): self.preRender()
-        r = self.pageType().render(self, REQUEST, RESPONSE, **kw)
+        variant = self.renderCacheVariant(client,REQUEST,**kw)
+        cached = variant and self.cachedRender(variant)
+        if cached:
+            r, contenttype = cached
+            if RESPONSE and contenttype:
+                RESPONSE.setHeader('content-type',contenttype)
+        else:
+            r = self.pageType().render(self, REQUEST, RESPONSE, **kw)
         if RESPONSE:
             if safe_hasattr(self,'zwiki_content_type'):
                 RESPONSE.setHeader('content-type',getattr(self,'zwiki_content_type'))
             elif not RESPONSE.getHeader('content-type'):
                 RESPONSE.setHeader('content-type','text/html')
+        if variant and not cached:
+            self.cacheRender(variant, r,
+                             RESPONSE and RESPONSE.getHeader('content-type'))
         return r
 
+    def renderCacheEnabled(self):
+        return getattr(self,'use_render_cache',RENDER_CACHE) and 1
+
+    def renderCacheVariant(self, client=None, REQUEST={}, **kw):
+        """
+        Say which cached rendering of this page this request could use.
+
+        The render cache holds the final output of page views for
+        anonymous users, when enabled by the use_render_cache property.
+        It's for plain page views only - pages with DTML, requests with
+        form data or render arguments, and views for users who are
+        logged in or have a username cookie (which are personalized) are
+        not cached, and we return None. Otherwise we return a tuple of
+        the things which can vary the output for a given page state: the
+        page's url (virtual hosting), skin, display mode, accepted
+        languages (without weights) and the anonymous/authenticated
+        state. At most RENDER_CACHE_VARIANTS of these are cached per page.
+        """
+        if (not self.renderCacheEnabled()
+            or client is not None or kw
+            or not safe_hasattr(REQUEST,'form') or REQUEST.form
+            or REQUEST.cookies.has_key('zwiki_username')
+            or getattr(self,'_p_jar',None) is None
+            or (self.dtmlAllowed() and self.hasDynamicContent())):
+            return None
+        user = getSecurityManager().getUser().getUserName()
+        if user != 'Anonymous User': return None
+        return (self.pageUrl(),
+                self.currentSkin(),
+                self.displayMode(REQUEST),
+                acceptedLanguages(REQUEST.get('HTTP_ACCEPT_LANGUAGE','')),
+                'anonymous')
+
+    def renderCacheState(self):
+        """
+        A key identifying the state of this page, its wiki and outline.
+
+        That is, the last modification times of the page, the wiki folder
+        and the wiki outline, and the wiki's page id and link cache serial
+        numbers (which change when pages are added, removed or renamed,
+        even in a BTreeFolder2 wiki whose folder stays the same; see
+        cacheSerial).
+        """
+        f = self.folder()
+        return (self._p_mtime,
+                getattr(aq_base(f),'_p_mtime',None),
+                getattr(getattr(aq_base(f),'outline',None),'_p_mtime',None),
+                self.cacheSerial('_pageidserial'),
+                self.cacheSerial('_linkcacheserial'))
+
+    def cachedRender(self, variant):
+        """
+        Get the cached (output, content type) for this page and variant, or None.
+        """
+        entry = RENDERCACHE.get(self.getPhysicalPath())
+        if not entry: return None
+        state, time_, variants = entry
+        if (state != self.renderCacheState()
+            or time.time() - time_ > RENDER_CACHE_TIMEOUT):
+            RENDERCACHE.discard(self.getPhysicalPath())
+            return None
+        return variants.get(variant)
+
+    def cacheRender(self, variant, output, contenttype=None):
+        """
+        Save output as this page's rendering for the given variant,
+        unless the page already has as many variants cached as allowed.
+        """
+        path, state = self.getPhysicalPath(), self.renderCacheState()
+        entry = RENDERCACHE.get(path)
+        if not entry or entry[0] != state:
+            entry = (state, time.time(), {})
+        variants = entry[2]
+        if not variants.has_key(variant) \
+           and len(variants) >= RENDER_CACHE_VARIANTS: return
+        variants[variant] = (output, contenttype)
+        RENDERCACHE.set(path, entry)
+
+    security.declarePrivate('clearRenderCache')
+    def clearRenderCache(self):
+        """
+        Forget any cached renderings of this page.
+        """
+        RENDERCACHE.discard(self.getPhysicalPath())
+
     def preRender(self,clear_cache=0):
         """
         Make sure any applicable pre-rendering for this page has been done.
@@ -271,6 +393,8 @@ class ZWikiPage(
         """
         if clear_cache: self.clearCache()
         self.setPreRendered(self.pageType().preRender(self))
+        self.preRenderDiscussionChunks()
+        self.updateLinkGraph()
 
     security.declarePublic('renderText')
     def renderText(self, text, type, **kw):
@@ -285,6 +409,7 @@ class ZWikiPage(
         forcibly clear out any cached render data for this page
         """
         self.setPreRendered('')
+        self.clearRenderCache()
         if safe_hasattr(self,'_v_cooked'):
             delattr(self,'_v_cooked')
             delattr(self,'_v_blocks')
@@ -296,21 +421,33 @@ class ZWikiPage(
         if self.dtmlAllowed() and self.hasDynamicContent(): self.cook()
 
     security.declareProtected(Permissions.View, 'cook')
-    def cook(self, cooklock=thread.allocate_lock()):
+    def cook(self):
         """
         Pre-parse this page's text (the pre-rendered, if available) for DTML.
+
+        Parse results are shared by all threads and pages through
+        DTMLCACHE, keyed by a digest of the text, so a page is parsed
+        once per process rather than once per zodb connection. Only
+        threads parsing the same text wait for each other.
         """
         t = self.preRendered() or self.read()
         # dtml can break with a unicode string here (eg
         # test_dtml_in_rst); we'll encode it and decode again in
         # evaluatePreRenderedAsDtml
         t = self.toencoded(t)
-        cooklock.acquire()
-        try:
-            self._v_blocks=self.parse(t)
-            self._v_cooked=None
-        finally:
-            cooklock.release()
+        key = md5(t).hexdigest()
+        blocks = DTMLCACHE.get(key)
+        if blocks is None:
+            DTMLCACHELOCKS.acquire(key)
+            try:
+                blocks = DTMLCACHE.get(key)
+                if blocks is None:
+                    blocks = self.parse(t)
+                    DTMLCACHE.set(key, blocks)
+            finally:
+                DTMLCACHELOCKS.release(key)
+        self._v_blocks=blocks
+        self._v_cooked=None
 
     def evaluatePreRenderedAsDtml(self,client=None, REQUEST={},
                                   RESPONSE=None, **kw):
@@ -362,11 +499,15 @@ class ZWikiPage(
         This is the subtopics, in the preferred style, if enabled, or
         nothing.  As a convenience, if it seems subtopics are already
         displayed via custom DTML code, we won't display them again.
+        If only the latest comments are shown, a link to the older ones
+        follows.
         """
+        t = ''
         if self.subtopicsEnabled(**kw) and not self.displaysSubtopicsWithDtml():
-            return self.subtopics()
-        else:
-            return ''
+            t = self.subtopics()
+        older = self.olderCommentsLink()
+        if older: t += '\n<p>%s</p>\n' % older
+        return t
 
     def displaysSubtopicsWithDtml(self):
         """
@@ -502,22 +643,22 @@ class ZWikiPage(
 
     def isWikiName(self,name):
         """Is name a WikiName ?"""
-        return re.match('^%s$' % wikiname,name) is not None
+        return wholewikinameexpr.match(name) is not None
 
     def isValidWikiLinkSyntax(self,link):
         """Does link look a valid wiki link syntax for this wiki ?
         """
         return ((
             (self.wikinameLinksAllowed() and
-                re.match(wikiname,link))
+                wikinameexpr.match(link))
             or (self.issueLinksAllowed() and
-                re.match(hashnumberexpr,link))
+                hashnumberlinkexpr.match(link))
             or (self.bracketLinksAllowed() and
-                re.match(singlebracketedexpr,link))
+                singlebracketedlinkexpr.match(link))
             or (self.doubleBracketLinksAllowed() and
-                re.match(doublebracketedexpr,link))
+                doublebracketedlinkexpr.match(link))
             or (self.doubleParenthesisLinksAllowed() and
-                re.match(doubleparenthesisexpr,link))) and 1)
+                doubleparenthesislinkexpr.match(link))) and 1)
 
     def firstBracketStyle(self): # -> tuple of strings
         """
@@ -541,8 +682,13 @@ class ZWikiPage(
 
         As well as all kinds of Zwiki wiki-links, marks bare urls, unless
         urls is false (useful for restructured text).
+
+        This is a single pass through the text: the literal and tag
+        context is carried forward in state from one link to the next
+        (see within_literal and withinSgmlOrDtml), so the time taken is
+        roughly linear in the size of the text.
         """
-        markedtext = ''
+        markedtext = []
         state = {'lastend':0,'inpre':0,'incode':0,'intag':0,'inanchor':0}
         lastpos = 0
         while 1:
@@ -553,24 +699,24 @@ class ZWikiPage(
                 linkstart,linkend = m.span()
                 if (link[0]=='!'
                     or not (self.isValidWikiLinkSyntax(link)
-                            or (urls and re.match(url,link))
+                            or (urls and urlexpr.match(link))
                             )
                     or within_literal(linkstart,linkend-1,state,text) # XXX these
-                    or withinSgmlOrDtml((linkstart,linkend),text)):   # overlap ?
+                    or withinSgmlOrDtml((linkstart,linkend),text,state)): # overlap ?
                     # no - ignore it (and strip the !)
                     if link[0] == '!':
                         link=link[1:]
-                    markedtext += text[lastpos:linkstart] + link
+                    markedtext.append(text[lastpos:linkstart] + link)
                 else:
                     # yes - mark it for later
-                    markedtext += '%s<zwiki>%s</zwiki>' \
-                                  % (text[lastpos:linkstart],link)
+                    markedtext.append('%s<zwiki>%s</zwiki>' \
+                                      % (text[lastpos:linkstart],link))
                 lastpos = linkend
             else:
                 # no more links - save the final text extent & quit
-                markedtext += text[lastpos:]
+                markedtext.append(text[lastpos:])
                 break
-        return markedtext
+        return ''.join(markedtext)
 
     def renderMarkedLinksIn(self,text):
         """
@@ -598,7 +744,7 @@ class ZWikiPage(
         """
         return re.sub(
             protected_line,
-            lambda m:re.sub(wikilink, r'!\1', m.group(1)),
+            lambda m:wikilinkexpr.sub(r'!\1', m.group(1)),
             text)
         
     def renderLink(self,link,state=None,text='',link_title=None,access_key=None):
@@ -624,7 +770,7 @@ class ZWikiPage(
             # keep state - do the within_literal and within sgml checks that
             # would normally be done in markLinksIn
             if (within_literal(match.start(),match.end()-1,state,text) or
-                withinSgmlOrDtml(match.span(),text)):
+                withinSgmlOrDtml(match.span(),text,state)):
                 return link
         link = linkorig = re.sub(markedwikilinkexpr, r'\1', link)
         label = None
@@ -640,12 +786,12 @@ class ZWikiPage(
             return link
 
         # is it an interwiki link ?
-        if re.match(interwikilink,link):
+        if interwikilinkexpr.match(link):
             return self.renderInterwikiLink(link)
 
         # is it a STX footnote ? check for matching named anchor in the page text
-        if re.match(singlebracketedexpr,link):
-            linknobrackets = re.sub(singlebracketedexpr, r'\1', link)
+        if singlebracketedlinkexpr.match(link):
+            linknobrackets = singlebracketedlinkexpr.sub(r'\1', link)
             if re.search(
                 r'(?s)<a name="ref%s"' % (re.escape(linknobrackets)),text):
                 return '<a href="%s#ref%s" title="footnote %s">[%s]</a>' % (
@@ -653,19 +799,17 @@ class ZWikiPage(
                     linknobrackets,linknobrackets)
 
         # is it a bare URL ?
-        if re.match(url,link):
+        if urlexpr.match(link):
             label = re.sub(r'^mailto:','',link)
             return '<a href="%s">%s</a>' % (link, label)
 
         # is it a hash number issue link (#123) ?
-        if re.match(hashnumberexpr,link):
+        if hashnumberlinkexpr.match(link):
             # yes - convert to the id of the issue page with that number
             # and continue; if we can't, don't bother linking
-            p = self.issuePageWithNumber(self.issueNumberFrom(link))
-            if p:
-                try: link = p.getId() # XXX poor caching
-                except AttributeError: link = p.id   # all-brains
-                return self.renderLinkToPage(link,
+            id, exists, style = self.resolveLink(link,how='issue')
+            if exists:
+                return self.renderLinkToPage(id,
                                              linkorig=linkorig,
                                              link_title=link_title,
                                              access_key=access_key)
@@ -692,14 +836,13 @@ class ZWikiPage(
                 return l[0], l[1]
             link, label = linkTargetAndLabel(link)
             # end
-            p = self.pageWithFuzzyName(link)
-            if p:
+            id, exists, style = self.resolveLink(link,how='fuzzy')
+            if exists:
                 # found the page, use its id for linking
-                try: link = p.getId() # XXX poor caching
-                except AttributeError: link = p.id   # all-brains
+                link = id
             else:
                 # no such page, maybe this is an external link ?
-                if re.match(url,link):
+                if urlexpr.match(link):
                     label = re.sub(r'^mailto:','',label)
                     return '<a href="%s">%s</a>' % (link, label)
                 # no - treat it as an uncreated page
@@ -721,24 +864,13 @@ class ZWikiPage(
         intended.
         """
         # does page exist in this wiki ?
-        p = self.pageWithNameOrId(page)
-        if p:
-            # yes - link to it
-            # make sure we have the page's id
-            if not self.pageWithId(page): # XXX this check helps avoid zodb loads ?
-                try: page = p.getId() # XXX poor caching
-                except AttributeError: page = p.id   # all-brains
+        id, exists, style = self.resolveLink(page)
+        if exists:
+            # yes - link to it, using the page's id
+            page      = id
             title     = (link_title and ' title="%s"' % link_title) or '' #' title="%s"' % self.pageWithId(page).linkTitle()
             name      = (name and ' name="%s"' % name) or ''
             accesskey = (access_key and ' accesskey="%s"' % access_key) or ''
-            # XXX tracker plugin dependency
-            if p.isIssue():
-                try:
-                    style=' style="background-color:%s;"' % p.issueColour() # poor caching
-                except AttributeError:
-                    style=' style="background-color:%s;"' % p.issueColour # all-brains
-            else:
-                style = ''
             link      = stripDelimitersFrom(linkorig or page)
             label     = label and label or self.formatWikiname(link)
             return '<a href="%s/%s"%s%s%s%s>%s</a>' % (
@@ -759,12 +891,116 @@ class ZWikiPage(
                 quote(self.toencoded(page)),
                 _("create this page")))
 
+    def resolveLink(self,link,how='name'):
+        """
+        Find the page that a wiki link refers to, using the link cache.
+
+        how says which lookup to do: 'name' (pageWithNameOrId), 'fuzzy'
+        (pageWithFuzzyName) or 'issue' (issuePageWithNumber, link is a
+        hash number like #123). Returns an (id, exists, style) tuple,
+        where id is the target page's id (or link itself if there is no
+        such page) and style is the link's style attribute, non-empty
+        for tracker issues.  Results are remembered in the wiki's link
+        cache, so repeat lookups don't touch the page objects at all.
+        """
+        cache = self.linkCache()
+        key = (how,link)
+        if cache.has_key(key): return cache[key]
+        if how == 'issue':
+            p = self.issuePageWithNumber(self.issueNumberFrom(link))
+        elif how == 'fuzzy':
+            p = self.pageWithFuzzyName(link)
+        else:
+            p = self.pageWithNameOrId(link)
+        if p:
+            try: id = p.getId()
+            except AttributeError: id = p.id   # all-brains
+            # XXX tracker plugin dependency
+            if p.isIssue():
+                try: colour = p.issueColour()
+                except (AttributeError,TypeError): colour = p.issueColour # all-brains
+                style = ' style="background-color:%s;"' % colour
+            else:
+                style = ''
+            result = (id, 1, style)
+        else:
+            result = (link, 0, '')
+        cache[key] = result
+        return result
+
+    def linkCache(self):
+        """
+        Get this wiki's link resolution cache, a dictionary.
+
+        This maps (lookup, link text) keys to resolveLink's (id, exists,
+        style) results. It is kept in a volatile attribute of the wiki
+        folder, so it is per-thread, and is discarded when the folder is
+        deactivated or when clearLinkCache has been called in any thread
+        since it was started (see cacheSerial). We don't cache when
+        linking to pages outside the folder (link_to_all_cataloged).
+        """
+        f = self.folder()
+        if f is None or self.linkToAllCataloged(): return {}
+        serial = self.cacheSerial('_linkcacheserial')
+        f = aq_base(f)
+        cached = getattr(f,'_v_linkcache',None)
+        if cached is None or cached[0] != serial:
+            cached = f._v_linkcache = (serial, {})
+        return cached[1]
+
+    def clearLinkCache(self):
+        """
+        Forget this wiki's cached link resolutions.
+
+        Call this whenever pages are created, renamed or deleted, or
+        something affecting link rendering (like issue status) changes.
+        Other threads' caches are discarded once this commits.
+        """
+        f = self.folder()
+        if f is None: return
+        self.bumpCacheSerial('_linkcacheserial')
+        if safe_hasattr(aq_base(f),'_v_linkcache'):
+            del aq_base(f)._v_linkcache
+
+    security.declarePrivate('cacheSerial')
+    def cacheSerial(self, name):
+        """
+        Get the value of one of the wiki folder's cache serial numbers.
+
+        Per-thread caches kept in volatile attributes of the folder
+        record the serial number they were built with, and are rebuilt
+        when it changes. Adding or removing a page in a BTreeFolder2
+        does not change the folder object itself, so its volatile
+        attributes survive in other threads; the serial number is a
+        separate persistent counter which every thread sees change at
+        its next transaction.
+        """
+        f = self.folder()
+        counter = f is not None and getattr(aq_base(f),name,None) or None
+        if counter is None: return 0
+        return counter()
+
+    security.declarePrivate('bumpCacheSerial')
+    def bumpCacheSerial(self, name):
+        """
+        Change one of the wiki folder's cache serial numbers, returning
+        the new value. The counter is a BTrees.Length, so concurrent
+        bumps don't conflict.
+        """
+        f = aq_base(self.folder())
+        counter = getattr(f,name,None)
+        if counter is None:
+            counter = Length()
+            setattr(f,name,counter)
+        counter.change(1)
+        return counter()
+
     def renderInterwikiLink(self, link):
         """
         Render an occurence of interwikilink. link is a string.
         """
         if link[0] == '!': return link[1:]
-        m = re.match(interwikilink,link)
+        m = interwikilinkexpr.match(link)
         local, remote  = m.group('local'), m.group('remote')
         # check local is an allowed link syntax for this wiki
         if not self.isValidWikiLinkSyntax(local): return link
@@ -818,7 +1054,7 @@ class ZWikiPage(
                 or link[0]=='!'
                 or not self.isValidWikiLinkSyntax(link)
                 or within_literal(linkstart,linkend-1,state,text) # XXX these
-                or withinSgmlOrDtml((linkstart,linkend),text)):   # overlap ?
+                or withinSgmlOrDtml((linkstart,linkend),text,state)): # overlap ?
                     markedtext += text[lastpos:linkstart] + link
                 else: # yes - change the link
                     if self.isWikiName(link):
@@ -858,7 +1094,7 @@ class ZWikiPage(
 
         Uses the wikiname regexp to follow localised capitalisation.
         """
-        if re.match('^%s$' % wikiname, pagename):
+        if wholewikinameexpr.match(pagename):
             words = [x[0] for x in re.findall(wikinamewords,pagename)]
             return ' '.join(words)
         else:
@@ -879,9 +1115,12 @@ class ZWikiPage(
         """
         # don't generate this if missing - too expensive when cataloging ?
         #if not self.preRendered(): self.preRender()
-        links = []
-        for l in re.findall(markedwikilinkexpr,self.preRendered()):
-            if not l in links: links.append(l)
+        links, seen = [], {}
+        for t in [self.preRendered()] + self.discussionChunks():
+            for l in re.findall(markedwikilinkexpr,t):
+                if not seen.has_key(l):
+                    seen[l] = 1
+                    links.append(l)
         return links
 
     security.declareProtected(Permissions.View, 'canonicalLinks')
@@ -893,7 +1132,6 @@ class ZWikiPage(
         from prerendered data, does not generate this if missing.
         """
         clinks = []
-        localwikilinkexpr = re.compile(localwikilink)
         for link in self.links():
             if localwikilinkexpr.match(link):
                 if link[0] == r'[' and link[-1] == r']': link = link[1:-1]
@@ -1078,7 +1316,8 @@ class ZWikiPage(
 
     def wikiPath(self):
         """
-        This wiki's folder path, for filtering our pages from catalog results
+        This wiki's folder path, for selecting our pages in catalog results.
+        The wikiPath catalog index holds this for each page.
         """
         return self.getPath()[:self.getPath().rfind('/')]
 
@@ -1092,9 +1331,12 @@ class ZWikiPage(
         """
         Look up metadata (brains) for some or all pages in this wiki.
 
-        This is a wrapper for searching the wiki's catalog. It filters
-        out results for other folders, to allow us to share a catalog
-        (eg within Plone).
+        This is a wrapper for searching the wiki's catalog. It finds
+        only pages directly in this wiki folder, to allow us to share a
+        catalog (eg within Plone) and to skip saved revisions and
+        archived pages. With a wikiPath index (see ensureWikiPathIndex)
+        the catalog does this; otherwise we search everything below the
+        wiki folder and filter the results.
 
         Up to 0.60 it used to fall back to a (less cache-friendly)
         zodb search when there was no catalog, and this turns out to
@@ -1103,6 +1345,9 @@ class ZWikiPage(
         """
         if not self.hasAllCatalogFields(): return []
         wikipath = self.wikiPath()
+        if self.hasCatalogIndexesMetadata((['wikiPath'],[])):
+            return list(self.searchCatalog(
+                meta_type=self.meta_type,wikiPath=wikipath,**kw))
         def inthiswiki(b):
             p = b.getPath()
             return p[:p.rfind('/')] == wikipath
@@ -1128,6 +1373,43 @@ class ZWikiPage(
         # note btreefolders don't always give a list
         return list(self.folder().objectIds(spec=self.meta_type))
 
+    def pageIdIndex(self):
+        """
+        Get this wiki folder's page id index (see PageIdIndex).
+
+        This is built from pageIds when first needed and kept in a
+        volatile attribute of the folder, so it is per-thread. It is
+        rebuilt when the folder is deactivated, or when a page has been
+        added or removed by another thread (see cacheSerial). Local page
+        additions and removals are recorded by the
+        manage_afterAdd/manage_beforeDelete hooks.
+        """
+        serial = self.cacheSerial('_pageidserial')
+        f = aq_base(self.folder())
+        cached = getattr(f,'_v_pageidindex',None)
+        if cached is None or cached[0] != serial:
+            cached = f._v_pageidindex = (serial, PageIdIndex(self.pageIds()))
+        return cached[1]
+
+    def updatePageIdIndex(self,added=None,removed=None):
+        """
+        Record a page id addition or removal in the page id index, if
+        any, and let other threads know to rebuild theirs.
+        """
+        f = self.folder()
+        if f is None: return
+        serial = self.cacheSerial('_pageidserial')
+        newserial = self.bumpCacheSerial('_pageidserial')
+        cached = getattr(aq_base(f),'_v_pageidindex',None)
+        if cached is None: return
+        if cached[0] != serial:
+            del aq_base(f)._v_pageidindex
+            return
+        index = cached[1]
+        if removed: index.remove(removed)
+        if added: index.add(added)
+        aq_base(f)._v_pageidindex = (newserial, index)
+
     security.declareProtected(Permissions.View, 'pageNames')
     def pageNames(self):
         """
@@ -1220,7 +1502,8 @@ class ZWikiPage(
         Return the page in this folder (or in the catalog) with this id.
 
         Can also do a case-insensitive id search, and optionally unquote
-        id.  If no such page exists, return None.
+        id.  If no such page exists, return None. Folder lookups use the
+        wiki's page id index, so are fast regardless of wiki size.
 
         XXX if ALLBRAINS is set true below, this and all the methods based
         on it will return a page brain, not the actual page object.
@@ -1242,17 +1525,11 @@ class ZWikiPage(
             page = self.pages(id=id) or (ignore_case and self.pages(id_nocase=id))
             return (page and page[0]) or None
         else:
-            f = self.folder()
-            # don't acquire
-            # XXX special case: aq_base adds a REQUEST attribute
-            # ('<Special Object Used to Force Acquisition>')
-            if id in f.objectIds() and self.isZwikiPage(f[id]): # poor caching
-                return f[id]
-            elif ignore_case:
-                id = string.lower(id)
-                for i in self.pageIds():
-                    if i.lower() == id:
-                        return f[i]
+            index = self.pageIdIndex()
+            if not index.has(id) and ignore_case:
+                id = index.withIdIgnoringCase(id)
+            if id and index.has(id):
+                return self.folder()[id]
             else:
                 return None
 
@@ -1290,7 +1567,7 @@ class ZWikiPage(
         Return the page in this folder for which name is a fuzzy link, or None.
 
         A fuzzy link ignores capitalization, punctuation and whitespace.
-        If there are multiple fuzzy matches, return the page whose name is
+        If there are multiple fuzzy matches, return the page whose id is
         alphabetically first.
 
         The allow_partial flag allows even fuzzier matching. numeric_match
@@ -1310,21 +1587,25 @@ class ZWikiPage(
         id = self.canonicalIdFrom(name)
         idlower = id.lower()
         if allow_partial and name.isdigit():
+            # matches are ordered by name here, so scan them all
             names = self.pageNames()
             names.sort()
             ids = [self.canonicalIdFrom(name) for name in names]
-        else:
-            ids = self.pageIds()
-
-        for i in ids:
-            ilower = i.lower()
-            if (ilower == idlower or 
-                ((allow_partial and ilower[:len(idlower)] == idlower) and not
-                 (numeric_match and re.match(r'[0-9]',ilower[len(idlower):])))
-                ):
-                return self.pageWithId(i)
-
-        return None
+            for i in ids:
+                ilower = i.lower()
+                if (ilower == idlower or 
+                    ((allow_partial and ilower[:len(idlower)] == idlower) and not
+                     (numeric_match and re.match(r'[0-9]',ilower[len(idlower):])))
+                    ):
+                    return self.pageWithId(i)
+            return None
+
+        # otherwise the page id index can find it directly
+        index = self.pageIdIndex()
+        i = index.withIdIgnoringCase(id)
+        if not i and allow_partial:
+            i = index.withIdPrefixIgnoringCase(id,numeric_match)
+        return (i and self.pageWithId(i)) or None
         
     security.declareProtected(Permissions.View, 'backlinksFor')
     def backlinksFor(self, page):
@@ -1335,15 +1616,21 @@ class ZWikiPage(
         objects but now returns metadata objects (catalog results if possible,
         or workalikes) to improve caching. 
 
-        page may be a name or id, and need not exist in the wiki
-
-        The non-catalog search is not too smart.
+        page may be a name or id, and need not exist in the wiki.
+        The linking pages are found in the wiki's link graph.
         """
         p = self.pageWithNameOrId(page)
         if p:
             try: id = p.getId() # poor caching
             except AttributeError: id = p.id #all-brains
         else: id = page
+        graph = self.linkGraph()
+        if graph is not None:
+            ids = graph.backlinks(id)
+            if not ids: return []
+            if self.hasAllCatalogFields(): return self.pages(id=ids)
+            return [self.metadataFor(p) for p in map(self.pageWithId,ids) if p]
+        # no link graph yet (wiki not upgraded), search the old way
         if self.hasCatalogIndexesMetadata(
             (['meta_type','path','canonicalLinks'], [])):
             return self.pages(canonicalLinks=id)
@@ -1359,6 +1646,80 @@ class ZWikiPage(
                     results.append(self.metadataFor(p))
             return results
 
+    def linkGraph(self):
+        """
+        Get this wiki's link graph (see LinkGraph), or None if it has not
+        been built yet.
+
+        This is kept in the wiki folder and updated whenever a page is
+        pre-rendered, commented on, added, renamed or deleted. It is
+        built when a wiki is created or upgraded, never during a view.
+        """
+        return getattr(aq_base(self.wikiFolder()),'_linkgraph',None)
+
+    security.declareProtected('Manage properties', 'rebuildLinkGraph')
+    def rebuildLinkGraph(self):
+        """
+        Regenerate the wiki's link graph from the pages' pre-rendered links.
+        This visits every page, so may take a while in a large wiki.
+        """
+        f = self.wikiFolder()
+        BLATHER('rebuilding link graph for wiki',f.getId())
+        graph = LinkGraph()
+        for p in f.objectValues(spec=self.meta_type): # poor caching
+            graph.setLinks(p.getId(),p.canonicalLinks())
+        f._linkgraph = graph
+        return graph
+
+    def updateLinkGraph(self,removed=0):
+        """
+        Record this page's current links, or its removal with the removed
+        flag, in the wiki's link graph, if there is one yet.
+        Dummy pages, like the ones used for edit preview, are ignored.
+        """
+        f = self.folder()
+        if f is None or self.inRevisionsFolder(): return
+        graph = getattr(aq_base(f),'_linkgraph',None)
+        if graph is None: return
+        if not removed and \
+           aq_base(f._getOb(self.getId(),None)) is not aq_base(self): return
+        if removed: graph.removePage(self.getId())
+        else: graph.setLinks(self.getId(),self.canonicalLinks())
+
+    security.declareProtected(Permissions.View, 'linkCount')
+    def linkCount(self):
+        """The number of distinct local wiki links on this page."""
+        graph = self.linkGraph()
+        if graph is None: return len(self.canonicalLinks())
+        return graph.linkCount(self.getId())
+
+    security.declareProtected(Permissions.View, 'backlinkCount')
+    def backlinkCount(self):
+        """The number of pages linking to this one."""
+        graph = self.linkGraph()
+        if graph is None: return len(self.backlinksFor(self.getId()))
+        return graph.backlinkCount(self.getId())
+
+    security.declareProtected(Permissions.View, 'orphanedPageIds')
+    def orphanedPageIds(self):
+        """
+        The ids of the pages in this wiki which no other page links to.
+        Empty until the link graph has been built (see rebuildLinkGraph).
+        """
+        graph = self.linkGraph()
+        if graph is None: return []
+        return graph.orphans()
+
+    security.declareProtected(Permissions.View, 'wantedPageIds')
+    def wantedPageIds(self):
+        """
+        The canonical ids of the pages which are linked to in this wiki
+        but don't exist. Empty until the link graph has been built.
+        """
+        graph = self.linkGraph()
+        if graph is None: return []
+        return graph.wanted()
+
     security.declareProtected(Permissions.View, 'translateHelper')
     def translateHelper(self,msgid,map=None):
         """
@@ -1407,6 +1768,66 @@ InitializeClass(ZWikiPage)
 
 # rendering helper functions
 
+localwikilinkexpr = re.compile(localwikilink)
+
+class PageIdIndex:
+    """
+    An in-memory index of the page ids in a wiki folder.
+
+    This allows exact, case-insensitive and case-insensitive prefix
+    lookups of page ids without scanning the folder. Where several ids
+    match, the alphabetically first wins.
+    """
+    def __init__(self, ids=[]):
+        self._ids = {}      # id -> lowercased id
+        self._lower = {}    # lowercased id -> sorted list of ids
+        self._keys = []     # sorted list of (lowercased id, id)
+        for id in ids: self.add(id)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def has(self, id):
+        return self._ids.has_key(id)
+
+    def add(self, id):
+        if self.has(id): return
+        lower = id.lower()
+        self._ids[id] = lower
+        bisect.insort(self._lower.setdefault(lower,[]), id)
+        bisect.insort(self._keys, (lower,id))
+
+    def remove(self, id):
+        if not self.has(id): return
+        lower = self._ids[id]
+        del self._ids[id]
+        ids = self._lower[lower]
+        ids.remove(id)
+        if not ids: del self._lower[lower]
+        i = bisect.bisect_left(self._keys, (lower,id))
+        del self._keys[i]
+
+    def withIdIgnoringCase(self, id):
+        """The first id equal to id ignoring case, or None."""
+        ids = self._lower.get(id.lower())
+        return (ids and ids[0]) or None
+
+    def withIdPrefixIgnoringCase(self, prefix, numeric_match=0):
+        """
+        The first id starting with prefix ignoring case, or None.
+
+        With numeric_match, a number in prefix must match a whole number
+        in the id, eg 1 does not match 100.
+        """
+        prefix = prefix.lower()
+        keys, n = self._keys, len(prefix)
+        for i in xrange(bisect.bisect_left(keys, (prefix,)), len(keys)):
+            lower, id = keys[i]
+            if lower[:n] != prefix: break
+            if not (numeric_match and re.match(r'[0-9]',lower[n:])):
+                return id
+        return None
+
 def thunk_substituter(func, text):
     """Return a function which takes one arg and passes it with other args
     to passed-in func.
@@ -1429,7 +1850,10 @@ def within_literal(upto, after, state, text,
     - within a tag '<' body '>'
     - within an '<a href...>' tag's contents '</a>'
 
-    We also update the state dict accordingly.
+    We also update the state dict accordingly. Successive calls with the
+    same state should be for the same text, in ascending order; we search
+    only the text since the last call, so checking every link in a page
+    is linear in the size of the page.
     """
     # XXX This breaks on badly nested angle brackets and <pre></pre>, etc.
     lastend,inpre,incode,intag,inanchor = \
@@ -1437,7 +1861,10 @@ def within_literal(upto, after, state, text,
       state['inanchor']
       
     newintag = newincode = newinpre = newinanchor = 0
-    text = lower(text)
+    # lowercase the text just once, not for every link
+    if state.get('text') is not text:
+        state['text'], state['lowertext'] = text, lower(text)
+    text = state['lowertext']
     
     # Check whether '<pre>' is currently (possibly, still) prevailing.
     opening = rfind(text, '<pre', lastend, upto)
@@ -1496,21 +1923,39 @@ def within_literal(upto, after, state, text,
     state['lastend'] = after
     return newinpre or newincode or newintag or newinanchor
 
-def withinSgmlOrDtml(span,text):
+def withinSgmlOrDtml(span,text,state=None):
     """
     report whether the span lies inside an sgml or dtml tag in text
+
+    If a state dict is provided (as for within_literal), the tag spans
+    are found just once per text and remembered there, and successive
+    spans are assumed to be ascending and non-overlapping, so that we
+    need only look at the next tag each time.
     """
-    spans = sgmlAndDtmlSpansIn(text)
-    for s in spans:
-        if span[0] >= s[0] and span[1] <= s[1]:
-            return 1
-    return 0
+    if state is None:
+        for s in sgmlAndDtmlSpansIn(text):
+            if span[0] >= s[0] and span[1] <= s[1]:
+                return 1
+        return 0
+    if state.get('tagtext') is not text:
+        state['tagtext'] = text
+        state['tagspans'] = sgmlAndDtmlSpansIn(text)
+        state['tagindex'] = 0
+    spans, i = state['tagspans'], state['tagindex']
+    # skip tags ending before this span does; they can't contain it or
+    # any later span
+    while i < len(spans) and spans[i][1] < span[1]:
+        i += 1
+    state['tagindex'] = i
+    return (i < len(spans) and spans[i][0] <= span[0]) and 1 or 0
+
+sgmlordtmlpat = re.compile(dtmlorsgmlexpr)
 
 def sgmlAndDtmlSpansIn(text):
     """
     return a list of spans (tuples) of all sgml and dtml tags in text
     """
-    pat = re.compile(dtmlorsgmlexpr)
+    pat = sgmlordtmlpat
     spans = []
     lastpos = 0
     while 1:
@@ -205,6 +205,12 @@ def manage_afterAdd(self, item, container):
     if not self.hasCreatorInfo():
         self.setCreator(getattr(self,'REQUEST',None)) 
     self.wikiOutline().add(self.pageName())
+    self.updatePageIdIndex(added=self.getId())
+    if self.inRevisionsFolder(): self.updateRevisionIndex(added=self)
+    else:
+        self.updateSubscriptionIndex(self.getId(),new=self.subscriber_list)
+        self.updateLinkGraph()
+    self.clearLinkCache()
     self.index_object()
 ZWikiPage.ZWikiPage.manage_afterAdd = manage_afterAdd
 
@@ -212,6 +218,12 @@ def manage_afterClone(self, item):
     if not self.hasCreatorInfo():
         self.setCreator(getattr(self,'REQUEST',None))
     self.wikiOutline().add(self.pageName())
+    self.updatePageIdIndex(added=self.getId())
+    if self.inRevisionsFolder(): self.updateRevisionIndex(added=self)
+    else:
+        self.updateSubscriptionIndex(self.getId(),new=self.subscriber_list)
+        self.updateLinkGraph()
+    self.clearLinkCache()
     self.index_object()
 ZWikiPage.ZWikiPage.manage_afterClone = manage_afterClone
 
@@ -219,6 +231,12 @@ def manage_beforeDelete(self, item, container):
     # update the wiki outline, but if it's out of date just ignore
     try: self.wikiOutline().delete(self.pageName())
     except KeyError: pass
+    self.updatePageIdIndex(removed=self.getId())
+    if self.inRevisionsFolder(): self.updateRevisionIndex(removed=self.getId())
+    else:
+        self.updateSubscriptionIndex(self.getId(),old=self.subscriber_list)
+        self.updateLinkGraph(removed=1)
+    self.clearLinkCache()
     self.unindex_object()
 ZWikiPage.ZWikiPage.manage_beforeDelete = manage_beforeDelete
 
@@ -241,16 +259,20 @@ ZWikiPage.ZWikiPage.manage_delProperties = manage_delProperties
 original_changeProperties = ZWikiPage.ZWikiPage.manage_changeProperties
 def manage_changeProperties(self, REQUEST=None, **kw):
     """Update properties and reindex"""
+    state = self.catalogState()
     r = apply(original_changeProperties,(self, REQUEST), kw)
-    self.reindex_object()
+    self.clearLinkCache() # eg issue status affects link style
+    self.reindexChanged(self.changedAttributes(state))
     return r
 ZWikiPage.ZWikiPage.manage_changeProperties = manage_changeProperties
 
 original_editProperties = ZWikiPage.ZWikiPage.manage_editProperties
 def manage_editProperties(self, REQUEST):
     """Edit Properties and reindex"""
+    state = self.catalogState()
     r = original_editProperties(self, REQUEST)
-    self.reindex_object()
+    self.clearLinkCache()
+    self.reindexChanged(self.changedAttributes(state))
     return r
 ZWikiPage.ZWikiPage.manage_editProperties = manage_editProperties
 
@@ -318,6 +340,10 @@ def addWikiFromZodb(self,new_id, new_title='', wiki_type='basic',
     self.manage_clone(prototype, new_id, REQUEST)
     wiki = getattr(self, new_id)
     wiki.manage_changeProperties(title=new_title)
+    pages = wiki.objectValues(spec='ZWiki Page')
+    if pages:
+        pages[0].rebuildLinkGraph()
+        pages[0].rebuildSubscriptionIndex()
     # could do stuff with ownership here
     # set it to low-privileged "nobody" by default ?
 
@@ -387,6 +413,8 @@ def addWikiFromFs(self, new_id, title='', wiki_type='basic',
     dir = os.path.join(package_home(globals()),'content',wiki_type)
     createFilesFromFsFolder(self, f, dir) # recurses
     f.objectValues(spec='ZWiki Page')[0].updatecontents()
+    f.objectValues(spec='ZWiki Page')[0].rebuildLinkGraph()
+    f.objectValues(spec='ZWiki Page')[0].rebuildSubscriptionIndex()
 
 def addZWikiPage(self, id, title='',
                   page_type=PAGETYPES[0]._id, file='', parents=[]):
@@ -113,7 +113,7 @@ class PageTypeBase:
     
     def preRenderMessages(self,page):
         t = ''
-        for m in page.messages(): t += self.preRenderMessage(page,m)
+        for m in page.latestComments(): t += self.preRenderMessage(page,m)
         if t: t = self.discussionSeparator(page) + t
         return t
 
@@ -6,6 +6,7 @@ from docutils.nodes import section
 from common import *
 from Products.ZWiki.i18n import _
 from Products.ZWiki.plugins.pagetypes import registerPageType
+from Products.ZWiki.RenderPool import renderInPool, RenderTimeout
 
 # RST verbosity (MORE <- 0 debug, 1 info, 2 warning, 3 error, 4 severe -> LESS) :
 RST_REPORT_LEVEL = 4
@@ -26,12 +27,23 @@ class PageTypeRst(PageTypeBase):
     def format(self, page, t):
         # rst returns an encoded string.. decode it back to unicode
         # hopefully the rst encoding in zope.conf matches the wiki's encoding
-        return page.tounicode(HTML(
+        # (we pass the encodings explicitly, for render pool workers
+        # which haven't read zope.conf)
+        try:
+            return page.tounicode(renderInPool(
+                len(t), HTML,
                 t,
                 report_level=RST_REPORT_LEVEL,
                 initial_header_level=RST_INITIAL_HEADER_LEVEL-1,
+                input_encoding=default_input_encoding,
+                output_encoding=default_output_encoding,
+                language_code=default_language_code,
                 settings={'raw_enabled':getattr(page,'rst_raw_enabled',0) and 1}
                 ))
+        except RenderTimeout, e:
+            BLATHER('reStructured Text formatting failed: %s' % e)
+            return '<pre>reStructured Text formatting failed:\n%s</pre>' \
+                   % html_quote(str(e))
 
     def preRender(self, page, text=None):
         t = text or (page.document()+'\n'+MIDSECTIONMARKER+ \
@@ -1,6 +1,11 @@
 from common import *
 from Products.ZWiki.i18n import _
 from Products.ZWiki.plugins.pagetypes import registerPageType
+from Products.ZWiki.Defaults import STX_BLOCK_CACHE_SIZE
+from Products.ZWiki.Utils import LRUCache
+from Products.ZWiki.RenderPool import renderInPool
+try: from hashlib import md5
+except ImportError: from md5 import new as md5 # python < 2.5
 
 from Globals import MessageDialog
 try: # zope 2.10 and up uses zope3 stx
@@ -44,10 +49,10 @@ class PageTypeStx(PageTypeBaseHtml):
         # standard structured text can't handle unicode
         # it may not handle non-ascii either, so this could still fail
         t = page.toencoded(t)
-        # let STX loose on it; don't let a formatter error break the whole page
+        # let STX loose on it, a block at a time; don't let a formatter
+        # error break the whole page
         try:
-            # XXX slow!
-            t = HTMLWithImages(ZwikiDocumentWithImages(structurize(t)), level=2)
+            t = self.formatBlocks(stxBlocks(t))
         except:
             BLATHER('Structured Text formatting failed: %s' \
                  % (formattedTraceback()))
@@ -57,10 +62,25 @@ class PageTypeStx(PageTypeBaseHtml):
 
         # clean up
         t = re.sub(r'(<|&lt;)!--NOSTX--(>|&gt;)', r'', t)
-        # strip html & body added by some zope versions
-        t = re.sub(r'(?sm)^<html.*<body.*?>\n(.*)</body>\n</html>\n',r'\1',t)
         return t
 
+    def formatBlocks(self, blocks):
+        """
+        Render some top-level blocks of (encoded) Structured Text as
+        HTML, getting those we've done before from STXBLOCKS and the
+        rest from formatStxBlocks, in the render pool if there is one.
+        """
+        keys = [md5(b).hexdigest() for b in blocks]
+        html = [STXBLOCKS.get(k) for k in keys]
+        todo = [i for i in range(len(blocks)) if html[i] is None]
+        if todo:
+            new = [blocks[i] for i in todo]
+            new = renderInPool(sum(map(len,new)), formatStxBlocks, new)
+            for i, h in zip(todo, new):
+                html[i] = h
+                STXBLOCKS.set(keys[i], h)
+        return ''.join(html)
+
     def preRender(self, page, text=None):
         """
         Do as much up-front rendering work as possible and save it.
@@ -99,6 +119,57 @@ class PageTypeStx(PageTypeBaseHtml):
         return t
 
 
+# formatted structured text blocks, by digest of their source
+STXBLOCKS = LRUCache(STX_BLOCK_CACHE_SIZE)
+
+def stxBlocks(t,
+              delimiter=re.compile(r'\n\s*\n|\r\n\s*\r\n'),
+              listitem=re.compile(r'\s*([-*o]\s|\w+\.|[0-9]+\s)').match,
+              description=re.compile(r'\s--\s').search):
+    """
+    Split some Structured Text into blocks which can be formatted
+    separately, giving the same HTML as formatting the whole.
+
+    A block is a top-level (unindented) paragraph with any following
+    indented paragraphs, which STX nests inside it. Consecutive blocks
+    which might be list items are kept together, since STX makes a
+    single list of them.
+    """
+    # paragraph start and end offsets
+    paragraphs, start = [], 0
+    for m in delimiter.finditer(t):
+        paragraphs.append((start, m.start()))
+        start = m.end()
+    paragraphs.append((start, len(t)))
+    blocks, blockstart, prevlist = [], 0, 0
+    # if the first paragraph is indented, STX nests what follows
+    # differently; leave such text in one piece
+    for start, end in paragraphs:
+        if t[start:end].strip():
+            if t[start].isspace(): return [t]
+            break
+    for start, end in paragraphs:
+        if not t[start:end].strip() or t[start].isspace(): continue
+        islist = listitem(t, start, end) or description(t, start, end)
+        if start and not (islist and prevlist) and t[blockstart:start].strip():
+            blocks.append(t[blockstart:start])
+            blockstart = start
+        prevlist = islist
+    blocks.append(t[blockstart:])
+    return blocks
+
+def formatStxBlocks(blocks):
+    """
+    Render a list of (encoded) Structured Text blocks as HTML, returning
+    a list of HTML strings. Runs in render pool workers.
+    """
+    html = []
+    for t in blocks:
+        t = HTMLWithImages(ZwikiDocumentWithImages(structurize(t)), level=2)
+        # strip html & body added by some zope versions
+        html.append(re.sub(r'(?sm)^<html.*<body.*?>\n(.*)</body>\n</html>\n',r'\1',t))
+    return html
+
 # structured text customizations
 class ZwikiDocumentWithImages(DocumentWithImages):
 
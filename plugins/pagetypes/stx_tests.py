@@ -32,3 +32,43 @@ class Tests(ZwikiTestCase):
         self.assertEquals(
             u'<p><a href="mailto:&#97;&#46;&#98;&#64;&#99;&#46;&#99;&#111;&#109;">&#97;&#46;&#98;&#64;&#99;&#46;&#99;&#111;&#109;</a></p>\n<p>\n</p>\n',
             self.p.renderText('mailto:a.b@c.com','stx'))
+
+    def test_stxBlocks(self):
+        from Products.ZWiki.plugins.pagetypes.stx import stxBlocks
+        self.assertEquals(stxBlocks(''),[''])
+        self.assertEquals(stxBlocks('a\n\n  b\n\nc\n'),['a\n\n  b\n\n','c\n'])
+        # list items stay together
+        self.assertEquals(stxBlocks('a\n\n* b\n\n* c\n\nd'),
+                          ['a\n\n','* b\n\n* c\n\n','d'])
+        # indented first paragraphs stop any splitting
+        self.assertEquals(stxBlocks('  a\n\nb'),['  a\n\nb'])
+
+    def test_format_in_render_pool(self):
+        from Products.ZWiki import RenderPool
+        from Products.ZWiki.plugins.pagetypes.stx import STXBLOCKS
+        t = 'A *test*\n\n  with **some** \n\n* structured\n\n* text\n'
+        self.p.edit(text=t)
+        expected = self.p.render(bare=1)
+        saved = RenderPool.RENDER_POOL_SIZE, RenderPool.RENDER_POOL_MIN_SIZE
+        RenderPool.RENDER_POOL_SIZE, RenderPool.RENDER_POOL_MIN_SIZE = 1, 0
+        try:
+            STXBLOCKS.clear()
+            self.p.preRender(clear_cache=1)
+            self.assertEquals(self.p.render(bare=1),expected)
+            self.assert_(RenderPool.POOL.idle) # it was used
+        finally:
+            RenderPool.RENDER_POOL_SIZE, RenderPool.RENDER_POOL_MIN_SIZE = saved
+            if RenderPool.POOL: RenderPool.POOL.stop()
+            RenderPool.POOL = None
+
+    def Xtest_format_speed(self):
+        # editing a large page should cost in proportion to the edit
+        import time
+        para = 'Section %d\n\n  Some *text* with a "link":http://zwiki.org and **bold** words.\n\n  * item one\n\n  * item two\n\n'
+        t = ''.join([para % i for i in range(2500)]) # ~200KB
+        start = time.time()
+        self.p.edit(text=t)
+        print 'first edit: %.3fs' % (time.time() - start)
+        start = time.time()
+        self.p.edit(text=t.replace('Section 500\n','Section 500 edited\n'))
+        print 'small edit: %.3fs' % (time.time() - start)
@@ -16,7 +16,7 @@ from Products.ZWiki import Permissions
 from Products.ZWiki.Utils import BLATHER
 from Products.ZWiki.Views import loadPageTemplate, TEMPLATES
 
-TEMPLATES['ratingform'] = loadPageTemplate('ratingform','plugins/rating')
+TEMPLATES.register('ratingform', loadPageTemplate, 'ratingform', 'plugins/rating')
 
 RATING_METADATA = [
     'voteCount',
@@ -95,8 +95,9 @@ class PluginRating:
                 votes[username] = vote
                 BLATHER("%s: recorded %s vote for %s" % (self.toencoded(self.pageName()),vote,username))
             self.setVotes(votes)
+            self.clearRenderCache()
             # update catalog, just the affected indexes
-            self.catalog().catalog_object(self, idxs=['rating', 'voteCount'], uid=None)
+            self.reindexChanged(['_votes'])
             if REQUEST:
                 REQUEST.RESPONSE.redirect(
                     # redirect to the page they came on.. might be some
@@ -18,17 +18,18 @@ from Products.ZWiki.Views import loadDtmlMethod, loadPageTemplate, TEMPLATES
      
 from Products.ZWiki.i18n import _
 
-TEMPLATES.update({
-    'issuepropertiesform': loadDtmlMethod('issuepropertiesform','plugins/tracker'),
+for name, load in [
+    ('issuepropertiesform', loadDtmlMethod),
     # page template wrappers
-    'issuetracker'       : loadPageTemplate('issuetracker','plugins/tracker'),
-    'issuebrowser'       : loadPageTemplate('issuebrowser','plugins/tracker'),
-    'filterissues'       : loadPageTemplate('filterissues','plugins/tracker'),
+    ('issuetracker',        loadPageTemplate),
+    ('issuebrowser',        loadPageTemplate),
+    ('filterissues',        loadPageTemplate),
     # the DTML implementations
-    'IssueTracker'       : loadDtmlMethod('IssueTracker','plugins/tracker'),
-    'IssueBrowser'       : loadDtmlMethod('IssueBrowser','plugins/tracker'),
-    'FilterIssues'       : loadDtmlMethod('FilterIssues','plugins/tracker'),
-    })
+    ('IssueTracker',        loadDtmlMethod),
+    ('IssueBrowser',        loadDtmlMethod),
+    ('FilterIssues',        loadDtmlMethod),
+    ]:
+    TEMPLATES.register(name, load, name, 'plugins/tracker')
 
 # issue tracker defaults, will be installed as folder properties
 ISSUE_CATEGORIES = [
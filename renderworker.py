@@ -0,0 +1,74 @@
+######################################################################
+# a render pool worker process
+
+"""
+A render pool worker (see RenderPool.py). This runs as a separate
+python process, reading requests from stdin and writing results to
+stdout. Messages are pickles preceded by their length.
+
+The first message gives the parent's sys.path and Products package
+path, so that we can import what it does. Each request after that is
+(module name, function name, args, keyword args), and is answered with
+(1, the function's result) or (0, a traceback). We exit when stdin is
+closed. This module must not import zope or zwiki code itself.
+"""
+
+import os, sys, struct, select, traceback
+from time import time
+from cPickle import dumps, loads
+
+def send(f, obj):
+    """Write a message to file f."""
+    data = dumps(obj, 2)
+    f.write(struct.pack('!I', len(data)) + data)
+    f.flush()
+
+class Timeout(Exception): pass
+
+def readExactly(fd, n, deadline=None):
+    chunks = []
+    while n:
+        if deadline is not None:
+            wait = deadline - time()
+            if wait <= 0 or not select.select([fd],[],[],wait)[0]:
+                raise Timeout
+        data = os.read(fd, n)
+        if not data: raise EOFError
+        chunks.append(data)
+        n -= len(data)
+    return ''.join(chunks)
+
+def receive(f, deadline=None):
+    """
+    Read a message from file f, giving up with Timeout at deadline
+    (time.time() value), if given. Returns None at end of file.
+    """
+    fd = f.fileno()
+    try:
+        size = struct.unpack('!I', readExactly(fd, 4, deadline))[0]
+    except EOFError:
+        return None
+    return loads(readExactly(fd, size, deadline))
+
+def main():
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdout = sys.stderr # stray output would break the protocol
+    config = receive(stdin)
+    if config is None: return
+    sys.path[:] = config['path']
+    if config.get('products'):
+        import Products
+        Products.__path__[:] = config['products']
+    while 1:
+        request = receive(stdin)
+        if request is None: break
+        module, name, args, kw = request
+        try:
+            __import__(module)
+            result = (1, getattr(sys.modules[module], name)(*args, **kw))
+        except:
+            result = (0, traceback.format_exc())
+        send(stdout, result)
+
+if __name__ == '__main__':
+    main()
@@ -89,6 +89,74 @@ class Tests(ZwikiTestCase):
         self.assert_(catalog._catalog.getIndex('SearchableText').meta_type == 'ZCTextIndex')
         self.assertEqual(catalog._catalog.getIndex('SearchableText').getLexicon().getId(),'DifferentLexicon')
 
+    def test_ensureWikiPathIndex(self):
+        p = self.page
+        p.ensureCatalog()
+        catalog = p.catalog()
+        self.assert_('wikiPath' in catalog.indexes())
+        p.saveRevision()
+        p.create('NewPage')
+        self.assertEqual(['NewPage','TestPage'], sorted([b.id for b in p.pages()]))
+        # an older catalog without the index gets one from upgradeAll
+        # (via setupCatalog), not from the per-view upgrade
+        catalog.delIndex('wikiPath')
+        self.assertEqual(2, len(p.pages()))
+        p.upgrade()
+        self.failIf('wikiPath' in catalog.indexes())
+        p.setupCatalog(reindex=0)
+        self.assert_('wikiPath' in catalog.indexes())
+        self.assertEqual(['NewPage','TestPage'], sorted([b.id for b in p.pages()]))
+
+    def test_runPageJob(self):
+        p = self.page
+        for id in ['PageA','PageB','PageC','PageD']: p.create(id)
+        allids = sorted(p.pageIds())
+        done = []
+        def action(page): done.append(page.getId())
+        self.assertEqual(5, p.runPageJob('test', action, batch=2))
+        self.assertEqual(allids, done)
+        self.assert_(p.pageJobFinished('test'))
+        # an interrupted run carries on after the last committed page
+        checkpoint = p.pageJobCheckpoint('test')
+        checkpoint['cursor'], checkpoint['done'] = 'PageB', 0
+        p.pageJobRun('test')['finished'] = 0
+        del done[:]
+        p.runPageJob('test', action, batch=2)
+        self.assertEqual(['PageC','PageD','TestPage'], done)
+        # shards divide the pages between them; shard 0 sets up each
+        # run, the last shard to finish finishes it
+        calls = []
+        for run in range(2):
+            del done[:]
+            for shard in range(3):
+                p.runPageJob('sharded', action, shard=shard, shards=3,
+                             setup=lambda:calls.append('setup'),
+                             finish=lambda:calls.append('finish'))
+                self.assertEqual(shard == 2, p.pageJobFinished('sharded', 3))
+            self.assertEqual(allids, sorted(done))
+        self.assertEqual(['setup','finish']*2, calls)
+        # a shard which has done its part of the run does nothing more
+        del done[:]
+        p.runPageJob('sharded', action, shard=1, shards=3)
+        self.assertEqual([], done)
+
+    def test_reindexCatalog(self):
+        p = self.page
+        p.setupCatalog(reindex=0)
+        p.create('PageA', text='some zebras')
+        catalog = p.catalog()
+        catalog.manage_catalogClear()
+        self.assertEqual(0, len(catalog(SearchableText='zebras')))
+        p.reindexCatalog(batch=1)
+        self.assertEqual(1, len(catalog(SearchableText='zebras')))
+        self.assert_(p.pageJobFinished('reindexCatalog'))
+        # just some indexes
+        p.pageWithName('PageA').raw = 'some giraffes'
+        p.reindexCatalog(idxs='Title, NoSuchIndex')
+        self.assertEqual(0, len(catalog(SearchableText='giraffes')))
+        p.reindexCatalog(idxs=['SearchableText'])
+        self.assertEqual(1, len(catalog(SearchableText='giraffes')))
+
     def xtest_setupTracker(self): #slow
         self.assert_(not self.page.catalog())
         self.assertEqual(len(self.page.pages()),1)
@@ -17,3 +17,56 @@ class Tests(ZwikiTestCase):
         p.comment('test')
         self.assertEqual(p.commentCount(),2)
 
+
+    def test_commentIndex(self):
+        p = self.page
+        p.edit(text='document\n')
+        p.comment('one', subject_heading='first', message_id='<1@test>')
+        p.comment('two', subject_heading='second', in_reply_to='<1@test>')
+        # the index is updated as comments are added..
+        index = p.commentIndex()
+        self.assertEqual(len(index),2)
+        p.comment('three')
+        self.assert_(p.commentIndex() is index)
+        self.assertEqual(p.commentCount(),3)
+        self.assertEqual(p.commentNumber(-1).get_payload().strip(),'three')
+        self.assertEqual(p.commentWithId('<1@test>').get_payload().strip(),'one')
+        self.assertEqual(p.commentHeaders()[1]['in-reply-to'],'<1@test>')
+        # ..and agrees with parsing the whole page
+        mbox = [m.as_string() for m in p.mailbox()]
+        self.assertEqual([m.as_string() for m in p.comments()],mbox)
+        # and is rebuilt after other changes
+        p.edit(text='document\n')
+        self.assertEqual(p.commentCount(),0)
+        self.assertEqual(p.commentNumber(0),None)
+
+    def test_discussionPagination(self):
+        p = self.page
+        p.folder().discussion_page_size = 2
+        for c in ['one','two','three','four','five']:
+            p.comment(c, subject_heading=c)
+        self.assertEqual(p.discussionChunkCount(),3)
+        self.assertEqual([m['subject'] for m in p.latestComments()],['five'])
+        # only the latest chunk is in the page..
+        self.assert_(p.preRendered().find('five') != -1)
+        self.assert_(p.preRendered().find('four') == -1)
+        self.assert_(p.olderCommentsLink())
+        # ..the older ones are kept separately
+        self.assert_(p.discussionChunk(0).find('two') != -1)
+        self.assert_(p.discussionChunk(1).find('four') != -1)
+        self.assertEqual(p.discussionChunk(2),'')
+        self.assertEqual(p.discussionChunk('x'),'')
+        # saved revisions keep their older comments viewable
+        rev = p.revision(p.revisionNumber()-1) # saved with four comments
+        self.assert_(rev.olderCommentsLink())
+        self.assert_(rev.discussionChunk(0).find('two') != -1)
+        # and a full prerender gives the same
+        chunks = p.discussionChunks()
+        p.preRender(clear_cache=1)
+        self.assertEqual(p.discussionChunks(),chunks)
+        # without pagination, everything is shown again
+        p.folder().discussion_page_size = 0
+        p.preRender(clear_cache=1)
+        self.assert_(p.preRendered().find('one') != -1)
+        self.assertEqual(p.discussionChunks(),[])
+        self.assertEqual(p.olderCommentsLink(),'')
@@ -714,6 +714,28 @@ bbb
         transaction.get().commit()
         p.render(bare=1)
         
+    def test_reindexChanged(self):
+        p = self.page
+        p.setupCatalog()
+        catalog = p.catalog()
+        p.edit(text='some zebras')
+        self.assertEqual(1, len(catalog(SearchableText='zebras')))
+        state = p.catalogState()
+        p.setParents(['SomePage'])
+        self.assertEqual(['parents'], p.changedAttributes(state))
+        # only the dependent indexes and metadata are updated
+        p.raw = 'some giraffes'
+        p.reindexChanged(['parents'])
+        self.assertEqual(0, len(catalog(SearchableText='giraffes')))
+        self.assertEqual(1, len(catalog(parents='SomePage')))
+        self.assertEqual(['SomePage'], catalog(id=p.getId())[0].parents)
+        # an attribute we don't know about gets a full reindex
+        p.reindexChanged(['some_property'])
+        self.assertEqual(1, len(catalog(SearchableText='giraffes')))
+        # edits reindex what they changed
+        p.edit(text='some camels')
+        self.assertEqual(1, len(catalog(SearchableText='camels')))
+
     def test_expungeLastEditor(self):
         p, r = self.page, self.request
         def be(u):r.cookies['zwiki_username'] = u
@@ -800,3 +822,21 @@ bbb
         p._replaceLinks('bla bla','flab flab',REQUEST=None)
         self.assertEqual(p.read(),
             u'something [flab flab] or [ga ga] other FlabFlab is ((flab flab)) - see: bla bla not')
+
+    def test_checkForSpam(self):
+        from zExceptions import Forbidden
+        from Products.ZWiki.SpamFilter import spamPatterns
+        p = self.page
+        p.folder().spampatterns = ['cheap\s+pills', 'casino', '(bad']
+        self.assertRaises(Forbidden, p.checkForSpam, 'buy cheap  pills now')
+        self.assertRaises(Forbidden, p.checkForSpam, 'online casino')
+        p.checkForSpam('a good edit (with brackets)')
+        # compiled once per pattern list, ignoring invalid patterns
+        patterns = spamPatterns(p.getSpamPatterns())
+        self.assert_(patterns is spamPatterns(list(p.folder().spampatterns)))
+        self.assertEqual(2, len(patterns))
+        # combining patterns doesn't change what each one matches
+        p.folder().spampatterns = ['(?i)viagra', 'CASINO']
+        p.checkForSpam('online casino')
+        p.folder().spampatterns = ['(buy)now', r'(\w)\1\1\1']
+        self.assertRaises(Forbidden, p.checkForSpam, 'xaaaax')
@@ -1,6 +1,7 @@
 from testsupport import *
 ZopeTestCase.installProduct('ZWiki')
 ZopeTestCase.installProduct('ZCatalog')
+from Products.ZWiki.Defaults import REVISION_SNAPSHOT_INTERVAL
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -155,3 +156,78 @@ class Tests(ZwikiTestCase):
         p.saveRevision()
         self.assertEqual(f, p.revisionsFolder()['TestPage.1'].wikiFolder())
 
+    def test_compactRevisions(self):
+        p = self.page
+        p.folder().compact_revisions = 1
+        texts = [p.text()]
+        for i in range(12):
+            p.edit(text=p.text() + '\nline %d' % i)
+            texts.append(p.text())
+        revs = p.oldRevisions()
+        self.assertEqual(texts[:-1], [r.text() for r in revs])
+        # revisions don't store pre-rendered text, and most store a delta
+        self.assert_(revs[1].isCompactRevision())
+        self.assertEqual('', revs[1].aq_base._prerendered)
+        self.assertEqual('', revs[1].aq_base.raw)
+        # with a full copy every so often
+        self.assert_(revs[REVISION_SNAPSHOT_INTERVAL].aq_base.raw)
+        # nor pre-rendered older comments
+        p.folder().discussion_page_size = 1
+        for c in ['one','two','three']: p.comment(c, subject_heading=c)
+        self.assert_(p.discussionChunks())
+        rev = p.revision(p.revisionNumber()-1) # saved with two comments
+        self.failIf(rev.aq_base.__dict__.has_key('_discussionchunks'))
+        p.folder().discussion_page_size = 0
+        # deleting a revision doesn't affect later ones
+        p.revisionsFolder().manage_delObjects(ids=[revs[1].getId()])
+        self.assertEqual(texts[2], p.revision(3).text())
+        # expunging makes a standalone page again
+        p.expunge(3)
+        p = p.pageWithId(p.getId())
+        self.assertEqual(texts[2], p.text())
+        self.failIf(p.isCompactRevision())
+        p.edit(text='new text')
+        self.assertEqual('new text', p.text())
+
+    def test_compactExistingRevisions(self):
+        p = self.page
+        for i in range(5): p.append(text='\ncomment %d' % i)
+        texts = [r.text() for r in p.oldRevisions()]
+        self.setRoles(['Manager'])
+        before, after = p.compactRevisions()
+        self.assert_(after < before)
+        self.assertEqual(texts, [r.text() for r in p.oldRevisions()])
+        self.assert_(p.revision(2).isCompactRevision())
+        # running it again changes nothing
+        self.assertEqual((after, after), p.compactRevisions())
+
+    def test_revisionIndex(self):
+        p = self.page
+        self.assertEqual(None, p.revisionIndex())
+        p.append(text='x', log='"first"')
+        p.append(text='y', log='"second"')
+        p.append(text='z', log='"third"')
+        index = p.revisionIndex()
+        self.assertEqual([1,2,3], [e[0] for e in index['TestPage']])
+        self.assertEqual('"second"', index['TestPage'][2][3])
+        self.assertEqual(4, p.revisionCount())
+        self.assertEqual('third', p.lastlog())
+        self.assertEqual('second', p.lastlog(1))
+        # kept up to date by saveRevision and the ZMI hooks
+        p.append(text='w')
+        self.assertEqual([1,2,3,4], p.oldRevisionNumbers())
+        p.revisionsFolder().manage_delObjects(ids=['TestPage.2'])
+        self.assertEqual([1,3,4], p.oldRevisionNumbers())
+        self.assertEqual(None, p.revision(2))
+        self.assertEqual('TestPage.3', p.revision(3).getId())
+        # and by expunge
+        p.expunge(3)
+        p = p.pageWithId('TestPage')
+        self.assertEqual([1], p.oldRevisionNumbers())
+        self.assertEqual(index.items(), p.rebuildRevisionIndex().items())
+        # in a wiki from before the index, it's not built on view, and
+        # the revisions are found the slow way until upgradeAll
+        del p.revisionsFolder()._revisionindex
+        self.assertEqual(None, p.revisionIndex())
+        self.assertEqual([1], p.oldRevisionNumbers())
+        self.assertEqual(None, p.revisionIndex())
@@ -1,11 +1,14 @@
 from testsupport import *
-from Products.ZWiki.Mail import MailIn, stripBottomQuoted, stripSignature
+from Products.ZWiki.Mail import MailIn, stripBottomQuoted, stripSignature, GenericMailHost
+from Products.ZWiki.MailQueue import MailQueue
 ZopeTestCase.installProduct('ZWiki')
+ZopeTestCase.installProduct('MailHost')
 
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(SubscriptionTests))
     suite.addTest(unittest.makeSuite(MailoutTests))
+    suite.addTest(unittest.makeSuite(MailQueueTests))
     suite.addTest(unittest.makeSuite(MailinTests))
     return suite
 
@@ -63,6 +66,33 @@ class SubscriptionTests(ZwikiTestCase):
         self.assertEquals(p.allSubscriptionsFor('b@b.b'),['whole_wiki', 'TestPage'])
         self.assertEquals(p.allSubscriptionsFor('c@c.c'),[])
         
+    def test_subscriptionIndex(self):
+        p = self.page
+        p.subscribe('a@a.a')
+        p.subscribe('me',edits=1)
+        # not built on demand; lookups scan the subscriber lists until it is
+        self.assertEquals(None, p.subscriptionIndex())
+        self.assertEquals(['TestPage'], p.allSubscriptionsFor('me'))
+        self.assertEquals(None, p.subscriptionIndex())
+        index = p.rebuildSubscriptionIndex()
+        self.assertEquals(('TestPage',), index['a@a.a'])
+        self.assertEquals(('TestPage',), index['me'])
+        # kept up to date by (un)subscribe, rename and delete
+        p.wikiSubscribe('a@a.a')
+        q = p.folder()[p.create('OtherPage')]
+        q.subscribe('A@A.A')
+        self.assertEquals(('OtherPage','TestPage','whole_wiki'), index['a@a.a'])
+        self.assertEquals(['whole_wiki','OtherPage','TestPage'],
+                          p.allSubscriptionsFor('a@a.a'))
+        p.unsubscribe('a@a.a')
+        self.assertEquals(('OtherPage','whole_wiki'), index['a@a.a'])
+        q.rename('RenamedPage')
+        self.assertEquals(('RenamedPage','whole_wiki'), index['a@a.a'])
+        p.delete()
+        self.failIf(index.has_key('me'))
+        self.assertEquals(index.items(),
+                          self.wiki.RenamedPage.rebuildSubscriptionIndex().items())
+
     def test_otherSubscriptionsFor(self):
         thispage = mockPage(__name__='ThisPage')
         thispage.create('ThatPage')
@@ -120,6 +150,35 @@ class MailoutTests(ZwikiTestCase):
         self.p.comment(text='comment',username='me',time='1999/12/31 GMT')
         self.assertEquals(self.p.mock_mailout_happened,1)
 
+    def test_queuedMailout(self):
+        import time, tempfile, shutil, transaction
+        from Products.MailHost.MailHost import MailHost
+        from Products.ZWiki import MailQueue
+        server = MockSMTPServer()
+        dir = tempfile.mkdtemp()
+        saveddir, MailQueue.MAIL_QUEUE_DIR = MailQueue.MAIL_QUEUE_DIR, dir
+        try:
+            self.wiki._setObject('MailHost', MailHost('MailHost', '',
+                                 smtp_host=server.host, smtp_port=server.port))
+            self.wiki.mail_from = 'wiki@example.com'
+            # the worker would look the mail host up with its own connection
+            queue = MailQueue.mailQueue()
+            queue.servers = lambda path: \
+                GenericMailHost(self.app.unrestrictedTraverse(path)).server()
+            self.p.sendMailTo(['you@example.com'], 'hello', self.request)
+            transaction.commit()
+            for i in range(100):
+                if server.received: break
+                time.sleep(0.1)
+        finally:
+            MailQueue.stopMailQueue(dir)
+            MailQueue.MAIL_QUEUE_DIR = saveddir
+            server.stop()
+            shutil.rmtree(dir)
+        self.assertEquals(1, len(server.received))
+        self.assert_('you@example.com' in server.received[0][1])
+        self.assert_('\nhello\n' in server.received[0][2])
+
     def test_mailoutCommentWithOrWithoutSubjectField(self):
         self.p.comment(text='comment',username='me',subject_heading='[test]')
         self.assertEquals(self.p.mock_mailout_happened,1)
@@ -127,6 +186,94 @@ class MailoutTests(ZwikiTestCase):
         self.p.comment(text='comment',username='me')
         self.assertEquals(self.p.mock_mailout_happened,1)
 
+class MailQueueTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        self.queue = MailQueue(self.dir)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def test_envelope(self):
+        class mailhost: meta_type = 'Mail Host'
+        m = GenericMailHost(mailhost())
+        self.assert_(m.canQueue())
+        fields = {'From':'Me <me@example.com>', 'Reply-To':'', 'To':'wiki@example.com',
+                  'Bcc':'a@example.com, B <b@example.com>', 'Subject':'s',
+                  'In-Reply-To':'', 'Message-ID':'<1>', 'X-Zwiki-Version':'',
+                  'X-BeenThere':'', 'List-Id':'', 'List-Post':'',
+                  'List-Subscribe':'', 'List-Unsubscribe':'', 'List-Archive':'',
+                  'List-Help':'', 'charset':'utf-8', 'body':'hello'}
+        mfrom, mto, msg = m.envelope(fields)
+        self.assertEquals('me@example.com', mfrom)
+        self.assertEquals(['wiki@example.com','a@example.com','b@example.com'], mto)
+        self.assert_('Bcc:' not in msg)
+        self.assert_(msg.endswith('\nhello\n'))
+
+    def test_delivery(self):
+        server = MockSMTPServer()
+        self.queue.servers = lambda path: (server.host, server.port, None, None)
+        try:
+            for i in range(3):
+                self.queue.put('me@example.com', ['you@example.com'],
+                               'Subject: %d\n\nhello\n' % i, '/MailHost')
+            self.assertEquals(3, len(self.queue.waiting()))
+            self.assertEquals(2, self.queue.process(batch=2))
+            self.assertEquals(1, self.queue.process())
+        finally:
+            server.stop()
+        self.assertEquals([], self.queue.waiting())
+        self.assertEquals(['Subject: 0','Subject: 1','Subject: 2'],
+                          [m[2].splitlines()[0] for m in server.received])
+        self.assertEquals(['you@example.com'], server.received[0][1])
+
+    def test_retry(self):
+        # with no server listening, messages wait for a later retry
+        server = MockSMTPServer()
+        self.queue.servers = lambda path: (server.host, server.port, None, None)
+        server.stop()
+        self.queue.put('me@example.com', ['you@example.com'], 'hello', '/MailHost')
+        self.assertEquals(0, self.queue.process())
+        self.assertEquals(1, len(self.queue.waiting()))
+        self.assertEquals([], self.queue.due())
+        name = self.queue.waiting()[0]
+        self.assertEquals('1', name.split('-')[1])
+        import time
+        self.assertEquals([name], self.queue.due(now=time.time()+3600))
+
+    def test_loginFailure(self):
+        # a mail host we can't log in to doesn't hold up the others
+        import os
+        server = MockSMTPServer()
+        self.queue.servers = lambda path: \
+            (server.host, server.port, path == '/Bad' and 'me' or None, 'secret')
+        try:
+            self.queue.put('me@example.com', ['you@example.com'], 'bad', '/Bad')
+            self.queue.put('me@example.com', ['you@example.com'], 'good', '/Good')
+            self.assertEquals(1, self.queue.process())
+        finally:
+            server.stop()
+        self.assertEquals([], os.listdir(os.path.join(self.dir,'cur')))
+        self.assertEquals(1, len(self.queue.waiting()))
+        self.assertEquals(['good'], [m[2] for m in server.received])
+
+    def test_claimIsNotStale(self):
+        # a message queued long ago is not taken for abandoned when claimed
+        import os
+        name = self.queue.put('me@example.com', ['you@example.com'], 'hello', '/MailHost')
+        os.utime(os.path.join(self.dir,'new',name), (0,0))
+        self.assert_(self.queue.claim(name))
+        self.queue.recover()
+        self.assertEquals([name], os.listdir(os.path.join(self.dir,'cur')))
+        self.assertEquals([], self.queue.waiting())
+
+    def test_noCredentialsInSpool(self):
+        name = self.queue.put('me@example.com', ['you@example.com'], 'hello', '/MailHost')
+        entry = self.queue.claim(name)
+        self.assertEquals(['from','mailhost','msg','to'], sorted(entry.keys()))
+
 
 THISPAGE    = 'TestPage'
 TESTSENDER  = 'sender'
@@ -73,6 +73,41 @@ class Tests(unittest.TestCase):
                            'TestPage',
                            ])
         
+    def test_nestingFollowsChanges(self):
+        o = self.outline
+        o.add('NewPage',['SingletonPage'])
+        self.assertEquals(o.nesting()[1],['SingletonPage','NewPage'])
+        o.reparent('NewPage',['GrandChildPage'])
+        self.assertEquals(o.nesting()[0],
+                          ['RootPage',
+                           ['ChildPage',
+                            ['GrandChildPage',
+                             'NewPage']]])
+        o.replace('GrandChildPage','RenamedPage')
+        self.assertEquals(o.nesting()[0],
+                          ['RootPage',
+                           ['ChildPage',
+                            ['RenamedPage',
+                             'NewPage']]])
+        o.delete('ChildPage')
+        self.assertEquals(o.nesting()[0],
+                          ['RootPage',
+                           ['RenamedPage',
+                            'NewPage']])
+
+    def Xtest_reparent_speed(self):
+        # should not depend on the size of the outline
+        import time
+        for size in (5000, 50000):
+            parentmap = {}
+            for i in range(size):
+                parentmap['Page%d' % i] = i and ['Page%d' % (i/10)] or []
+            o = Outline(parentmap)
+            t = time.time()
+            for i in range(1, 101):
+                o.reparent('Page%d' % i, ['Page%d' % (size-i)])
+            print '%6d pages: %.3fs for 100 reparents' % (size, time.time() - t)
+
     def test_next(self):
         o = self.outline
         self.assertEquals(o.next('RootPage'),'ChildPage')
@@ -85,6 +120,36 @@ class Tests(unittest.TestCase):
         self.assertEquals(o.previous('ChildPage'),'RootPage')
         self.assertEquals(o.previous('SingletonPage'),'GrandChildPage')
 
+    def test_navigationFollowsChanges(self):
+        o = self.outline
+        self.assertEquals(o.next('TestPage',wrap=1),'RootPage')
+        o.add('ZuluPage')
+        self.assertEquals(o.next('TestPage'),'ZuluPage')
+        self.assertEquals(o.last(),'ZuluPage')
+        o.reparent('SingletonPage',['RootPage'])
+        self.assertEquals(o.next('RootPage'),'ChildPage')
+        self.assertEquals(o.previous('TestPage'),'SingletonPage')
+        o.delete('RootPage')
+        self.assertEquals(o.first(),'ChildPage')
+        self.assertEquals(o.previous('ChildPage'),None)
+        self.assert_(not o.hasNode('RootPage'))
+        self.assertEquals(o.nodeCount(),5)
+
+    def Xtest_next_speed(self):
+        # should not depend on the size of the outline
+        import time
+        for size in (5000, 50000):
+            parentmap = {}
+            for i in range(size):
+                parentmap['Page%d' % i] = i and ['Page%d' % (i/10)] or []
+            o = Outline(parentmap)
+            o.flat()
+            t = time.time()
+            for i in range(1000):
+                o.next('Page%d' % i)
+                o.previous('Page%d' % i)
+            print '%6d pages: %.3fs for 1000 next/previous' % (size, time.time() - t)
+
     def test_ancestors(self):
         o = self.outline
         self.assertEquals(o.ancestors('RootPage'),[['RootPage']])
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from testsupport import *
+ZopeTestCase.installProduct('ZWiki')
+from Products.ZWiki.Splitter import UnicodeWordSplitter, \
+     UnicodeHTMLWordSplitter, UnicodeCJKWordSplitter, UnicodeCaseNormalizer
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(Tests))
+    return suite
+
+def words(splitter, t, glob=False):
+    if glob: return UnicodeCaseNormalizer().process(splitter.processGlob([t]))
+    else: return UnicodeCaseNormalizer().process(splitter.process([t]))
+
+class Tests(unittest.TestCase):
+
+    def test_splitter(self):
+        self.assertEqual([u'envoy\xe9', u'b', u'bold', u'b', u'x', u'amp', u'y'],
+                         words(UnicodeWordSplitter(),
+                               'Envoy\xc3\xa9 <b>bold</b> x&amp;y'))
+        self.assertEqual([u'envoy\xe9', u'bold', u'x', u'y'],
+                         words(UnicodeHTMLWordSplitter(),
+                               u'Envoy\xe9 <b>bold</b> x&amp;y'))
+        self.assertEqual([u'wiki*', u'pa?e'],
+                         words(UnicodeHTMLWordSplitter(), '<i>Wiki*</i> Pa?e', 1))
+        self.assertEqual([], words(UnicodeWordSplitter(), ''))
+
+    def test_cjk_bigrams(self):
+        s = UnicodeCJKWordSplitter()
+        self.assertEqual([u'東京', u'京都', u'abc', u'漢', u'x', u'東京', u'y'],
+                         words(s, u'東京都 abc 漢 x東京y'))
+        self.assertEqual([u'東京', u'abc*'], words(s, u'東京* abc*', 1))
+        # without bigrams, a CJK run is one word
+        self.assertEqual([u'東京都'], words(UnicodeWordSplitter(), u'東京都'))
+
+    def Xtest_indexing_speed(self):
+        # splitting & normalizing throughput on the bundled wiki pages
+        import os, glob, time
+        dir = os.path.join(os.path.dirname(__file__), '..', 'content', 'basic')
+        pages = [open(f).read() for f in glob.glob(os.path.join(dir,'*'))]
+        size = sum(map(len, pages))
+        splitter, normalizer = UnicodeHTMLWordSplitter(), UnicodeCaseNormalizer()
+        start = time.time()
+        for i in range(100):
+            for t in pages: normalizer.process(splitter.process([t]))
+        elapsed = time.time() - start
+        print '%d pages/s, %.1f MB/s' % (100*len(pages)/elapsed,
+                                          100*size/elapsed/1e6)
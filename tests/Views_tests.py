@@ -14,6 +14,31 @@ class Tests(ZwikiTestCase):
         # make sure all default templates have meta_type
         self.failIf(filter(lambda x:not safe_hasattr(x,'meta_type'),TEMPLATES.values()))
 
+    def test_skinTemplatesLoadedLazily(self):
+        from Products.ZWiki.Views import registerSkin, isPageTemplate
+        from Products.ZWiki.Utils import abszwikipath
+        skin = registerSkin(abszwikipath('skins/zwiki'))
+        self.assert_('wikipage' in skin.keys())
+        self.assertEqual({}, skin.objects)
+        self.assert_(isPageTemplate(skin['wikipage']))
+        self.assertEqual(['wikipage'], skin.objects.keys())
+        self.assert_(skin['wikipage'] is skin.get('wikipage'))
+        self.assertEqual(None, skin.get('nosuchtemplate'))
+
+    def Xtest_startup_speed(self):
+        # registering the skins at product import, vs loading and
+        # compiling everything as was done before
+        import time
+        from Products.ZWiki.Views import registerSkin, isPageTemplate
+        from Products.ZWiki.Utils import abszwikipath
+        start = time.time()
+        for i in range(10): skin = registerSkin(abszwikipath('skins/zwiki'))
+        print 'registering skin: %.4fs' % ((time.time() - start) / 10)
+        start = time.time()
+        for t in skin.values():
+            if isPageTemplate(t): t.pt_macros()
+        print 'loading and compiling all templates: %.4fs' % (time.time() - start)
+
 class BindingsTests(ZwikiTestCase):
     """
     Tests of template bindings and acquisition context, for eg #1285 and #1220.
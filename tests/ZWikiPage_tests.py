@@ -97,6 +97,29 @@ class Tests(ZwikiTestCase):
         self.failIf(p.pageWithFuzzyName('test'))
         self.assert_(p.pageWithFuzzyName('test',allow_partial=1))
 
+    def test_pageIdIndex(self):
+        p = self.page
+        index = p.pageIdIndex()
+        self.assert_(index.has('TestPage'))
+        # kept up to date as pages come and go
+        p.create('IssueNo0010')
+        p.create('IssueNo0100')
+        self.assert_(index.has('IssueNo0010'))
+        self.assertEqual(index.withIdIgnoringCase('issueno0100'),'IssueNo0100')
+        self.assertEqual(index.withIdPrefixIgnoringCase('issueno01'),'IssueNo0100')
+        self.assertEqual(index.withIdPrefixIgnoringCase('IssueNo001',1),None)
+        p.pageWithId('IssueNo0010').rename('IssueNo0011')
+        self.failIf(index.has('IssueNo0010'))
+        self.assert_(index.has('IssueNo0011'))
+        p.pageWithId('IssueNo0011').delete()
+        self.failIf(index.has('IssueNo0011'))
+        self.assertEqual(len(index),len(p.pageIds()))
+        # a page added or removed by another thread (which changes the
+        # serial number) makes us rebuild it
+        p.bumpCacheSerial('_pageidserial')
+        self.assert_(p.pageIdIndex() is not index)
+        self.assertEqual(len(p.pageIdIndex()),len(p.pageIds()))
+
     def test_backlinksFor(self):
         p = self.page
         p.title = 'Test Page'
@@ -104,6 +127,47 @@ class Tests(ZwikiTestCase):
         p.create('PageThree',text='TestPage')
         self.assertEqual(len(p.backlinksFor('Test Page')),2)
 
+    def test_linkGraph(self):
+        p = self.page
+        # not built lazily, the queries fall back until it exists
+        self.assertEqual(None, p.linkGraph())
+        self.assertEqual([], p.orphanedPageIds())
+        graph = p.rebuildLinkGraph()
+        self.assertEqual(graph, p.linkGraph())
+        self.assertEqual(['TestPage'], graph.orphans())
+        p.create('PageTwo',text='TestPage WantedPage')
+        p.create('PageThree',text='PageTwo PageThree')
+        self.assertEqual(['PageTwo'], graph.backlinks('TestPage'))
+        self.assertEqual(['PageThree'], graph.backlinks('PageTwo'))
+        self.assertEqual(['PageThree'], p.orphanedPageIds())
+        self.assertEqual(['WantedPage'], p.wantedPageIds())
+        self.assertEqual(1, p.backlinkCount())
+        self.assertEqual(2, p.pageWithId('PageTwo').linkCount())
+        # kept up to date by edit, comment, rename and delete
+        p.pageWithId('PageTwo').edit(text='PageThree')
+        self.assertEqual(['TestPage'], p.orphanedPageIds())
+        self.assertEqual([], p.wantedPageIds())
+        p.comment(text='WantedPage',username='me')
+        self.assertEqual(['WantedPage'], p.wantedPageIds())
+        p.pageWithId('PageThree').rename('RenamedPage',updatebacklinks=0)
+        self.assertEqual(['PageThree','WantedPage'], p.wantedPageIds())
+        self.assertEqual(['PageTwo','RenamedPage'], graph.backlinks('PageThree'))
+        p.pageWithId('PageTwo').delete()
+        self.assertEqual(['PageThree','PageTwo','WantedPage'], p.wantedPageIds())
+        self.assertEqual(['RenamedPage','TestPage'], p.orphanedPageIds())
+        self.assertEqual(graph.wanted(), p.rebuildLinkGraph().wanted())
+
+    def test_linkGraphIgnoresPreview(self):
+        p = self.page
+        p.create('PageTwo',text='TestPage')
+        p.rebuildLinkGraph()
+        self.assertEqual(1, len(p.backlinksFor('TestPage')))
+        p.pageWithId('PageTwo').renderText('no links here','stx')
+        self.assertEqual(1, len(p.backlinksFor('TestPage')))
+        self.assertEqual([], p.wantedPageIds())
+        p.pageWithId('PageTwo').renderText('WantedPage','stx')
+        self.assertEqual([], p.wantedPageIds())
+
     def test_isWikiName(self):
         p = self.page
         self.assert_(p.isWikiName('WikiName'))
@@ -162,6 +226,29 @@ class Tests(ZwikiTestCase):
             'WikiName, ((double parentheses)), (bla), ((double parentheses))'),
             'WikiName, <zwiki>((double parentheses))</zwiki>, (bla), <zwiki>((double parentheses))</zwiki>')
 
+    def test_markLinksInLiteralContext(self):
+        # links in pre, code, tags, anchors and dtml are left alone, the
+        # context being carried from one link to the next
+        self.assertEquals(
+            self.p.markLinksIn(
+            'WikiName <pre>WikiName</pre> <code>WikiName</code> '
+            '<a href="x">WikiName</a> <a name="y">WikiName '
+            '<b class="WikiName">&dtml-WikiName; WikiName'),
+            '<zwiki>WikiName</zwiki> <pre>WikiName</pre> <code>WikiName</code> '
+            '<a href="x">WikiName</a> <a name="y"><zwiki>WikiName</zwiki> '
+            '<b class="WikiName">&dtml-WikiName; <zwiki>WikiName</zwiki>')
+
+    def Xtest_markLinksIn_speed(self):
+        # should scale roughly linearly with text size
+        import time
+        chunk = ('WikiName <b>bold</b> [free link] <pre>PreName</pre> '
+                 '<a href="http://a.b">AnchorName</a> http://a.b/c text\n')
+        for size in (10000, 100000, 1000000):
+            text = (chunk * (size/len(chunk) + 1))[:size]
+            t = time.time()
+            self.p.markLinksIn(text)
+            print '%8d chars: %.3fs' % (size, time.time() - t)
+
     def test_formatWikiname(self):
         self.assertEquals(self.p.formatWikiname('CamelCase'),'CamelCase')
         self.p.folder().space_wikinames = 1
@@ -185,7 +272,66 @@ class Tests(ZwikiTestCase):
         self.assertEquals(
             self.p.renderLink('[http://some.url|label]'),
             '<a href="http://some.url">label</a>')
-        
+
+    def test_linkCache(self):
+        p = self.p
+        self.assertEquals(p.resolveLink('TestPage'),('TestPage',1,''))
+        self.assertEquals(p.resolveLink('NewPage'),('NewPage',0,''))
+        self.assert_(p.linkCache().has_key(('name','NewPage')))
+        # a change in another thread (seen as a new serial number) clears it
+        p.bumpCacheSerial('_linkcacheserial')
+        self.failIf(p.linkCache().has_key(('name','NewPage')))
+        self.assertEquals(p.resolveLink('NewPage'),('NewPage',0,''))
+        # as do creating, renaming and deleting pages
+        p.create('NewPage')
+        self.failIf(p.linkCache().has_key(('name','NewPage')))
+        self.assertEquals(p.resolveLink('NewPage'),('NewPage',1,''))
+        p.pageWithName('NewPage').rename('OtherPage')
+        self.assertEquals(p.resolveLink('NewPage'),('NewPage',0,''))
+        self.assertEquals(p.resolveLink('OtherPage'),('OtherPage',1,''))
+        p.pageWithName('OtherPage').delete()
+        self.assertEquals(p.resolveLink('OtherPage'),('OtherPage',0,''))
+        # repeat renders give the same result
+        self.assertEquals(p.renderLink('TestPage'),p.renderLink('TestPage'))
+
+    def test_renderCache(self):
+        import transaction
+        p, r = self.p, self.request
+        transaction.savepoint() # give the page a _p_jar
+        self.logout()
+        # disabled by default
+        self.failIf(p.renderCacheVariant(REQUEST=r))
+        p.folder().use_render_cache = 1
+        variant = p.renderCacheVariant(REQUEST=r)
+        self.assert_(variant)
+        p.cacheRender(variant,'cached','text/html')
+        self.assertEqual(p.cachedRender(variant),('cached','text/html'))
+        p.clearRenderCache()
+        self.assertEqual(p.cachedRender(variant),None)
+        # adding or removing pages anywhere in the wiki invalidates it
+        p.cacheRender(variant,'cached','text/html')
+        p.bumpCacheSerial('_pageidserial')
+        self.assertEqual(p.cachedRender(variant),None)
+        # accepted languages are normalised, and variants per page are limited
+        from Products.ZWiki.ZWikiPage import acceptedLanguages
+        self.assertEqual(acceptedLanguages('en-US, fr;q=0.8 ,,DE; q=0.5'),
+                         'en-us,fr,de')
+        from Products.ZWiki.Defaults import RENDER_CACHE_VARIANTS
+        for i in range(RENDER_CACHE_VARIANTS + 1):
+            p.cacheRender(variant+(i,),'cached','text/html')
+        self.assertEqual(p.cachedRender(variant+(0,)),('cached','text/html'))
+        self.assertEqual(p.cachedRender(variant+(RENDER_CACHE_VARIANTS,)),None)
+        p.clearRenderCache()
+        # personalized views are not cached
+        r.cookies['zwiki_username'] = 'someone'
+        self.failIf(p.renderCacheVariant(REQUEST=r))
+        del r.cookies['zwiki_username']
+        r.form['skin'] = 'zwiki'
+        self.failIf(p.renderCacheVariant(REQUEST=r))
+        self.login()
+        del r.form['skin']
+        self.failIf(p.renderCacheVariant(REQUEST=r))
+
     def test_renderLinksIn(self):
         self.assertEquals(self.p.renderLinksIn('nolink'),'nolink')
         self.assertEquals(self.p.renderLinksIn('http://a.b.c/d'),
@@ -244,6 +390,20 @@ class Tests(ZwikiTestCase):
         self.p.edit(text='&dtml-subtopics')
         self.assert_(self.p.displaysSubtopicsWithDtml())
 
+    def test_cook(self):
+        # pages with the same text share one parse, which survives the
+        # loss of their volatile attributes
+        self.p.allow_dtml = 1
+        self.p.edit(text='<dtml-var "1+1">')
+        self.p.create('OtherPage',text='<dtml-var "1+1">')
+        q = self.wiki.OtherPage
+        self.p.cook(); q.cook()
+        self.assert_(self.p._v_blocks is q._v_blocks)
+        blocks = q._v_blocks
+        del q._v_blocks, q._v_cooked
+        q.cook()
+        self.assert_(q._v_blocks is blocks)
+
     def test_linkTitleFrom(self):
         edittime = DateTime.DateTime() - 0.2
         edittime = edittime.ISO8601()
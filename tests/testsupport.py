@@ -174,6 +174,31 @@ def mockPage(source_string='', mapping=None, __name__='TestPage', folder=None):
     folder.REQUEST = page.REQUEST
     return folder[id]
 
+class MockSMTPServer:
+    """
+    A local stand-in for an SMTP server, which collects the messages it
+    receives in .received as (mailfrom, rcpttos, data) tuples. Runs in a
+    thread until stop() is called.
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        import smtpd, asyncore, threading
+        received = self.received = []
+        class Server(smtpd.SMTPServer):
+            def process_message(self, peer, mailfrom, rcpttos, data):
+                received.append((mailfrom, rcpttos, data))
+        self.server = Server((host, port), None)
+        self.host, self.port = self.server.socket.getsockname()
+        self.running = 1
+        def loop():
+            while self.running: asyncore.loop(timeout=0.1, count=1)
+        self.thread = threading.Thread(target=loop)
+        self.thread.setDaemon(1)
+        self.thread.start()
+    def stop(self):
+        self.running = 0
+        self.thread.join()
+        self.server.close()
+
 
 # if PTS is installed, disabled it to let tests run.. I18n_tests.py will
 # test it directly